@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+import time
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+FINAL_STATES = (DONE, FAILED)
+
+
+class BatchManifest:
+    """
+    On-disk record of the state of every pair in a batch screen.
+
+    The manifest is an append-only JSON lines journal: a header describing
+    the batch followed by one line per state change. Appending keeps each
+    update cheap for screens of any size, and replaying the journal after a
+    crash restores the last recorded state of every pair. A torn last line
+    from an interrupted write is cut off so the next record starts on a
+    line of its own.
+
+    With retry_failed, pairs recorded as failed are pending again when an
+    existing journal is reopened; failures from timeouts or killed workers
+    are often transient.
+    """
+
+    def __init__(self, path, header=None, retry_failed=False):
+        self.path = path
+        self.header = header or {}
+        self.pairs = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            self._load()
+            if retry_failed:
+                self.pairs = {index: record for index, record in self.pairs.items() if record['state'] != FAILED}
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(json.dumps({'header': self.header, 'created_at': time.time()}) + '\n')
+
+    def _load(self):
+        complete = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                complete += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 'header' in record:
+                    self.header = record['header']
+                elif 'index' in record:
+                    self.pairs[record['index']] = record
+        if complete < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(complete)
+
+    def mark(self, index, state, result=None, error=None):
+        """Record a pair's new state and append it to the journal"""
+        record = {'index': index, 'state': state, 'time': time.time()}
+        if result is not None:
+            record['result'] = result
+        if error is not None:
+            record['error'] = str(error)
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            self.pairs[index] = record
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+    def state(self, index):
+        record = self.pairs.get(index)
+        return record['state'] if record else PENDING
+
+    def is_finished(self, index):
+        return self.state(index) in FINAL_STATES
+
+    def interrupted_at(self, index):
+        """Time a pair started running if a previous run stopped while docking it"""
+        record = self.pairs.get(index)
+        if record and record['state'] == RUNNING:
+            return record['time']
+        return None
+
+    def results(self):
+        """Results of finished pairs as {pair_index: result}"""
+        return {index: record.get('result') for index, record in self.pairs.items()
+                if record['state'] == DONE}
+
+    def counts(self):
+        counts = {}
+        for record in self.pairs.values():
+            counts[record['state']] = counts.get(record['state'], 0) + 1
+        return counts
@@ -0,0 +1,159 @@
+import heapq
+import math
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+def plan_workers(max_jobs=None, cpu_per_job=None, exhaustiveness=1,
+                 total_cpus=None):
+    """
+    Split the available cores between concurrently running smina processes.
+
+    Smina parallelises over its Monte Carlo runs, so a job never benefits from
+    more threads than its exhaustiveness. When neither value is given the pool
+    runs as many single-purpose jobs as the machine has room for.
+
+    Args:
+        max_jobs: Number of concurrent docking jobs (default: derived)
+        cpu_per_job: Threads passed to each smina run via --cpu (default: derived)
+        exhaustiveness: Exhaustiveness used by each job (default: 1)
+        total_cpus: Cores available to the pool (default: os.cpu_count())
+
+    Returns:
+        tuple: (max_jobs, cpu_per_job)
+    """
+    total = max(1, int(total_cpus or os.cpu_count() or 1))
+
+    if cpu_per_job:
+        cpu_per_job = max(1, min(int(cpu_per_job), total))
+    elif max_jobs:
+        cpu_per_job = max(1, total // max(1, int(max_jobs)))
+    else:
+        cpu_per_job = max(1, min(int(exhaustiveness or 1), total))
+
+    jobs_limit = max(1, total // cpu_per_job)
+    if max_jobs:
+        max_jobs = max(1, min(int(max_jobs), jobs_limit))
+    else:
+        max_jobs = jobs_limit
+
+    return max_jobs, cpu_per_job
+
+
+def imap_ordered(func, items, max_jobs=1):
+    """
+    Run func over items in a bounded worker pool, yielding results in input order.
+
+    At most max_jobs calls run at once and at most max_jobs results wait to be
+    yielded, so items may be a lazy iterable of any length. Each call is
+    expected to spend its time in a child process (smina, obabel), so a
+    thread pool is enough to keep every worker busy.
+
+    Args:
+        func: Callable applied to each item
+        items: Iterable of work items
+        max_jobs: Maximum number of concurrent calls (default: 1)
+
+    Yields:
+        The return value of func for each item, in the order items were given
+    """
+    max_jobs = max(1, int(max_jobs or 1))
+    items = iter(items)
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_jobs:
+                break
+
+        while pending:
+            result = pending.popleft().result()
+            for item in items:
+                pending.append(executor.submit(func, item))
+                break
+            yield result
+
+
+def imap_unordered(func, items, max_jobs=1):
+    """
+    Run func over items in a bounded worker pool, yielding results as they finish.
+
+    Only max_jobs calls are in flight at any time and nothing is retained
+    after it has been yielded, so memory stays flat for any number of items.
+
+    Args:
+        func: Callable applied to each item
+        items: Iterable of work items
+        max_jobs: Maximum number of concurrent calls (default: 1)
+
+    Yields:
+        tuple: (index, result) where index is the item's position in items
+    """
+    max_jobs = max(1, int(max_jobs or 1))
+    items = enumerate(items)
+    in_flight = {}
+
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        for index, item in items:
+            in_flight[executor.submit(func, item)] = index
+            if len(in_flight) >= max_jobs:
+                break
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = in_flight.pop(future)
+                for next_index, item in items:
+                    in_flight[executor.submit(func, item)] = next_index
+                    break
+                yield index, future.result()
+
+
+class TopHits:
+    """
+    Keep the best-scoring entries of a screen without storing the rest.
+
+    Lower scores are better (binding affinities in kcal/mol).
+    """
+
+    def __init__(self, limit):
+        self.limit = max(0, int(limit))
+        self._heap = []
+        self._counter = 0
+
+    @classmethod
+    def for_screen(cls, total, top_k=None, top_percent=None):
+        """
+        Size the selection from an absolute count and/or a percentage of total.
+
+        When both are given the smaller selection wins; with neither the top
+        10 percent are kept.
+        """
+        limits = []
+        if top_k:
+            limits.append(int(top_k))
+        if top_percent:
+            limits.append(math.ceil(total * float(top_percent) / 100.0))
+        if not limits:
+            limits.append(math.ceil(total * 0.1))
+        return cls(min(limits))
+
+    def add(self, score, item):
+        if self.limit <= 0:
+            return
+        # heapq is a min-heap, so store negated scores to pop the worst first
+        entry = (-score, -self._counter, item)
+        self._counter += 1
+        if len(self._heap) < self.limit:
+            heapq.heappush(self._heap, entry)
+        elif entry > self._heap[0]:
+            heapq.heapreplace(self._heap, entry)
+
+    def ranked(self):
+        """Selected items, best score first"""
+        return [item for _, _, item in sorted(self._heap, reverse=True)]
+
+    def __len__(self):
+        return len(self._heap)
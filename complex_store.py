@@ -0,0 +1,149 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import pdbqt_io
+
+SIDECAR_SUFFIX = '.parts.json'
+
+
+def receptor_pdb(receptor_pdbqt, directory=None):
+    """
+    PDB version of a prepared receptor, converted once and reused.
+
+    The PDB is written next to the PDBQT, or into directory when given, and
+    regenerated only when the PDBQT is newer.
+
+    Returns:
+        str: Path of the receptor PDB
+    """
+    pdb_path = os.path.splitext(receptor_pdbqt)[0] + '.receptor.pdb'
+    if directory is not None:
+        pdb_path = os.path.join(directory, os.path.basename(pdb_path))
+    try:
+        if os.path.getmtime(pdb_path) >= os.path.getmtime(receptor_pdbqt):
+            return pdb_path
+    except OSError:
+        pass
+
+    # Concurrent batch pairs may convert the same receptor; publish atomically
+    tmp_path = f"{pdb_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        pdbqt_io.write_pdb(receptor_pdbqt, tmp_path)
+        os.replace(tmp_path, pdb_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return pdb_path
+
+
+def save_complex(complex_path, receptor_path, ligand_path):
+    """
+    Record a complex as references to its receptor and ligand PDB files.
+
+    Nothing is combined here; build_complex() assembles the file when it is
+    requested.
+    """
+    base = os.path.dirname(complex_path)
+    parts = {
+        'receptor': os.path.relpath(receptor_path, base),
+        'ligand': os.path.relpath(ligand_path, base)
+    }
+    with open(complex_path + SIDECAR_SUFFIX, 'w') as f:
+        json.dump(parts, f)
+    # A complex written in full by an earlier run would shadow the sidecar
+    if os.path.exists(complex_path):
+        os.remove(complex_path)
+
+
+def complex_parts(complex_path):
+    """
+    Receptor and ligand files a lazily built complex is made of.
+
+    Returns:
+        tuple: (receptor_path, ligand_path), or None if complex_path has no sidecar
+    """
+    try:
+        with open(complex_path + SIDECAR_SUFFIX, 'r') as f:
+            parts = json.load(f)
+    except (OSError, ValueError):
+        return None
+    base = os.path.dirname(complex_path)
+    return os.path.join(base, parts['receptor']), os.path.join(base, parts['ligand'])
+
+
+def build_complex(receptor_path, ligand_path):
+    """
+    Combine receptor and ligand PDB files into one complex.
+
+    Returns:
+        bytes: PDB text of the receptor, a TER record and the ligand atoms
+    """
+    lines = []
+    with open(receptor_path, 'r') as rec:
+        lines.extend(line for line in rec if not line.startswith('END'))
+    lines.append('TER\n')
+    with open(ligand_path, 'r') as lig:
+        lines.extend(line for line in lig if not line.startswith(('MODEL', 'ENDMDL', 'END')))
+    lines.append('END\n')
+    return ''.join(lines).encode('utf-8')
+
+
+class BuiltComplex:
+    """An assembled complex with its content hash and a lazily made gzip copy"""
+
+    def __init__(self, data):
+        self.data = data
+        self.etag = hashlib.sha256(data).hexdigest()
+        self._gzipped = None
+
+    def gzipped(self):
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.data, compresslevel=6, mtime=0)
+        return self._gzipped
+
+
+class ComplexCache:
+    """
+    Small LRU cache of assembled complexes, keyed by path and part versions.
+
+    Viewers tend to re-request the same few poses, so recent complexes are
+    kept in memory instead of being rebuilt on every request.
+    """
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, complex_path):
+        """
+        Complex for complex_path, built from its parts if needed.
+
+        Returns:
+            BuiltComplex: The complex, or None if complex_path is not a lazy complex
+        """
+        parts = complex_parts(complex_path)
+        if parts is None:
+            return None
+        try:
+            key = (complex_path,) + tuple(os.stat(p).st_mtime_ns for p in parts)
+        except OSError:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+
+        entry = BuiltComplex(build_complex(*parts))
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
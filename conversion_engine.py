@@ -0,0 +1,361 @@
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+import batch_scheduler
+
+try:
+    from openbabel import pybel
+except ImportError:
+    pybel = None
+
+SDF_DELIMITER = '$$$$'
+MOL2_MOLECULE = '@<TRIPOS>MOLECULE'
+# Input formats whose single-molecule files can be merged into one batch file
+BATCH_FORMATS = {'.sdf': 'sdf', '.sd': 'sdf', '.mol': 'sdf', '.mol2': 'mol2'}
+
+
+def _read_sdf_records(path):
+    """Records of an SDF/MOL file as lists of lines, without the $$$$ delimiters"""
+    records, current = [], []
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip() == SDF_DELIMITER:
+                records.append(current)
+                current = []
+            else:
+                current.append(line if line.endswith('\n') else line + '\n')
+    if any(line.strip() for line in current):
+        records.append(current)
+    return records
+
+
+def _write_sdf_record(f, record, title=None):
+    f.write((title if title is not None else record[0].rstrip('\n')) + '\n')
+    f.writelines(record[1:])
+    f.write(SDF_DELIMITER + '\n')
+
+
+def _read_mol2_records(path):
+    """Molecules of a MOL2 file as lists of lines, each starting at its MOLECULE section"""
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            if line.startswith(MOL2_MOLECULE):
+                records.append([])
+            if records:
+                records[-1].append(line if line.endswith('\n') else line + '\n')
+    return records
+
+
+def _write_mol2_record(f, record, title=None):
+    f.write(record[0])
+    f.write((title if title is not None else record[1].rstrip('\n')) + '\n')
+    f.writelines(record[2:])
+
+
+# (reader, writer, title line index) per batchable format
+_RECORD_IO = {
+    'sdf': (_read_sdf_records, _write_sdf_record, 0),
+    'mol2': (_read_mol2_records, _write_mol2_record, 1)
+}
+
+
+def _input_format(path):
+    return os.path.splitext(path)[1].lower().lstrip('.') or 'pdb'
+
+
+class ObabelBackend:
+    """
+    OpenBabel command-line backend.
+
+    Batches convert many molecules per obabel process: inputs are written
+    to one multi-molecule file with a placeholder title per molecule, and
+    the output is split and matched back by those titles. Molecules missing
+    from a batch's output are retried one at a time, so one bad molecule
+    only costs an extra process for itself.
+    """
+
+    name = 'obabel'
+
+    def __init__(self, timeout_per_molecule=10, min_timeout=60):
+        self.timeout_per_molecule = timeout_per_molecule
+        self.min_timeout = min_timeout
+
+    def _run(self, args, output_file, count=1, action='Conversion'):
+        """
+        Run obabel; returns an error message, or None if output_file was written.
+
+        Runs over count ligands are limited to timeout_per_molecule each (at
+        least min_timeout). count=None runs without a timeout, for receptors
+        whose size says nothing about a hang.
+        """
+        timeout = max(self.min_timeout, self.timeout_per_molecule * count) if count else None
+        try:
+            result = subprocess.run(['obabel'] + args, capture_output=True, text=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return f"{action} timed out"
+        except Exception as e:
+            return f"{action} error: {str(e)}"
+
+        if result.returncode != 0:
+            return f"{action} failed: {result.stderr if result.stderr else result.stdout}"
+        if output_file and (not os.path.exists(output_file) or os.path.getsize(output_file) == 0):
+            return f"{action} produced empty file"
+        return None
+
+    def smiles_to_sdf(self, items, work_dir=None):
+        """
+        Build 3D structures (with hydrogens) from SMILES.
+
+        Args:
+            items: List of (smiles, output_sdf)
+            work_dir: Directory for batch files (default: system temp)
+
+        Returns:
+            list: Error message per item, None where the SDF was written
+        """
+        if len(items) == 1:
+            smiles, output_sdf = items[0]
+            return [self._run([f'-:{smiles}', '-O', output_sdf, '--gen3d', '-h'], output_sdf,
+                              action='3D structure generation')]
+
+        batch_dir = tempfile.mkdtemp(prefix='obabel-', dir=work_dir)
+        try:
+            smi_path = os.path.join(batch_dir, 'batch.smi')
+            with open(smi_path, 'w') as f:
+                for i, (smiles, _) in enumerate(items):
+                    f.write(f"{smiles} mol{i}\n")
+            sdf_path = os.path.join(batch_dir, 'batch.sdf')
+            self._run([smi_path, '-O', sdf_path, '--gen3d', '-h'], None, len(items), '3D structure generation')
+
+            found = {}
+            if os.path.exists(sdf_path):
+                for record in _read_sdf_records(sdf_path):
+                    found[record[0].strip()] = record
+
+            errors = []
+            for i, (smiles, output_sdf) in enumerate(items):
+                record = found.get(f'mol{i}')
+                if record is None:
+                    errors.extend(self.smiles_to_sdf([(smiles, output_sdf)]))
+                    continue
+                with open(output_sdf, 'w') as f:
+                    _write_sdf_record(f, record, title='')
+                errors.append(None)
+            return errors
+        finally:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+
+    def to_pdbqt(self, items, work_dir=None, ph=7.4, rigid=False):
+        """
+        Convert structures to PDBQT.
+
+        Args:
+            items: List of (input_file, output_pdbqt)
+            work_dir: Directory for batch files (default: system temp)
+            ph: pH used to protonate ligands
+            rigid: Write rigid receptors (-xr) instead of protonated ligands
+
+        Returns:
+            list: Error message per item, None where the PDBQT was written
+        """
+        options = ['-xr'] if rigid else ['-p', str(ph)]
+
+        # Only single-molecule SDF/MOL/MOL2 inputs can share a process, one per format
+        groups = {}
+        if len(items) > 1 and not rigid:
+            for i, (input_file, _) in enumerate(items):
+                kind = BATCH_FORMATS.get(os.path.splitext(input_file)[1].lower())
+                if kind is None:
+                    continue
+                try:
+                    file_records = _RECORD_IO[kind][0](input_file)
+                except (OSError, UnicodeDecodeError):
+                    continue
+                if len(file_records) == 1:
+                    groups.setdefault(kind, {})[i] = file_records[0]
+
+        converted = set()
+        for kind, records in groups.items():
+            if len(records) > 1:
+                converted |= self._batch_to_pdbqt(kind, records, items, options, work_dir)
+
+        errors = [None] * len(items)
+        for i, (input_file, output_pdbqt) in enumerate(items):
+            if i not in converted:
+                errors[i] = self._run([input_file, '-O', output_pdbqt] + options, output_pdbqt,
+                                      None if rigid else 1, 'PDBQT conversion')
+        return errors
+
+    def _batch_to_pdbqt(self, kind, records, items, options, work_dir):
+        """Convert {item index: record} in one obabel run; returns the indices written"""
+        _, write_record, title_line = _RECORD_IO[kind]
+        converted = set()
+        batch_dir = tempfile.mkdtemp(prefix='obabel-', dir=work_dir)
+        try:
+            batch_path = os.path.join(batch_dir, f'batch.{kind}')
+            with open(batch_path, 'w') as f:
+                for i, record in records.items():
+                    write_record(f, record, title=f'mol{i}')
+            self._run([batch_path, '-O', os.path.join(batch_dir, 'out.pdbqt'), '-m'] + options, None,
+                      len(records), 'PDBQT conversion')
+
+            for name in os.listdir(batch_dir):
+                if not (name.startswith('out') and name.endswith('.pdbqt')):
+                    continue
+                with open(os.path.join(batch_dir, name), 'r') as f:
+                    lines = f.readlines()
+                title = next((line.split('=', 1)[1].strip() for line in lines
+                              if line.startswith('REMARK') and 'Name =' in line), '')
+                if not title.startswith('mol') or not title[3:].isdigit() or int(title[3:]) not in records:
+                    continue
+                i = int(title[3:])
+                original = records[i][title_line].strip()
+                with open(items[i][1], 'w') as out:
+                    for line in lines:
+                        out.write(f"REMARK  Name = {original}\n"
+                                  if line.startswith('REMARK') and 'Name =' in line else line)
+                converted.add(i)
+        finally:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+        return converted
+
+    def add_hydrogens(self, input_file, output_file, ph=7.0):
+        """Protonate a structure for the given pH; returns an error message or None"""
+        return self._run([input_file, '-O', output_file, '-p', str(ph)], output_file, None, 'Hydrogen addition')
+
+    def to_pdb(self, input_file, output_file):
+        """Convert a structure to PDB; returns an error message or None"""
+        return self._run([input_file, '-O', output_file], output_file, None, 'PDB conversion')
+
+
+class PybelBackend:
+    """
+    In-process backend on the OpenBabel Python bindings.
+
+    No process is started per molecule. The bindings hold the GIL while
+    they work, so conversions on this backend do not run in parallel.
+    """
+
+    name = 'pybel'
+
+    def smiles_to_sdf(self, items, work_dir=None):
+        errors = []
+        for smiles, output_sdf in items:
+            try:
+                mol = pybel.readstring('smi', smiles)
+                # make3D adds hydrogens, then builds and cleans up coordinates
+                mol.make3D()
+                mol.write('sdf', output_sdf, overwrite=True)
+                errors.append(None)
+            except Exception as e:
+                errors.append(f"3D structure generation failed: {str(e)}")
+        return errors
+
+    def to_pdbqt(self, items, work_dir=None, ph=7.4, rigid=False):
+        errors = []
+        for input_file, output_pdbqt in items:
+            try:
+                mol = next(pybel.readfile(_input_format(input_file), input_file))
+                if rigid:
+                    mol.write('pdbqt', output_pdbqt, overwrite=True, opt={'r': None})
+                else:
+                    mol.OBMol.AddHydrogens(False, True, ph)
+                    mol.write('pdbqt', output_pdbqt, overwrite=True)
+                errors.append(None)
+            except Exception as e:
+                errors.append(f"PDBQT conversion failed: {str(e)}")
+        return errors
+
+    def add_hydrogens(self, input_file, output_file, ph=7.0):
+        try:
+            mol = next(pybel.readfile(_input_format(input_file), input_file))
+            mol.OBMol.AddHydrogens(False, True, ph)
+            mol.write(_input_format(output_file), output_file, overwrite=True)
+            return None
+        except Exception as e:
+            return f"Hydrogen addition failed: {str(e)}"
+
+    def to_pdb(self, input_file, output_file):
+        try:
+            mol = next(pybel.readfile(_input_format(input_file), input_file))
+            mol.write('pdb', output_file, overwrite=True)
+            return None
+        except Exception as e:
+            return f"PDB conversion failed: {str(e)}"
+
+
+class ConversionEngine:
+    """
+    Runs molecule conversions on a backend, in batches over a worker pool.
+
+    Lists of molecules are cut into batches, and up to workers batches are
+    converted at once. With the command-line backend each batch is one
+    obabel process; the in-process backend runs one batch at a time.
+    """
+
+    def __init__(self, backend=None, workers=None, batch_size=50):
+        self.backend = backend or (PybelBackend() if pybel is not None else ObabelBackend())
+        if self.backend.name == 'pybel':
+            workers = 1
+        self.workers = max(1, int(workers or os.cpu_count() or 1))
+        self.batch_size = max(1, int(batch_size))
+
+    def _batches(self, items):
+        # Small lists are spread over every worker rather than filling one batch
+        size = max(1, min(self.batch_size, math.ceil(len(items) / self.workers)))
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    def _map(self, convert, items):
+        errors = []
+        for batch_errors in batch_scheduler.imap_ordered(convert, self._batches(list(items)), self.workers):
+            errors.extend(batch_errors)
+        return errors
+
+    def smiles_to_sdf(self, items, work_dir=None):
+        """3D SDF files from (smiles, output_sdf) items; returns an error (or None) per item"""
+        return self._map(lambda batch: self.backend.smiles_to_sdf(batch, work_dir), items)
+
+    def to_pdbqt(self, items, work_dir=None, ph=7.4, rigid=False):
+        """PDBQT files from (input_file, output_pdbqt) items; returns an error (or None) per item"""
+        return self._map(lambda batch: self.backend.to_pdbqt(batch, work_dir, ph=ph, rigid=rigid), items)
+
+    def add_hydrogens(self, input_file, output_file, ph=7.0):
+        return self.backend.add_hydrogens(input_file, output_file, ph)
+
+    def to_pdb(self, input_file, output_file):
+        return self.backend.to_pdb(input_file, output_file)
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def configure(backend=None, workers=None, batch_size=50):
+    """
+    Set up the engine used by default_engine().
+
+    Args:
+        backend: 'pybel', 'obabel' or None to use pybel when it is installed
+    """
+    global _default
+    if backend == 'pybel' and pybel is None:
+        print("OpenBabel Python bindings are not installed; using the obabel command")
+        backend = None
+    instance = {'pybel': PybelBackend, 'obabel': ObabelBackend}.get(backend, lambda: None)()
+    _default = ConversionEngine(instance, workers=workers, batch_size=batch_size)
+    return _default
+
+
+def default_engine():
+    """The configured engine, created from the environment on first use"""
+    with _default_lock:
+        if _default is None:
+            configure(os.environ.get('CONVERSION_BACKEND') or None,
+                      workers=int(os.environ.get('CONVERSION_WORKERS', 0)) or None,
+                      batch_size=int(os.environ.get('CONVERSION_BATCH_SIZE', 50)))
+        return _default
@@ -0,0 +1,134 @@
+import functools
+import itertools
+import json
+import os
+import threading
+
+import verify_structures
+
+# Seconds per work unit before any runtime has been observed; puts a
+# 30-atom ligand with 5 torsions in a 30 A box at about a minute at
+# exhaustiveness 8 on one core.
+DEFAULT_SECONDS_PER_UNIT = 0.04
+REFERENCE_BOX_VOLUME = 30.0 ** 3
+
+
+@functools.lru_cache(maxsize=4096)
+def _structure_size(path, mtime_ns):
+    stats = verify_structures.verify_pdbqt_structure(path, is_protein=False).get('statistics', {})
+    return stats.get('atom_count', 0), stats.get('torsion_count', 0)
+
+
+def structure_size(path):
+    """
+    Atom and torsion counts of a PDBQT file, memoised per file version.
+
+    Returns:
+        tuple: (atom_count, torsion_count)
+    """
+    try:
+        return _structure_size(os.path.abspath(path), os.stat(path).st_mtime_ns)
+    except OSError:
+        return 0, 0
+
+
+class CostModel:
+    """
+    Estimate how long smina takes for a receptor/ligand pair.
+
+    The estimate is a work figure that grows with ligand size and
+    flexibility, exhaustiveness, search box volume and receptor size,
+    multiplied by a seconds-per-unit scale. The scale starts from a default
+    and follows observed runtimes (exponential moving average), and is saved
+    to path so later runs start from what this machine actually achieves.
+    """
+
+    def __init__(self, path=None, safety=4.0, min_timeout=60, max_timeout=3600, smoothing=0.2):
+        self.path = path
+        self.safety = safety
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.smoothing = smoothing
+        self.seconds_per_unit = DEFAULT_SECONDS_PER_UNIT
+        self.observations = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+            self.seconds_per_unit = float(state['seconds_per_unit'])
+            self.observations = int(state.get('observations', 0))
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable cost model {self.path}: {e}")
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump({'seconds_per_unit': self.seconds_per_unit, 'observations': self.observations}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not save cost model: {e}")
+
+    def work(self, receptor, ligand, box_size, exhaustiveness=8, cpu=1):
+        """Relative amount of work for one docking run (unitless)"""
+        receptor_atoms, _ = structure_size(receptor)
+        ligand_atoms, torsions = structure_size(ligand)
+        volume = box_size[0] * box_size[1] * box_size[2]
+        search = (max(ligand_atoms, 1) * (1 + torsions) * max(int(exhaustiveness or 1), 1)
+                  * (volume / REFERENCE_BOX_VOLUME) ** (1.0 / 3.0))
+        # Smina spreads its Monte Carlo runs over at most exhaustiveness threads
+        threads = max(1, min(int(cpu or 1), int(exhaustiveness or 1)))
+        # Grid precomputation scales with receptor size and box volume, not with the search
+        grids = receptor_atoms * volume / REFERENCE_BOX_VOLUME / 100.0
+        return search / threads + grids
+
+    def estimate(self, work):
+        """Expected runtime in seconds for the given amount of work"""
+        return work * self.seconds_per_unit
+
+    def timeout(self, work, runs=1):
+        """Timeout in seconds for work spread over runs docking runs"""
+        seconds = self.estimate(work) * self.safety
+        return max(self.min_timeout * runs, min(seconds, self.max_timeout * runs))
+
+    def observe(self, work, seconds):
+        """Fold the measured runtime of a completed run into the scale"""
+        if work <= 0 or seconds <= 0:
+            return
+        with self._lock:
+            rate = seconds / work
+            if self.observations == 0:
+                self.seconds_per_unit = rate
+            else:
+                self.seconds_per_unit += self.smoothing * (rate - self.seconds_per_unit)
+            self.observations += 1
+            self._save()
+
+
+def longest_first(items, cost, window=None):
+    """
+    Order work items by estimated cost, most expensive first.
+
+    Starting the long jobs first keeps one slow job from running alone at the
+    end of a batch, which shortens its total runtime. With a window only
+    that many consecutive items are read and sorted at a time, so the first
+    item is available without costing the whole batch and memory stays
+    bounded by the window.
+    """
+    if not window:
+        yield from sorted(items, key=cost, reverse=True)
+        return
+    items = iter(items)
+    while True:
+        block = list(itertools.islice(items, window))
+        if not block:
+            return
+        yield from sorted(block, key=cost, reverse=True)
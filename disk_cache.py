@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+META_FILE = 'meta.json'
+
+
+def make_key(*parts):
+    """
+    Build a stable cache key from bytes, strings and JSON-serialisable values.
+
+    Returns:
+        str: Hex SHA-256 digest of all parts
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, bytes):
+            data = part
+        elif isinstance(part, str):
+            data = part.encode('utf-8')
+        else:
+            data = json.dumps(part, sort_keys=True, default=str).encode('utf-8')
+        digest.update(len(data).to_bytes(8, 'big'))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+_digest_memo = {}
+_digest_lock = threading.Lock()
+
+
+def file_digest(path):
+    """
+    SHA-256 of a file's contents, memoised on (path, mtime, size).
+
+    Returns:
+        str: Hex digest
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _digest_lock:
+        cached = _digest_memo.get(memo_key)
+    if cached:
+        return cached
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    value = digest.hexdigest()
+
+    with _digest_lock:
+        if len(_digest_memo) > 4096:
+            _digest_memo.clear()
+        _digest_memo[memo_key] = value
+    return value
+
+
+class DiskCache:
+    """
+    Size-bounded LRU cache of files on disk.
+
+    Every entry is a directory named after its key holding the cached files
+    and a meta.json. Reading an entry refreshes the mtime of its meta.json,
+    which is what eviction orders by, so the cache survives restarts and can
+    be shared by several processes on the same filesystem.
+    """
+
+    def __init__(self, root, max_bytes=1024 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        os.makedirs(root, exist_ok=True)
+        self.evict()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """
+        Look up an entry and mark it as recently used.
+
+        Returns:
+            tuple: (entry_dir, meta) on a hit, (None, None) on a miss
+        """
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, META_FILE)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            os.utime(meta_path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None, None
+
+        with self._lock:
+            self.hits += 1
+        return entry_dir, meta
+
+    def put(self, key, files=None, meta=None):
+        """
+        Store files under key, replacing nothing if the key already exists.
+
+        Args:
+            key: Cache key from make_key()
+            files: Mapping of entry file name to source path (copied) or bytes
+            meta: JSON-serialisable metadata saved with the entry
+
+        Returns:
+            str: Path of the entry directory, or None if storing failed
+        """
+        entry_dir = self._entry_dir(key)
+        if os.path.exists(os.path.join(entry_dir, META_FILE)):
+            return entry_dir
+
+        tmp_dir = os.path.join(self.root, f'.tmp-{uuid.uuid4().hex}')
+        try:
+            os.makedirs(tmp_dir)
+            for name, source in (files or {}).items():
+                target = os.path.join(tmp_dir, name)
+                if isinstance(source, bytes):
+                    with open(target, 'wb') as f:
+                        f.write(source)
+                else:
+                    shutil.copyfile(source, target)
+            with open(os.path.join(tmp_dir, META_FILE), 'w') as f:
+                json.dump({**(meta or {}), 'stored_at': time.time()}, f)
+
+            size = _dir_size(tmp_dir)
+            os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # Another writer stored the same key first
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return entry_dir
+        except Exception as e:
+            print(f"Cache write failed for {key}: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return None
+
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += size
+        self.evict()
+        return entry_dir
+
+    def delete(self, key):
+        """Remove an entry, e.g. one that has expired"""
+        entry_dir = self._entry_dir(key)
+        size = _dir_size(entry_dir)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes = max(0, self._total_bytes - size)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes"""
+        with self._lock:
+            if self._total_bytes is not None and self._total_bytes <= self.max_bytes:
+                return
+
+            entries = []
+            for prefix in os.listdir(self.root):
+                prefix_dir = os.path.join(self.root, prefix)
+                if prefix.startswith('.') or not os.path.isdir(prefix_dir):
+                    continue
+                for key in os.listdir(prefix_dir):
+                    entry_dir = os.path.join(prefix_dir, key)
+                    try:
+                        used = os.path.getmtime(os.path.join(entry_dir, META_FILE))
+                    except OSError:
+                        used = 0
+                    entries.append((used, _dir_size(entry_dir), entry_dir))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry_dir in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total -= size
+            self._total_bytes = total
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'size_bytes': self._total_bytes,
+                'max_bytes': self.max_bytes
+            }
+
+
+def _dir_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
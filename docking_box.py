@@ -0,0 +1,176 @@
+import numpy as np
+
+import pdbqt_io
+
+
+def box_from_coordinates(coords, padding=5.0, min_size=10.0, max_size=None):
+    """
+    Docking box enclosing a set of coordinates.
+
+    Args:
+        coords: (N, 3) array of atom coordinates
+        padding: Margin added on every side in Angstrom (default: 5.0)
+        min_size: Smallest edge length in Angstrom (default: 10.0)
+        max_size: Largest edge length in Angstrom (default: unlimited)
+
+    Returns:
+        dict: {'center': (x, y, z), 'size': (sx, sy, sz)}
+    """
+    coords = np.asarray(coords, dtype=float)
+    if coords.size == 0:
+        raise ValueError("No coordinates to build a docking box from")
+
+    lower = coords.min(axis=0)
+    upper = coords.max(axis=0)
+    center = (lower + upper) / 2.0
+    size = np.maximum(upper - lower + 2.0 * padding, min_size)
+    if max_size:
+        size = np.minimum(size, max_size)
+
+    return {
+        'center': tuple(round(float(v), 3) for v in center),
+        'size': tuple(round(float(v), 3) for v in size)
+    }
+
+
+def receptor_box(pdbqt_file, padding=5.0, max_size=None):
+    """
+    Docking box covering the whole prepared receptor (blind docking).
+
+    Returns:
+        dict: {'center': (x, y, z), 'size': (sx, sy, sz)}
+    """
+    coords = pdbqt_io.read_coordinates(pdbqt_file, heavy_only=True)
+    return box_from_coordinates(coords, padding=padding, max_size=max_size)
+
+
+def _box_sum(grid, half_width):
+    """Sum of grid values in the cube of the given half width around every cell"""
+    k = half_width
+    padded = np.pad(grid.astype(np.int32), k + 1)
+    table = padded.cumsum(0).cumsum(1).cumsum(2)
+    n0, n1, n2 = grid.shape
+    hi = [slice(2 * k + 1, 2 * k + 1 + n) for n in (n0, n1, n2)]
+    lo = [slice(0, n) for n in (n0, n1, n2)]
+
+    def corner(a, b, c):
+        return table[(a[0], b[1], c[2])]
+
+    return (corner(hi, hi, hi) - corner(lo, hi, hi) - corner(hi, lo, hi)
+            - corner(hi, hi, lo) + corner(lo, lo, hi) + corner(lo, hi, lo)
+            + corner(hi, lo, lo) - corner(lo, lo, lo))
+
+
+def _enclosure(occupied):
+    """Number of axes (0-3) along which a cell has protein on both sides"""
+    count = np.zeros(occupied.shape, dtype=np.int8)
+    for axis in range(3):
+        before = np.maximum.accumulate(occupied, axis=axis)
+        after = np.flip(np.maximum.accumulate(np.flip(occupied, axis), axis=axis), axis)
+        count += (before & after).astype(np.int8)
+    return count
+
+
+def _label_components(mask):
+    """
+    Label 6-connected components of a boolean grid.
+
+    Labels are propagated as the minimum over neighbours until stable, which
+    keeps the work in NumPy instead of a per-voxel flood fill.
+    """
+    size = mask.size
+    labels = np.where(mask, np.arange(size).reshape(mask.shape), size)
+    while True:
+        current = labels
+        for axis in range(3):
+            for shift in (1, -1):
+                rolled = np.roll(current, shift, axis=axis)
+                edge = [slice(None)] * 3
+                edge[axis] = 0 if shift == 1 else -1
+                rolled[tuple(edge)] = size
+                current = np.minimum(current, rolled)
+        current = np.where(mask, current, size)
+        if np.array_equal(current, labels):
+            return labels
+        labels = current
+
+
+def detect_pockets(pdbqt_file, top_n=3, spacing=1.0, probe_radius=3.0,
+                   min_enclosure=2, min_buriedness=0.35, min_volume=20.0,
+                   padding=4.0):
+    """
+    Find candidate binding pockets on a prepared receptor.
+
+    The receptor is mapped onto a grid; empty cells that are enclosed by
+    protein along at least min_enclosure axes and whose neighbourhood is
+    sufficiently filled with protein are pocket cells. Connected pocket
+    cells are grouped and ranked by volume times buriedness.
+
+    Args:
+        pdbqt_file: Prepared receptor PDBQT
+        top_n: Number of pockets to return (default: 3)
+        spacing: Grid spacing in Angstrom (default: 1.0)
+        probe_radius: Distance from an atom centre counted as protein (default: 3.0)
+        min_enclosure: Axes along which a cell must be enclosed (default: 2)
+        min_buriedness: Minimum protein fraction within 8 Angstrom (default: 0.35)
+        min_volume: Smallest pocket kept, in cubic Angstrom (default: 20.0)
+        padding: Margin added around each pocket's box (default: 4.0)
+
+    Returns:
+        list: Pocket dicts with 'center', 'size', 'volume', 'buriedness' and
+              'score', best first
+    """
+    coords = pdbqt_io.read_coordinates(pdbqt_file, heavy_only=True)
+    if coords.size == 0:
+        return []
+
+    origin = coords.min(axis=0) - probe_radius - spacing
+    shape = np.ceil((coords.max(axis=0) + probe_radius + spacing - origin) / spacing).astype(int) + 1
+
+    # Mark every cell within probe_radius of an atom as protein
+    reach = int(np.ceil(probe_radius / spacing))
+    steps = np.arange(-reach, reach + 1)
+    stencil = np.stack(np.meshgrid(steps, steps, steps, indexing='ij'), -1).reshape(-1, 3)
+    stencil = stencil[(stencil ** 2).sum(axis=1) * spacing ** 2 <= probe_radius ** 2]
+
+    cells = np.rint((coords - origin) / spacing).astype(int)
+    occupied = np.zeros(shape, dtype=bool)
+    for offset in stencil:
+        idx = np.clip(cells + offset, 0, shape - 1)
+        occupied[idx[:, 0], idx[:, 1], idx[:, 2]] = True
+
+    half_width = max(1, int(round(8.0 / spacing)))
+    window = (2 * half_width + 1) ** 3
+    buriedness = _box_sum(occupied, half_width) / window
+
+    pocket_mask = (~occupied) & (_enclosure(occupied) >= min_enclosure) & (buriedness >= min_buriedness)
+    if not pocket_mask.any():
+        return []
+
+    labels = _label_components(pocket_mask)
+    flat_labels = labels[pocket_mask]
+    flat_points = np.argwhere(pocket_mask) * spacing + origin
+    flat_buried = buriedness[pocket_mask]
+
+    unique, inverse, counts = np.unique(flat_labels, return_inverse=True, return_counts=True)
+    mean_buried = np.bincount(inverse, weights=flat_buried) / counts
+    volumes = counts * spacing ** 3
+    scores = volumes * mean_buried
+
+    pockets = []
+    for i in np.argsort(-scores):
+        if volumes[i] < min_volume:
+            continue
+        points = flat_points[inverse == i]
+        box = box_from_coordinates(points, padding=padding)
+        pockets.append({
+            'center': box['center'],
+            'size': box['size'],
+            'volume': round(float(volumes[i]), 1),
+            'buriedness': round(float(mean_buried[i]), 3),
+            'score': round(float(scores[i]), 1)
+        })
+        if len(pockets) >= top_n:
+            break
+
+    return pockets
@@ -0,0 +1,53 @@
+import os
+import shutil
+
+from disk_cache import DiskCache, file_digest, make_key
+
+OUTPUT_FILE = 'out.pdbqt'
+
+
+class DockingCache(DiskCache):
+    """
+    Content-addressed cache of Smina docking outputs.
+
+    Entries are keyed by the receptor and ligand PDBQT contents plus every
+    search parameter that affects the result, so a hit can stand in for a
+    Smina run. With a fixed seed the cached output is exactly what a fresh
+    run would produce.
+    """
+
+    def docking_key(self, receptor, ligand, center, size, exhaustiveness,
+                    num_modes, seed=None):
+        return make_key(
+            'smina-docking',
+            file_digest(receptor),
+            file_digest(ligand),
+            [float(v) for v in center],
+            [float(v) for v in size],
+            int(exhaustiveness),
+            int(num_modes),
+            seed
+        )
+
+    def fetch(self, key, output_file):
+        """
+        Copy a cached docking output to output_file.
+
+        Returns:
+            list: Cached affinities on a hit, None on a miss
+        """
+        entry_dir, meta = self.get(key)
+        if entry_dir is None:
+            return None
+        try:
+            shutil.copyfile(os.path.join(entry_dir, OUTPUT_FILE), output_file)
+        except OSError:
+            return None
+        return meta.get('affinities', [])
+
+    def store(self, key, output_file, affinities):
+        """Save a successful docking output under key"""
+        if not affinities or not os.path.exists(output_file):
+            return None
+        return self.put(key, {OUTPUT_FILE: output_file},
+                        {'affinities': affinities})
@@ -0,0 +1,183 @@
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Responses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Requests per second sent to each host, within the services' usage policies
+DEFAULT_RATE_LIMITS = {
+    'rest.uniprot.org': 10,
+    'alphafold.ebi.ac.uk': 10,
+    'api.esmatlas.com': 2,
+    'pubchem.ncbi.nlm.nih.gov': 5
+}
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised instead of sending a request to a host that keeps failing"""
+
+
+class HostState:
+    """Rate limit and circuit breaker state of one remote host"""
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_slot = 0.0
+        self.failures = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    def wait_for_slot(self):
+        """Block until this host may receive another request"""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def is_open(self):
+        return time.monotonic() < self.open_until
+
+    def record(self, ok, threshold, reset_after):
+        with self._lock:
+            if ok:
+                self.failures = 0
+                self.open_until = 0.0
+            else:
+                self.failures += 1
+                if self.failures >= threshold:
+                    self.open_until = time.monotonic() + reset_after
+
+
+class HttpClient:
+    """
+    Pooled HTTP client shared by the structure and ligand lookups.
+
+    One requests.Session keeps connections to each host alive across calls
+    and threads. Every host gets a request rate limit, transient failures
+    (connection errors, 429 and 5xx responses) are retried with exponential
+    backoff, and a host that fails failure_threshold calls in a row is not
+    contacted again for reset_after seconds, so a batch upload fails fast
+    instead of waiting out every timeout against a service that is down.
+    """
+
+    def __init__(self, pool_size=16, retries=3, backoff=0.5, max_backoff=30.0,
+                 rate_limits=None, failure_threshold=5, reset_after=60.0):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limits = {**DEFAULT_RATE_LIMITS, **(rate_limits or {})}
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _host(self, host):
+        with self._lock:
+            state = self.hosts.get(host)
+            if state is None:
+                state = self.hosts[host] = HostState(self.rate_limits.get(host))
+            return state
+
+    def _delay(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        return min(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.0), self.max_backoff)
+
+    def request(self, method, url, retries=None, **kwargs):
+        """
+        Send a request with rate limiting, retries and the host's circuit breaker.
+
+        Args:
+            method: HTTP method
+            url: Request URL
+            retries: Retries for this call (default: the client's setting)
+            **kwargs: Passed to requests.Session.request (timeout, data, ...)
+
+        Returns:
+            requests.Response: The final response, which may still be an error status
+
+        Raises:
+            CircuitOpenError: If the host is failing and its cooldown has not passed
+            requests.RequestException: If the last attempt failed without a response
+        """
+        host = urlsplit(url).netloc
+        state = self._host(host)
+        if state.is_open():
+            raise CircuitOpenError(f"{host} is temporarily unavailable after repeated failures")
+
+        attempts = self.retries if retries is None else retries
+        for attempt in range(attempts + 1):
+            state.wait_for_slot()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.ConnectionError:
+                if attempt >= attempts:
+                    state.record(False, self.failure_threshold, self.reset_after)
+                    raise
+                delay = self._delay(attempt)
+            except requests.Timeout:
+                # A slow service stays slow; retrying would multiply the wait
+                state.record(False, self.failure_threshold, self.reset_after)
+                raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= attempts:
+                    state.record(response.status_code < 500, self.failure_threshold, self.reset_after)
+                    return response
+                delay = self._delay(attempt, response)
+                response.close()
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def configure(pool_size=16, retries=3, **kwargs):
+    """Set up the client used by get(), head() and post()"""
+    global _default
+    _default = HttpClient(pool_size=pool_size, retries=retries, **kwargs)
+    return _default
+
+
+def default_client():
+    """The configured client, created from the environment on first use"""
+    with _default_lock:
+        if _default is None:
+            configure(pool_size=int(os.environ.get('HTTP_POOL_SIZE', 16)),
+                      retries=int(os.environ.get('HTTP_RETRIES', 3)))
+        return _default
+
+
+def get(url, **kwargs):
+    return default_client().get(url, **kwargs)
+
+
+def head(url, **kwargs):
+    return default_client().head(url, **kwargs)
+
+
+def post(url, **kwargs):
+    return default_client().post(url, **kwargs)
@@ -0,0 +1,210 @@
+import functools
+import os
+
+import numpy as np
+
+import pdbqt_io
+
+CONTACT_CUTOFF = 4.0
+HBOND_CUTOFF = 3.5
+HYDROPHOBIC_CUTOFF = 4.0
+DONOR_H_DISTANCE = 1.2
+
+POLAR_TYPES = {'N', 'NA', 'NS', 'OA', 'OS', 'SA', 'O'}
+ACCEPTOR_TYPES = {'NA', 'NS', 'OA', 'OS', 'SA', 'O'}
+CARBON_TYPES = {'C', 'A'}
+
+# Packing of integer cell coordinates into one int64 key
+_KEY_BASE = 1 << 20
+_KEY_OFFSET = 1 << 19
+_NEIGHBOUR_OFFSETS = np.stack(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing='ij'), -1).reshape(-1, 3)
+
+
+def _cell_keys(cells):
+    cells = cells.astype(np.int64) + _KEY_OFFSET
+    return (cells[:, 0] * _KEY_BASE + cells[:, 1]) * _KEY_BASE + cells[:, 2]
+
+
+class GridHash:
+    """
+    Uniform grid over a point set for fixed-radius neighbour queries.
+
+    Points are bucketed into cubic cells no smaller than the query radius
+    and stored sorted by cell, so every cell is a contiguous slice. A query
+    looks up the 27 cells around each query point with searchsorted and
+    expands the slices with NumPy, with no per-point Python loop.
+    """
+
+    def __init__(self, coords, cell_size=4.5):
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+        self.cell_size = float(cell_size)
+        self.origin = self.coords.min(axis=0) if len(self.coords) else np.zeros(3)
+        keys = _cell_keys(np.floor((self.coords - self.origin) / self.cell_size))
+        self.order = np.argsort(keys, kind='stable')
+        self.keys, self.starts, self.counts = np.unique(keys[self.order], return_index=True, return_counts=True)
+
+    def pairs_within(self, points, radius):
+        """
+        All (point, indexed atom) pairs closer than radius.
+
+        Returns:
+            tuple: (point_indices, atom_indices, distances) as arrays
+        """
+        if radius > self.cell_size:
+            raise ValueError(f"Query radius {radius} exceeds grid cell size {self.cell_size}")
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        if not len(points) or not len(self.keys):
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0)
+
+        cells = np.floor((points - self.origin) / self.cell_size).astype(np.int64)
+        point_parts, atom_parts = [], []
+        for offset in _NEIGHBOUR_OFFSETS:
+            keys = _cell_keys(cells + offset)
+            pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+            hit = np.flatnonzero(self.keys[pos] == keys)
+            if not len(hit):
+                continue
+            starts = self.starts[pos[hit]]
+            counts = self.counts[pos[hit]]
+            # Expand each [start, start + count) slice into individual atom positions
+            within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            point_parts.append(np.repeat(hit, counts))
+            atom_parts.append(self.order[np.repeat(starts, counts) + within])
+
+        if not point_parts:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0)
+        point_idx = np.concatenate(point_parts)
+        atom_idx = np.concatenate(atom_parts)
+        dist = np.linalg.norm(points[point_idx] - self.coords[atom_idx], axis=1)
+        keep = dist <= radius
+        return point_idx[keep], atom_idx[keep], dist[keep]
+
+
+def _donor_flags(coords, types, h_coords):
+    """Polar atoms with a polar hydrogen bonded to them"""
+    donors = np.zeros(len(coords), dtype=bool)
+    if len(h_coords) and len(coords):
+        grid = GridHash(h_coords, cell_size=DONOR_H_DISTANCE)
+        point_idx, _, _ = grid.pairs_within(coords, DONOR_H_DISTANCE)
+        donors[point_idx] = True
+    polar = np.array([t in POLAR_TYPES for t in types], dtype=bool)
+    return donors & polar
+
+
+class ReceptorIndex:
+    """Heavy atoms of a prepared receptor with residue labels and H-bond roles"""
+
+    def __init__(self, pdbqt_file):
+        lines = list(pdbqt_io.iter_atom_lines(pdbqt_file))
+        heavy = [line for line in lines if pdbqt_io.atom_type(line) not in pdbqt_io.HYDROGEN_TYPES]
+        polar_h = [line for line in lines if pdbqt_io.atom_type(line) in ('HD', 'HS')]
+
+        self.coords = pdbqt_io.coordinates_from_lines(heavy)
+        self.types = [pdbqt_io.atom_type(line) for line in heavy]
+        self.atom_names = [line[12:16].strip() for line in heavy]
+
+        labels = [f"{line[21].strip() or '_'}:{line[17:20].strip()}{line[22:26].strip()}" for line in heavy]
+        # Residues numbered in file order, so fingerprints list them along the chain
+        self.residues = list(dict.fromkeys(labels))
+        lookup = {label: i for i, label in enumerate(self.residues)}
+        self.residue_ids = np.array([lookup[label] for label in labels], dtype=np.int64)
+
+        self.acceptor = np.array([t in ACCEPTOR_TYPES for t in self.types], dtype=bool)
+        self.donor = _donor_flags(self.coords, self.types, pdbqt_io.coordinates_from_lines(polar_h))
+        self.carbon = np.array([t in CARBON_TYPES for t in self.types], dtype=bool)
+        self.grid = GridHash(self.coords, cell_size=max(CONTACT_CUTOFF, HBOND_CUTOFF, HYDROPHOBIC_CUTOFF))
+
+
+@functools.lru_cache(maxsize=16)
+def _cached_index(path, mtime_ns):
+    return ReceptorIndex(path)
+
+
+def receptor_index(pdbqt_file):
+    """ReceptorIndex for a prepared receptor, built once per file version"""
+    return _cached_index(os.path.abspath(pdbqt_file), os.stat(pdbqt_file).st_mtime_ns)
+
+
+def ligand_poses(models):
+    """
+    Heavy-atom coordinates of every pose of one ligand, with its atom roles.
+
+    Args:
+        models: MODEL blocks (lists of PDBQT lines) of the same ligand
+
+    Returns:
+        tuple: ((n_poses, n_atoms, 3) coordinates, types, donor flags, atom names)
+    """
+    first = [line for line in models[0] if line.startswith(('ATOM', 'HETATM'))]
+    heavy_mask = np.array([pdbqt_io.atom_type(line) not in pdbqt_io.HYDROGEN_TYPES for line in first], dtype=bool)
+    polar_h_mask = np.array([pdbqt_io.atom_type(line) in ('HD', 'HS') for line in first], dtype=bool)
+    types = [pdbqt_io.atom_type(line) for line, heavy in zip(first, heavy_mask) if heavy]
+    names = [line[12:16].strip() for line, heavy in zip(first, heavy_mask) if heavy]
+
+    all_coords = np.stack([
+        pdbqt_io.coordinates_from_lines([line for line in lines if line.startswith(('ATOM', 'HETATM'))])
+        for lines in models
+    ])
+    # Bonding does not change between poses, so donors are found on the first one
+    donors = _donor_flags(all_coords[0][heavy_mask], types, all_coords[0][polar_h_mask])
+    return all_coords[:, heavy_mask], types, donors, names
+
+
+def analyse_poses(index, coords, types, donors, names=None):
+    """
+    Contacts, hydrogen-bond candidates and hydrophobic contacts of many poses.
+
+    All poses are queried against the receptor grid in one call and the
+    interactions are grouped per pose afterwards.
+
+    Args:
+        index: ReceptorIndex of the receptor the poses were docked into
+        coords: (n_poses, n_atoms, 3) ligand heavy-atom coordinates
+        types: AutoDock type of each ligand atom
+        donors: Boolean donor flag of each ligand atom
+        names: Ligand atom names used in the H-bond list (default: 1-based index)
+
+    Returns:
+        list: Per pose, a dict with 'contacts' (atom pairs within 4 A),
+              'residues' (residues in contact), 'hbonds' (candidate
+              donor/acceptor pairs) and 'fingerprint' ({residue: [kinds]})
+    """
+    coords = np.asarray(coords, dtype=float)
+    n_poses, n_atoms = coords.shape[:2]
+    lig_acceptor = np.array([t in ACCEPTOR_TYPES for t in types], dtype=bool)
+    lig_carbon = np.array([t in CARBON_TYPES for t in types], dtype=bool)
+    lig_donor = np.asarray(donors, dtype=bool)
+
+    point_idx, atom_idx, dist = index.grid.pairs_within(coords.reshape(-1, 3), CONTACT_CUTOFF)
+    pose = point_idx // max(n_atoms, 1)
+    lig_atom = point_idx % max(n_atoms, 1)
+    residue = index.residue_ids[atom_idx]
+
+    hbond = (dist <= HBOND_CUTOFF) & (
+        (lig_donor[lig_atom] & index.acceptor[atom_idx]) | (lig_acceptor[lig_atom] & index.donor[atom_idx]))
+    hydrophobic = (dist <= HYDROPHOBIC_CUTOFF) & lig_carbon[lig_atom] & index.carbon[atom_idx]
+
+    contact_counts = np.bincount(pose, minlength=n_poses)
+    n_res = max(len(index.residues), 1)
+    results = [{'contacts': int(contact_counts[p]), 'residues': [], 'hbonds': [], 'fingerprint': {}}
+               for p in range(n_poses)]
+
+    for kind, mask in (('contact', np.ones(len(pose), dtype=bool)), ('hydrophobic', hydrophobic), ('hbond', hbond)):
+        for key in np.unique(pose[mask] * n_res + residue[mask]):
+            p, r = divmod(int(key), n_res)
+            results[p]['fingerprint'].setdefault(index.residues[r], []).append(kind)
+
+    for i in np.flatnonzero(hbond):
+        results[pose[i]]['hbonds'].append({
+            'residue': index.residues[residue[i]],
+            'receptor_atom': index.atom_names[atom_idx[i]],
+            'ligand_atom': names[lig_atom[i]] if names else int(lig_atom[i]) + 1,
+            'distance': round(float(dist[i]), 2)
+        })
+
+    # Contacts were added first in (pose, residue) order, so residues follow the chain
+    for result in results:
+        result['residues'] = list(result['fingerprint'])
+    return results
@@ -0,0 +1,144 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+FINISHED_STATES = {DONE, FAILED, CANCELLED}
+
+
+class JobCancelled(Exception):
+    """Raised inside a job function when the job has been cancelled"""
+
+
+class Job:
+    """State and progress of one background job"""
+
+    def __init__(self, kind, owner=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.owner = owner
+        self.status = QUEUED
+        self.completed = 0
+        self.total = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    def check_cancelled(self):
+        """Raise JobCancelled if cancellation was requested"""
+        if self.cancelled:
+            raise JobCancelled(f"Job {self.id} was cancelled")
+
+    def set_total(self, total):
+        with self._lock:
+            self.total = total
+
+    def advance(self, count=1):
+        """Record that count more units of work have finished"""
+        with self._lock:
+            self.completed += count
+
+    def to_dict(self):
+        with self._lock:
+            progress = {'completed': self.completed, 'total': self.total}
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': progress,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+
+
+class JobQueue:
+    """
+    Run docking jobs on a background thread pool and keep their status.
+
+    Finished jobs are kept in memory so clients can fetch their results; once
+    more than max_finished have accumulated the oldest are forgotten.
+    """
+
+    def __init__(self, max_workers=2, max_finished=1000):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='docking-job')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_finished = max_finished
+
+    def submit(self, kind, func, *args, owner=None, **kwargs):
+        """
+        Enqueue func(job, *args, **kwargs) and return the new Job immediately.
+
+        The return value of func becomes job.result. Exceptions mark the job
+        failed with the exception message; JobCancelled marks it cancelled.
+        """
+        job = Job(kind, owner=owner)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        self._executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Request cancellation of a job.
+
+        Returns:
+            bool: True if the job exists and had not finished yet
+        """
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return False
+        job._cancel_event.set()
+        return True
+
+    def _run(self, job, func, args, kwargs):
+        if job.cancelled:
+            job.status = CANCELLED
+            job.finished_at = time.time()
+            return
+
+        job.status = RUNNING
+        job.started_at = time.time()
+        try:
+            job.result = func(job, *args, **kwargs)
+            job.status = CANCELLED if job.cancelled else DONE
+        except JobCancelled:
+            job.status = CANCELLED
+        except Exception as e:
+            print(f"Job {job.id} ({job.kind}) failed: {e}")
+            job.error = str(e)
+            job.status = FAILED
+        finally:
+            job.finished_at = time.time()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
@@ -0,0 +1,202 @@
+import os
+import re
+from collections import namedtuple
+
+import conversion_engine
+import ligand_prep
+import workspace
+
+SDF_EXTENSIONS = ('.sdf', '.sd', '.mol')
+MOL2_EXTENSIONS = ('.mol2',)
+SMILES_EXTENSIONS = ('.smi', '.smiles', '.ism', '.can', '.txt')
+LIBRARY_EXTENSIONS = SDF_EXTENSIONS + MOL2_EXTENSIONS + SMILES_EXTENSIONS
+
+# Folder of a workspace holding uploaded libraries, one subfolder of prepared ligands each
+LIBRARIES_DIR = 'libraries'
+
+# A preparation lock not refreshed for this long belongs to a preparation that died
+LOCK_STALE_SECONDS = 600
+
+LibraryRecord = namedtuple('LibraryRecord', ['index', 'name', 'kind', 'data'])
+
+
+def is_library_file(filename):
+    return os.path.splitext(filename)[1].lower() in LIBRARY_EXTENSIONS
+
+
+def iter_sdf(lines):
+    """Yield (title, record text) per molecule of an SDF stream"""
+    record = []
+    for line in lines:
+        if line.strip() == conversion_engine.SDF_DELIMITER:
+            if any(l.strip() for l in record):
+                yield record[0].strip(), ''.join(record) + conversion_engine.SDF_DELIMITER + '\n'
+            record = []
+        else:
+            record.append(line if line.endswith('\n') else line + '\n')
+    if any(l.strip() for l in record):
+        yield record[0].strip(), ''.join(record) + conversion_engine.SDF_DELIMITER + '\n'
+
+
+def iter_mol2(lines):
+    """Yield (name, record text) per molecule of a MOL2 stream"""
+    record = []
+    for line in lines:
+        if line.startswith(conversion_engine.MOL2_MOLECULE) and record:
+            yield record[1].strip() if len(record) > 1 else '', ''.join(record)
+            record = []
+        if record or line.startswith(conversion_engine.MOL2_MOLECULE):
+            record.append(line if line.endswith('\n') else line + '\n')
+    if record:
+        yield record[1].strip() if len(record) > 1 else '', ''.join(record)
+
+
+def iter_smiles(lines):
+    """Yield (name, smiles) per line of a SMILES file; the name is the optional second column"""
+    for line in lines:
+        parts = line.split(None, 1)
+        if not parts or parts[0].startswith('#'):
+            continue
+        yield (parts[1].strip() if len(parts) > 1 else ''), parts[0]
+
+
+def iter_records(path):
+    """
+    Stream the molecules of a library file one record at a time.
+
+    Only the current record is held in memory, so libraries of any size
+    can be read.
+
+    Yields:
+        LibraryRecord: (index, name, kind, data) where kind is 'sdf', 'mol2'
+                       or 'smiles' and data is the record text or SMILES
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in SDF_EXTENSIONS:
+        kind, reader = 'sdf', iter_sdf
+    elif ext in MOL2_EXTENSIONS:
+        kind, reader = 'mol2', iter_mol2
+    else:
+        kind, reader = 'smiles', iter_smiles
+
+    with open(path, 'r', errors='replace') as f:
+        for index, (name, data) in enumerate(reader(f)):
+            yield LibraryRecord(index, name or f'mol{index}', kind, data)
+
+
+def chunked(iterable, size):
+    """Yield lists of up to size consecutive items"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def ligand_file_name(library_id, record):
+    """File name a library record is prepared under; the library id keeps docking outputs of libraries apart"""
+    safe_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', record.name).strip('._')[:40] or 'mol'
+    return f'batch_lig_{library_id}_{record.index}_{safe_name}.pdbqt'
+
+
+def prepare_library(path, library_id, output_dir, work_dir, block_size=None):
+    """
+    Prepare every molecule of a library file for docking.
+
+    Records are read in blocks; each block is prepared through the
+    ligand_prep batch functions, which spread it over the conversion
+    engine's workers, so memory stays bounded by the block size.
+
+    Args:
+        path: SDF, MOL2 or SMILES library file
+        library_id: Prefix that keeps this library's ligand files apart
+        output_dir: Directory the prepared PDBQT files are written to
+        work_dir: Directory for intermediate files
+        block_size: Records per block (default: one batch per conversion worker)
+
+    Yields:
+        tuple: (record, pdbqt_path or None, error_message) in file order
+    """
+    if block_size is None:
+        engine = conversion_engine.default_engine()
+        block_size = engine.batch_size * engine.workers
+
+    for block in chunked(iter_records(path), max(1, block_size)):
+        outputs = [os.path.join(output_dir, ligand_file_name(library_id, record)) for record in block]
+        results = [None] * len(block)
+
+        smiles = [i for i, record in enumerate(block) if record.kind == 'smiles']
+        if smiles:
+            prepared = ligand_prep.prepare_ligands_from_smiles(
+                [(block[i].data, outputs[i]) for i in smiles], work_dir)
+            for i, (success, error, sdf_path) in zip(smiles, prepared):
+                results[i] = (success, error)
+                if sdf_path and os.path.exists(sdf_path):
+                    os.remove(sdf_path)
+
+        structures = [i for i, record in enumerate(block) if record.kind != 'smiles']
+        if structures:
+            inputs = []
+            for i in structures:
+                input_file = os.path.join(work_dir, f'record_{block[i].index}.{block[i].kind}')
+                with open(input_file, 'w') as f:
+                    f.write(block[i].data)
+                inputs.append(input_file)
+            prepared = ligand_prep.prepare_ligands_from_files(
+                [(input_file, outputs[i]) for i, input_file in zip(structures, inputs)], work_dir)
+            for i, input_file, result in zip(structures, inputs, prepared):
+                results[i] = result
+                os.remove(input_file)
+
+        for record, output, (success, error) in zip(block, outputs, results):
+            yield record, output if success else None, error
+
+
+def iter_listing(path):
+    """Ligand file names registered by a prepared library"""
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    yield line.strip()
+    except OSError:
+        return
+
+
+class BatchLigands:
+    """
+    Ligand files of a batch: named files followed by the prepared ligands of
+    uploaded libraries.
+
+    Library listings are read again on every pass rather than held in
+    memory, so a batch over a large library can be walked once per receptor.
+    """
+
+    def __init__(self, paths=(), libraries=()):
+        # libraries: (library_id, folder, listing_path) per library
+        self.paths = list(paths)
+        self.libraries = list(libraries)
+
+    def __iter__(self):
+        yield from self.paths
+        for _, folder, listing in self.libraries:
+            for name in iter_listing(listing):
+                yield os.path.join(folder, os.path.basename(name))
+
+    def __len__(self):
+        return len(self.paths) + sum(
+            sum(1 for _ in iter_listing(listing)) for _, _, listing in self.libraries)
+
+
+def claim(lock_path):
+    """
+    Take the preparation lock of a library.
+
+    Returns:
+        bool: False while another preparation holds the lock; a lock not
+              refreshed for LOCK_STALE_SECONDS is taken over
+    """
+    return workspace.claim_lock(lock_path, LOCK_STALE_SECONDS)
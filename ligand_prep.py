@@ -1,7 +1,13 @@
 import os
-import requests
-import subprocess
-import urllib.parse
+import conversion_engine
+import http_client
+import lookup_cache
+import batch_scheduler
+
+PUBCHEM_COMPOUND_URL = "https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound"
+
+# CIDs per property request; PUG REST accepts comma-separated CID lists
+PUBCHEM_CID_BATCH_SIZE = 200
 
 def fetch_smiles_from_pubchem(compound_name):
     """
@@ -13,26 +19,88 @@ def fetch_smiles_from_pubchem(compound_name):
     Returns:
         tuple: (smiles_string, compound_cid, error_message)
     """
-    encoded_name = urllib.parse.quote(compound_name)
-    url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/{encoded_name}/property/CanonicalSMILES/TXT"
+    found, error = lookup_cache.lookup('pubchem', [compound_name.strip().lower()],
+                                       lambda: _fetch_smiles_from_pubchem(compound_name))
+    if error:
+        return None, None, error
+    return found[0], found[1], None
+
+def _pubchem_properties(response):
+    """{cid: smiles} from a PUG REST property table response"""
+    rows = response.json().get('PropertyTable', {}).get('Properties', [])
+    # PubChem has been renaming its SMILES properties; accept any of the names
+    return {str(row['CID']): row.get('CanonicalSMILES') or row.get('ConnectivitySMILES') or row.get('SMILES')
+            for row in rows if 'CID' in row}
+
+def _fetch_smiles_from_pubchem(compound_name):
+    # One request returns both the CID and the SMILES; the name goes in the
+    # body so names containing slashes survive
+    url = f"{PUBCHEM_COMPOUND_URL}/name/property/CanonicalSMILES/JSON"
     
     try:
-        response = requests.get(url, timeout=10)
+        response = http_client.post(url, data={'name': compound_name}, timeout=10)
         
         if response.status_code == 200:
-            smiles = response.text.strip()
-            
-            cid_url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/{encoded_name}/cids/TXT"
-            cid_response = requests.get(cid_url, timeout=10)
-            cid = cid_response.text.strip() if cid_response.status_code == 200 else "unknown"
-            
-            return smiles, cid, None
+            for cid, smiles in _pubchem_properties(response).items():
+                if smiles:
+                    return [smiles, cid], None
+            return None, f"Compound '{compound_name}' has no SMILES in chemical database"
         elif response.status_code == 404:
-            return None, None, f"Compound '{compound_name}' not found in chemical database"
+            return None, f"Compound '{compound_name}' not found in chemical database"
         else:
-            return None, None, f"Chemical database error: HTTP {response.status_code}"
+            return None, f"Chemical database error: HTTP {response.status_code}"
     except Exception as e:
-        return None, None, f"Failed to fetch compound data: {str(e)}"
+        return None, f"Failed to fetch compound data: {str(e)}"
+
+def _fetch_cids_from_pubchem(cids):
+    """SMILES for many CIDs in one request; {} if the request fails"""
+    url = f"{PUBCHEM_COMPOUND_URL}/cid/property/CanonicalSMILES/JSON"
+    try:
+        response = http_client.post(url, data={'cid': ','.join(cids)}, timeout=30)
+        if response.status_code == 200:
+            return _pubchem_properties(response)
+    except Exception as e:
+        print(f"PubChem bulk CID lookup failed: {str(e)}")
+    return {}
+
+def fetch_smiles_from_pubchem_bulk(compound_names, workers=8):
+    """
+    Fetch SMILES for many compounds with as few PubChem requests as possible.
+    
+    Cached answers are used first and duplicate names are looked up once.
+    Numeric entries are treated as CIDs and resolved PUBCHEM_CID_BATCH_SIZE
+    per request. PUG REST only takes one name per request, so names (and
+    CIDs a bulk request did not answer) are looked up individually, up to
+    workers at a time within the client's PubChem rate limit.
+    
+    Args:
+        compound_names: Compound names or CIDs
+        workers: Maximum concurrent per-name lookups
+    
+    Returns:
+        list: (smiles_string, compound_cid, error_message) per name, in order
+    """
+    keys = [name.strip().lower() for name in compound_names]
+    results = {}
+    for key in dict.fromkeys(keys):
+        found = lookup_cache.peek('pubchem', [key])
+        if found:
+            results[key] = (found[0], found[1], None)
+    
+    cids = [key for key in dict.fromkeys(keys) if key not in results and key.isdigit()]
+    if not lookup_cache.is_offline():
+        for start in range(0, len(cids), PUBCHEM_CID_BATCH_SIZE):
+            found = _fetch_cids_from_pubchem(cids[start:start + PUBCHEM_CID_BATCH_SIZE])
+            for cid, smiles in found.items():
+                if smiles and cid not in results:
+                    lookup_cache.store('pubchem', [cid], [smiles, cid])
+                    results[cid] = (smiles, cid, None)
+    
+    remaining = [key for key in dict.fromkeys(keys) if key not in results]
+    for key, found in zip(remaining, batch_scheduler.imap_ordered(fetch_smiles_from_pubchem, remaining, workers)):
+        results[key] = found
+    
+    return [results[key] for key in keys]
 
 def smiles_to_3d_sdf(smiles, output_sdf):
     """
@@ -45,23 +113,10 @@ def smiles_to_3d_sdf(smiles, output_sdf):
     Returns:
         tuple: (success, error_message)
     """
-    try:
-        cmd = ['obabel', f'-:{smiles}', '-O', output_sdf, '--gen3d', '-h']
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-        
-        if result.returncode != 0:
-            error_msg = result.stderr if result.stderr else result.stdout
-            return False, f"3D structure generation failed: {error_msg}"
-        
-        if not os.path.exists(output_sdf) or os.path.getsize(output_sdf) == 0:
-            return False, "3D structure generation produced empty file"
-        
-        return True, None
-    
-    except subprocess.TimeoutExpired:
-        return False, "3D structure generation timed out"
-    except Exception as e:
-        return False, f"Error generating 3D structure: {str(e)}"
+    error = conversion_engine.default_engine().smiles_to_sdf([(smiles, output_sdf)])[0]
+    if error:
+        return False, error
+    return True, None
 
 def convert_to_pdbqt(input_file, output_pdbqt, is_protein=False):
     """
@@ -75,29 +130,12 @@ def convert_to_pdbqt(input_file, output_pdbqt, is_protein=False):
     Returns:
         tuple: (success, error_message)
     """
-    try:
-        if is_protein:
-            cmd = ['obabel', input_file, '-O', output_pdbqt, '-xr']
-        else:
-            cmd = ['obabel', input_file, '-O', output_pdbqt, '-p', '7.4']
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-        
-        if result.returncode != 0:
-            error_msg = result.stderr if result.stderr else result.stdout
-            return False, f"PDBQT conversion failed: {error_msg}"
-        
-        if not os.path.exists(output_pdbqt) or os.path.getsize(output_pdbqt) == 0:
-            return False, "PDBQT conversion produced empty file"
-        
-        return True, None
-    
-    except subprocess.TimeoutExpired:
-        return False, "PDBQT conversion timed out"
-    except Exception as e:
-        return False, f"Error converting to PDBQT: {str(e)}"
+    error = conversion_engine.default_engine().to_pdbqt([(input_file, output_pdbqt)], rigid=is_protein)[0]
+    if error:
+        return False, error
+    return True, None
 
-def prepare_ligand_from_name(compound_name, output_pdbqt):
+def prepare_ligand_from_name(compound_name, output_pdbqt, work_dir=None):
     """
     Complete ligand preparation pipeline from compound name:
     1. Fetch SMILES from PubChem
@@ -107,6 +145,7 @@ def prepare_ligand_from_name(compound_name, output_pdbqt):
     Args:
         compound_name: Name of the compound
         output_pdbqt: Path to output PDBQT file
+        work_dir: Directory for the intermediate SDF (default: next to output_pdbqt)
     
     Returns:
         tuple: (success, error_message, smiles, cid, sdf_path)
@@ -116,7 +155,7 @@ def prepare_ligand_from_name(compound_name, output_pdbqt):
         if error:
             return False, error, None, None, None
         
-        base_dir = os.path.dirname(output_pdbqt)
+        base_dir = work_dir or os.path.dirname(output_pdbqt)
         sdf_path = os.path.join(base_dir, f'ligand_{cid}.sdf')
         
         success, error = smiles_to_3d_sdf(smiles, sdf_path)
@@ -132,6 +171,46 @@ def prepare_ligand_from_name(compound_name, output_pdbqt):
     except Exception as e:
         return False, f"Ligand preparation error: {str(e)}", None, None, None
 
+def prepare_ligands_from_smiles(items, work_dir):
+    """
+    Prepare many ligands from SMILES in batches.
+    
+    3D generation and PDBQT conversion each run over the whole list on the
+    conversion engine, instead of two OpenBabel runs per ligand.
+    
+    Args:
+        items: List of (smiles, output_pdbqt)
+        work_dir: Directory for the intermediate SDF files
+    
+    Returns:
+        list: (success, error_message, sdf_path) per item
+    """
+    engine = conversion_engine.default_engine()
+    sdf_paths = [os.path.join(work_dir, f'ligand_{i}.sdf') for i in range(len(items))]
+    errors = engine.smiles_to_sdf([(smiles, sdf) for (smiles, _), sdf in zip(items, sdf_paths)], work_dir)
+    
+    built = [i for i, error in enumerate(errors) if error is None]
+    pdbqt_errors = engine.to_pdbqt([(sdf_paths[i], items[i][1]) for i in built], work_dir)
+    for i, error in zip(built, pdbqt_errors):
+        errors[i] = error
+    
+    return [(error is None, error, sdf if i in built else None)
+            for i, (error, sdf) in enumerate(zip(errors, sdf_paths))]
+
+def prepare_ligands_from_files(items, work_dir):
+    """
+    Convert many single-molecule ligand files to PDBQT in batches.
+    
+    Args:
+        items: List of (input_file, output_pdbqt)
+        work_dir: Directory for batch files
+    
+    Returns:
+        list: (success, error_message) per item
+    """
+    errors = conversion_engine.default_engine().to_pdbqt(items, work_dir)
+    return [(error is None, error) for error in errors]
+
 def prepare_ligand_from_file(input_file, output_pdbqt):
     """
     Prepare ligand from uploaded file by converting to PDBQT.
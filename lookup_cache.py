@@ -0,0 +1,132 @@
+import json
+import os
+import time
+
+from disk_cache import DiskCache, make_key
+
+DAY = 24 * 3600
+
+# How long a remote answer stays valid, per source
+DEFAULT_TTLS = {
+    'uniprot_fasta': 30 * DAY,
+    'uniprot_search': 7 * DAY,
+    'alphafold': 30 * DAY,
+    'esmfold': 365 * DAY,
+    'pubchem': 30 * DAY
+}
+
+
+class LookupCache(DiskCache):
+    """
+    Disk cache of remote database lookups shared by the preparation modules.
+
+    Entries are keyed by source and stable request parts (accession,
+    sequence hash, compound name), expire after the source's TTL and are
+    evicted least recently used first. In offline mode no request is made:
+    cached answers are served even when expired and misses fail.
+    """
+
+    def __init__(self, root, max_bytes=512 * 1024 * 1024, ttls=None, offline=False):
+        super().__init__(root, max_bytes=max_bytes)
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self.offline = offline
+
+    def _read(self, entry_dir, meta):
+        if meta.get('kind') == 'bytes':
+            with open(os.path.join(entry_dir, 'value.bin'), 'rb') as f:
+                return f.read()
+        with open(os.path.join(entry_dir, 'value.json'), 'r') as f:
+            return json.load(f)
+
+    def lookup(self, source, key_parts, fetch):
+        """
+        Answer a lookup from the cache, calling fetch() on a miss.
+
+        Args:
+            source: Name of the remote source, selects the TTL
+            key_parts: Values identifying the request
+            fetch: Callable returning (value, error_message); value is bytes
+                   or JSON-serialisable and is only stored when error is None
+
+        Returns:
+            tuple: (value, error_message)
+        """
+        value = self.peek(source, key_parts)
+        if value is not None:
+            return value, None
+
+        if self.offline:
+            return None, f"Offline mode: no cached {source} result for {', '.join(map(str, key_parts))}"
+
+        value, error = fetch()
+        if error is None and value is not None:
+            self.store(source, key_parts, value)
+        return value, error
+
+    def peek(self, source, key_parts):
+        """Cached value for a lookup, or None on a miss; never fetches"""
+        key = make_key('lookup', source, *key_parts)
+        entry_dir, meta = self.get(key)
+        if meta is None:
+            return None
+        fresh = time.time() - meta.get('stored_at', 0) <= self.ttls.get(source, DAY)
+        if fresh or self.offline:
+            try:
+                return self._read(entry_dir, meta)
+            except (OSError, ValueError):
+                pass
+        self.delete(key)
+        return None
+
+    def store(self, source, key_parts, value):
+        """Save a value fetched outside lookup(), e.g. one answer of a bulk request"""
+        key = make_key('lookup', source, *key_parts)
+        if isinstance(value, bytes):
+            self.put(key, {'value.bin': value}, {'source': source, 'kind': 'bytes'})
+        else:
+            self.put(key, {'value.json': json.dumps(value).encode('utf-8')}, {'source': source, 'kind': 'json'})
+
+
+_default = None
+
+
+def configure(root, max_bytes, offline=False, ttls=None):
+    """Set up the cache used by lookup()"""
+    global _default
+    _default = LookupCache(root, max_bytes=max_bytes, ttls=ttls, offline=offline) if max_bytes > 0 else None
+    return _default
+
+
+def default_cache():
+    """The configured cache, created from the environment on first use"""
+    if _default is None and os.environ.get('LOOKUP_CACHE_MAX_MB', '512') != '0':
+        configure(os.environ.get('LOOKUP_CACHE_DIR', 'data/cache/lookups'),
+                  int(os.environ.get('LOOKUP_CACHE_MAX_MB', 512)) * 1024 * 1024,
+                  offline=os.environ.get('LOOKUP_OFFLINE', '0') == '1')
+    return _default
+
+
+def lookup(source, key_parts, fetch):
+    """Cached lookup through the default cache; calls fetch() directly when caching is off"""
+    cache = default_cache()
+    if cache is None:
+        return fetch()
+    return cache.lookup(source, key_parts, fetch)
+
+
+def peek(source, key_parts):
+    """Cached value from the default cache, or None"""
+    cache = default_cache()
+    return cache.peek(source, key_parts) if cache is not None else None
+
+
+def store(source, key_parts, value):
+    """Save a value in the default cache, if caching is on"""
+    cache = default_cache()
+    if cache is not None:
+        cache.store(source, key_parts, value)
+
+
+def is_offline():
+    cache = default_cache()
+    return cache is not None and cache.offline
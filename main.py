@@ -1,29 +1,116 @@
 import os
+import posixpath
 import subprocess
 import re
 import platform
-from flask import Flask, request, jsonify, send_from_directory, redirect, url_for, session
+from flask import Flask, Response, request, jsonify, send_file, send_from_directory, redirect, url_for, session
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
+from werkzeug.utils import secure_filename, safe_join
 from werkzeug.security import generate_password_hash, check_password_hash
 import shutil
 import json
+import gzip
+import mimetypes
+import time
+import functools
+import itertools
+import uuid
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import protein_prep
 import ligand_prep
 import verify_structures
+import batch_scheduler
+import job_queue
+from docking_cache import DockingCache
+from receptor_cache import ReceptorCache
+from disk_cache import file_digest, make_key
+import batch_manifest
+import cost_model
+import docking_box
+import pdbqt_io
+import conversion_engine
+import complex_store
+import receptor_trim
+import pose_clustering
+import interactions
+import workspace
+import ligand_library
+import lookup_cache
+import http_client
+import task_broker
 
 app = Flask(__name__, static_folder='static')
 CORS(app)
 app.secret_key = os.environ.get('SESSION_SECRET', 'arqgene-docking-secret-2026')
-app.config['UPLOAD_FOLDER'] = 'data'
-app.config['POSES_FOLDER'] = 'data/poses'
+app.config['UPLOAD_FOLDER'] = os.environ.get('DATA_DIR', 'data')
+app.config['POSES_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'poses')
+app.config['CACHE_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'cache')
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024
 app.config['DATABASE_URL'] = os.environ.get('DATABASE_URL')
+app.config['BATCH_MAX_JOBS'] = int(os.environ.get('BATCH_MAX_JOBS', 0)) or None
+app.config['BATCH_CPU_PER_JOB'] = int(os.environ.get('BATCH_CPU_PER_JOB', 0)) or None
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['DOCKING_SEED'] = int(os.environ['DOCKING_SEED']) if os.environ.get('DOCKING_SEED') else None
+app.config['DOCKING_CACHE_DIR'] = os.environ.get('DOCKING_CACHE_DIR', os.path.join(app.config['CACHE_FOLDER'], 'docking'))
+app.config['DOCKING_CACHE_MAX_MB'] = int(os.environ.get('DOCKING_CACHE_MAX_MB', 2048))
+app.config['RECEPTOR_CACHE_DIR'] = os.environ.get('RECEPTOR_CACHE_DIR', os.path.join(app.config['CACHE_FOLDER'], 'receptors'))
+app.config['RECEPTOR_CACHE_MAX_MB'] = int(os.environ.get('RECEPTOR_CACHE_MAX_MB', 1024))
+app.config['RECEPTOR_TRIM_MARGIN'] = float(os.environ.get('RECEPTOR_TRIM_MARGIN', 0))
+app.config['LOOKUP_CACHE_DIR'] = os.environ.get('LOOKUP_CACHE_DIR', os.path.join(app.config['CACHE_FOLDER'], 'lookups'))
+app.config['LOOKUP_CACHE_MAX_MB'] = int(os.environ.get('LOOKUP_CACHE_MAX_MB', 512))
+app.config['LOOKUP_OFFLINE'] = os.environ.get('LOOKUP_OFFLINE', '0') == '1'
+app.config['HTTP_POOL_SIZE'] = int(os.environ.get('HTTP_POOL_SIZE', 16))
+app.config['HTTP_RETRIES'] = int(os.environ.get('HTTP_RETRIES', 3))
+app.config['FETCH_WORKERS'] = int(os.environ.get('FETCH_WORKERS', 8))
+app.config['WORKSPACE_TTL_HOURS'] = float(os.environ.get('WORKSPACE_TTL_HOURS', 72))
+app.config['DOCKING_BROKER'] = os.environ.get('DOCKING_BROKER')
+app.config['COMPLEX_CACHE_ENTRIES'] = int(os.environ.get('COMPLEX_CACHE_ENTRIES', 32))
+app.config['POSE_RMSD_THRESHOLD'] = float(os.environ.get('POSE_RMSD_THRESHOLD', 0))
+app.config['INTERACTIONS'] = os.environ.get('INTERACTIONS', '1') != '0'
+app.config['COST_MODEL_FILE'] = os.environ.get('COST_MODEL_FILE', os.path.join(app.config['CACHE_FOLDER'], 'cost_model.json'))
+app.config['BROKER_POLL_SECONDS'] = float(os.environ.get('BROKER_POLL_SECONDS', 2))
+app.config['BROKER_STALL_SECONDS'] = float(os.environ.get('BROKER_STALL_SECONDS', 900))
 
 ALLOWED_EXTENSIONS = {'pdb', 'pdbqt', 'sdf', 'mol', 'mol2'}
 
+DEFAULT_BOX_CENTER = (0, 0, 0)
+DEFAULT_BOX_SIZE = (30, 30, 30)
+
+# Streamed batches sort this many items per worker at a time instead of the whole batch
+STREAM_SCHEDULE_WINDOW = 4
+
+# How often a batch that is already running elsewhere is checked for having finished
+BATCH_LOCK_POLL_SECONDS = 5
+
+jobs = job_queue.JobQueue(max_workers=app.config['JOB_WORKERS'])
+docking_cache = None
+if app.config['DOCKING_CACHE_MAX_MB'] > 0:
+    docking_cache = DockingCache(app.config['DOCKING_CACHE_DIR'],
+                                 max_bytes=app.config['DOCKING_CACHE_MAX_MB'] * 1024 * 1024)
+receptor_cache = None
+if app.config['RECEPTOR_CACHE_MAX_MB'] > 0:
+    receptor_cache = ReceptorCache(app.config['RECEPTOR_CACHE_DIR'],
+                                   max_bytes=app.config['RECEPTOR_CACHE_MAX_MB'] * 1024 * 1024)
+# Shared by the UniProt, AlphaFold, ESMFold and PubChem lookups in protein_prep/ligand_prep
+lookups = lookup_cache.configure(app.config['LOOKUP_CACHE_DIR'], app.config['LOOKUP_CACHE_MAX_MB'] * 1024 * 1024,
+                                 offline=app.config['LOOKUP_OFFLINE'])
+http_client.configure(pool_size=app.config['HTTP_POOL_SIZE'], retries=app.config['HTTP_RETRIES'])
+complex_cache = complex_store.ComplexCache(max_entries=app.config['COMPLEX_CACHE_ENTRIES'])
+runtime_model = cost_model.CostModel(app.config['COST_MODEL_FILE'])
+
+def check_broker_path(path):
+    """Refuse a broker database inside the data folder, whose files are served over HTTP"""
+    data_dir = os.path.realpath(app.config['UPLOAD_FOLDER'])
+    if os.path.commonpath([data_dir, os.path.realpath(path)]) == data_dir:
+        raise RuntimeError(f"Task broker database {path} is inside the data folder {data_dir}; "
+                           "put it on shared storage outside the data folder")
+    return path
+
+broker = None
+if app.config['DOCKING_BROKER']:
+    broker = task_broker.TaskBroker(check_broker_path(app.config['DOCKING_BROKER']))
+
 def get_db_connection():
     conn = psycopg2.connect(app.config['DATABASE_URL'])
     return conn
@@ -38,52 +125,98 @@ def get_smina_command():
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def build_smina_command(receptor, ligand, output_file, center=(0, 0, 0), size=(30, 30, 30),
+                        exhaustiveness=8, num_modes=9, cpu=None, seed=None, verbosity=1):
+    """Build the Smina command line for one receptor and one or more ligand files"""
+    cmd = [get_smina_command(), '--receptor', receptor]
+    for lig in ([ligand] if isinstance(ligand, str) else ligand):
+        cmd.extend(['--ligand', lig])
+    cmd.extend(['--num_modes', str(num_modes), '--exhaustiveness', str(exhaustiveness)])
+    for axis, value in zip('xyz', center):
+        cmd.extend([f'--center_{axis}', str(value)])
+    for axis, value in zip('xyz', size):
+        cmd.extend([f'--size_{axis}', str(value)])
+    if cpu:
+        cmd.extend(['--cpu', str(cpu)])
+    if seed is not None:
+        cmd.extend(['--seed', str(seed)])
+    cmd.extend(['--out', output_file, '--verbosity', str(verbosity)])
+    return cmd
+
+@functools.lru_cache(maxsize=256)
+def _cached_receptor_box(receptor, mtime_ns, box_mode, pocket_index):
+    if box_mode == 'pocket':
+        pockets = docking_box.detect_pockets(receptor, top_n=pocket_index + 1)
+        if len(pockets) > pocket_index:
+            return pockets[pocket_index]['center'], pockets[pocket_index]['size']
+        print(f"No pocket #{pocket_index + 1} found in {receptor}, using the whole receptor")
+    box = docking_box.receptor_box(receptor)
+    return box['center'], box['size']
+
+def compute_docking_box(receptor, box_mode='auto', pocket_index=0):
+    """
+    Docking box derived from the receptor geometry.
+    
+    'auto' encloses the whole receptor, 'pocket' uses the pocket_index-th
+    detected cavity and 'fixed' keeps the legacy 30 A box at the origin.
+    
+    Returns:
+        tuple: (center, size)
+    """
+    if box_mode == 'fixed':
+        return DEFAULT_BOX_CENTER, DEFAULT_BOX_SIZE
+    mtime_ns = os.stat(receptor).st_mtime_ns
+    return _cached_receptor_box(os.path.abspath(receptor), mtime_ns, box_mode, int(pocket_index))
+
+def run_smina(cmd, timeout=300, job=None):
+    """
+    Run a Smina command, killing it if it times out or the job is cancelled.
+    
+    Returns:
+        subprocess.CompletedProcess with captured stdout/stderr
+    """
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            stdout, stderr = proc.communicate(timeout=0.5)
+            return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+        except subprocess.TimeoutExpired:
+            if job is not None and job.cancelled:
+                proc.kill()
+                proc.communicate()
+                raise job_queue.JobCancelled(f"Job {job.id} was cancelled")
+            if time.monotonic() > deadline:
+                proc.kill()
+                proc.communicate()
+                raise subprocess.TimeoutExpired(cmd, timeout)
+
 def convert_to_pdbqt(input_file, output_file, is_protein=False):
     """Convert any molecular format to PDBQT using OpenBabel"""
-    try:
-        if is_protein:
-            cmd = ['obabel', input_file, '-O', output_file, '-xr']
-        else:
-            cmd = ['obabel', input_file, '-O', output_file, '-p', '7.4']
-        
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            error_msg = result.stderr if result.stderr else result.stdout
-            print(f"OpenBabel conversion failed for {input_file}: {error_msg}")
-            raise Exception(f"Conversion failed: {error_msg}")
-        
-        if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
-            print(f"OpenBabel produced empty or missing output file: {output_file}")
-            raise Exception("Conversion produced empty file - please check input format")
-        
-        return True
-    except subprocess.SubprocessError as e:
-        print(f"Subprocess error during conversion: {e}")
-        raise Exception(f"Conversion tool error: {str(e)}")
-    except Exception as e:
-        print(f"Conversion error: {e}")
-        raise
+    error = conversion_engine.default_engine().to_pdbqt([(input_file, output_file)], rigid=is_protein)[0]
+    if error:
+        print(f"OpenBabel conversion failed for {input_file}: {error}")
+        raise Exception(f"Conversion failed: {error}")
+    return True
 
 def convert_pdbqt_to_pdb(input_file, output_file):
-    """Convert PDBQT to PDB for visualization"""
+    """
+    Convert PDBQT to PDB for visualization.
+    
+    The conversion is done in-process; OpenBabel is only started if that fails.
+    """
     try:
-        cmd = ['obabel', input_file, '-O', output_file]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            error_msg = result.stderr if result.stderr else result.stdout
-            print(f"OpenBabel PDB conversion failed: {error_msg}")
-            return False
-        
-        if not os.path.exists(output_file):
-            print(f"OpenBabel produced missing output file: {output_file}")
-            return False
-        
-        return True
+        if pdbqt_io.write_pdb(input_file, output_file) > 0:
+            return True
+        print(f"No atoms written for {input_file}, falling back to OpenBabel")
     except Exception as e:
-        print(f"PDB conversion error: {e}")
+        print(f"In-process PDB conversion failed for {input_file}: {e}")
+    
+    error = conversion_engine.default_engine().to_pdb(input_file, output_file)
+    if error:
+        print(f"OpenBabel PDB conversion failed: {error}")
         return False
+    return True
 
 def parse_vina_results(output_file):
     affinities = []
@@ -101,59 +234,44 @@ def parse_vina_results(output_file):
         print(f"Error parsing results: {e}")
         return []
 
-def split_poses(multi_pose_file, output_dir):
-    """Split multi-pose PDBQT file into individual pose files"""
-    poses = []
-    current_pose = []
-    pose_num = 1
+def split_molecules(multi_ligand_file, output_files):
+    """
+    Split a multi-ligand Smina output into one multi-pose file per ligand.
+    
+    Smina writes the poses of each input ligand as consecutive MODEL blocks
+    and restarts the model numbering at 1 for every new ligand.
+    
+    Returns:
+        int: Number of ligand blocks found (only the first len(output_files) are written)
+    """
+    molecules = []
+    last_model = None
     
     try:
-        with open(multi_pose_file, 'r') as f:
+        with open(multi_ligand_file, 'r') as f:
             for line in f:
                 if line.startswith('MODEL'):
-                    current_pose = [line]
-                elif line.startswith('ENDMDL'):
-                    current_pose.append(line)
-                    pose_file = os.path.join(output_dir, f'pose_{pose_num}.pdbqt')
-                    with open(pose_file, 'w') as pf:
-                        pf.writelines(current_pose)
-                    poses.append(pose_file)
-                    pose_num += 1
-                    current_pose = []
-                elif current_pose:
-                    current_pose.append(line)
+                    parts = line.split()
+                    model = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+                    if not molecules or (model is not None and last_model is not None and model <= last_model):
+                        molecules.append([])
+                    last_model = model
+                if molecules:
+                    molecules[-1].append(line)
     except Exception as e:
-        print(f"Error splitting poses: {e}")
+        print(f"Error splitting molecules: {e}")
+        return 0
     
-    return poses
-
-def combine_protein_ligand(protein_file, ligand_file, output_file):
-    """Combine protein and ligand PDBQT files into a single file for visualization"""
-    try:
+    for lines, output_file in zip(molecules, output_files):
         with open(output_file, 'w') as out:
-            with open(protein_file, 'r') as prot:
-                for line in prot:
-                    if not line.startswith('END'):
-                        out.write(line)
-            
-            out.write('TER\n')
-            
-            with open(ligand_file, 'r') as lig:
-                for line in lig:
-                    if not line.startswith(('MODEL', 'ENDMDL', 'END')):
-                        out.write(line)
-            
-            out.write('END\n')
-        
-        return True
-    except Exception as e:
-        print(f"Error combining protein and ligand: {e}")
-        return False
+            out.writelines(lines)
+    
+    return len(molecules)
 
 @app.before_request
 def check_auth():
     # List of endpoints that don't require authentication
-    public_endpoints = ['login', 'login_page', 'signup', 'logout', 'static', 'serve_pose', 'serve_data']
+    public_endpoints = ['login', 'login_page', 'signup', 'logout', 'static', 'serve_pose']
     
     # Check if the current endpoint is public or if user is logged in
     if request.endpoint and request.endpoint not in public_endpoints:
@@ -161,8 +279,8 @@ def check_auth():
             # List of all API/Action endpoints that should return 401
             api_endpoints = [
                 '/api/', '/prepare_protein', '/prepare_ligand', '/dock', 
-                '/get_results', '/upload_batch', '/get_fasta', '/predict_structure',
-                '/dock_batch'
+                '/get_results', '/upload_batch', '/upload_library', '/get_fasta', '/predict_structure',
+                '/dock_batch', '/jobs/', '/cache/', '/detect_pockets', '/data/'
             ]
             is_api = any(request.path.startswith(p) for p in api_endpoints) or request.path in api_endpoints
             
@@ -232,16 +350,147 @@ def login():
 @app.route('/api/auth/logout')
 def logout():
     session.pop('user_id', None)
+    session.pop('workspace', None)
     return redirect(url_for('login_page'))
 
+def get_workspace():
+    """Workspace directory of the current session, created on first use"""
+    if 'workspace' not in session:
+        session['workspace'] = workspace.new_workspace_id()
+        workspace.cleanup_stale_workspaces(app.config['UPLOAD_FOLDER'], app.config['WORKSPACE_TTL_HOURS'] * 3600)
+    path = workspace.session_workspace(app.config['UPLOAD_FOLDER'], session['workspace'])
+    os.utime(path)
+    return path
+
+def workspace_task(ws, func):
+    """func wrapped so the workspace is not cleaned up while it runs"""
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        with workspace.in_use(ws):
+            return func(*args, **kwargs)
+    return run
+
+def data_url_path(path):
+    """URL path under /data/ for a file inside the data folder"""
+    return 'data/' + os.path.relpath(path, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+
+def plddt_cutoff_from(form):
+    """pLDDT cutoff requested in a form, or None to keep every residue; raises ValueError unless it is in 0-100"""
+    value = form.get('plddt_cutoff', '').strip()
+    if not value:
+        return None
+    try:
+        cutoff = float(value)
+    except ValueError:
+        raise ValueError('plddt_cutoff must be a number')
+    if not 0 <= cutoff <= 100:
+        raise ValueError('plddt_cutoff must be between 0 and 100')
+    return cutoff
+
+def trim_margin_from(data):
+    """Receptor trim margin requested in a JSON body; raises ValueError unless it is a number >= 0"""
+    try:
+        margin = float(data.get('trim_margin', app.config['RECEPTOR_TRIM_MARGIN']))
+    except (TypeError, ValueError):
+        raise ValueError('trim_margin must be a number')
+    if not margin >= 0:
+        raise ValueError('trim_margin must not be negative')
+    return margin
+
+def rmsd_threshold_from(data):
+    """Pose deduplication RMSD requested in a JSON body; raises ValueError unless it is a number >= 0"""
+    try:
+        threshold = float(data.get('rmsd_threshold', app.config['POSE_RMSD_THRESHOLD']))
+    except (TypeError, ValueError):
+        raise ValueError('rmsd_threshold must be a number')
+    if not threshold >= 0:
+        raise ValueError('rmsd_threshold must not be negative')
+    return threshold
+
+def prepare_protein_in_workspace(input_pdb, output_pdbqt, ws, keep_chain='A', add_h=True, plddt_cutoff=None):
+    """
+    Prepare and verify a receptor, keeping its intermediate files private to this call.
+    
+    A structure prepared before with the same options is copied from the
+    receptor cache instead of being prepared again.
+    
+    Returns:
+        tuple: (success, error_message, verification)
+    """
+    cache_key = None
+    if receptor_cache is not None:
+        cache_key = receptor_cache.receptor_key(input_pdb, keep_chain, add_h, plddt_cutoff)
+        verification = receptor_cache.fetch(cache_key, output_pdbqt)
+        if verification is not None:
+            return True, None, verification
+    
+    with workspace.scratch_directory(ws) as scratch:
+        success, error, cleaned_pdb = protein_prep.prepare_protein(input_pdb, output_pdbqt, keep_chain=keep_chain,
+                                                                   add_h=add_h, work_dir=scratch,
+                                                                   plddt_cutoff=plddt_cutoff)
+        verification = None
+        if success:
+            verification = verify_structures.verify_protein_preparation(cleaned_pdb, output_pdbqt)
+            if cache_key and verification.get('overall_valid'):
+                receptor_cache.store(cache_key, output_pdbqt, cleaned_pdb, verification)
+    return success, error, verification
+
+def fetch_batch_protein(pid, ws, plddt_cutoff=None):
+    """
+    Download (or predict) a receptor by UniProt ID and prepare it for a batch.
+    
+    Returns:
+        str: Path of the prepared PDBQT, or None if it could not be prepared
+    """
+    raw_pdb = os.path.join(ws, f"batch_raw_{pid}.pdb")
+    pdbqt = os.path.join(ws, f"batch_prot_{pid}.pdbqt")
+    if not protein_prep.fetch_alphafold_structure(pid, raw_pdb)[0]:
+        fasta, _ = protein_prep.fetch_uniprot_fasta(pid)
+        if fasta:
+            protein_prep.predict_structure_esmfold(fasta, raw_pdb)
+    
+    if os.path.exists(raw_pdb) and prepare_protein_in_workspace(raw_pdb, pdbqt, ws, plddt_cutoff=plddt_cutoff)[0]:
+        return pdbqt
+    return None
+
+def prepare_batch_ligands(lnames, ws):
+    """
+    Look up ligands by name and prepare them for a batch.
+    
+    Names are resolved together (CIDs in bulk requests, names
+    concurrently), then all 3D structures and PDBQT files are built in
+    batches on the conversion engine.
+    
+    Returns:
+        list: Paths of the prepared PDBQT files
+    """
+    found = ligand_prep.fetch_smiles_from_pubchem_bulk(lnames, workers=app.config['FETCH_WORKERS'])
+    # Names that map to the same file are prepared once
+    outputs = {}
+    for lname, (smiles, _, error) in zip(lnames, found):
+        if not error:
+            outputs.setdefault(os.path.join(ws, f"batch_lig_{secure_filename(lname)}.pdbqt"), smiles)
+    items = [(smiles, pdbqt) for pdbqt, smiles in outputs.items()]
+    
+    paths = []
+    with workspace.scratch_directory(ws) as scratch:
+        for (_, pdbqt), (success, _, _) in zip(items, ligand_prep.prepare_ligands_from_smiles(items, scratch)):
+            if success:
+                verify_structures.verify_ligand_preparation(pdbqt)
+                paths.append(pdbqt)
+    return paths
+
 @app.route('/upload_batch', methods=['POST'])
 def upload_batch():
     protein_ids = request.form.get('protein_ids', '').split(',')
     protein_names = request.form.get('protein_names', '').split(',')
     ligand_names = request.form.get('ligand_names', '').split(',')
+    try:
+        plddt_cutoff = plddt_cutoff_from(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-    os.makedirs(app.config['POSES_FOLDER'], exist_ok=True)
+    ws = get_workspace()
     
     protein_paths = []
     ligand_paths = []
@@ -250,61 +499,43 @@ def upload_batch():
         for protein in request.files.getlist('proteins'):
             if protein and allowed_file(protein.filename):
                 filename = secure_filename(protein.filename)
-                path = os.path.join(app.config['UPLOAD_FOLDER'], f"batch_prot_{filename}")
+                path = os.path.join(ws, f"batch_prot_{filename}")
                 protein.save(path)
                 
                 pdbqt_path = path + ".pdbqt"
-                success, error, cleaned_pdb = protein_prep.prepare_protein(path, pdbqt_path)
-                if success:
-                    verify_structures.verify_protein_preparation(cleaned_pdb, pdbqt_path)
+                if prepare_protein_in_workspace(path, pdbqt_path, ws, plddt_cutoff=plddt_cutoff)[0]:
                     protein_paths.append(pdbqt_path)
                 
     if 'ligands' in request.files:
         for ligand in request.files.getlist('ligands'):
             if ligand and allowed_file(ligand.filename):
                 filename = secure_filename(ligand.filename)
-                path = os.path.join(app.config['UPLOAD_FOLDER'], f"batch_lig_{filename}")
+                path = os.path.join(ws, f"batch_lig_{filename}")
                 ligand.save(path)
                 
                 pdbqt_path = path + ".pdbqt"
                 if ligand_prep.prepare_ligand_from_file(path, pdbqt_path)[0]:
                     ligand_paths.append(pdbqt_path)
 
-    for pid in [p.strip() for p in protein_ids if p.strip()]:
-        raw_pdb = os.path.join(app.config['UPLOAD_FOLDER'], f"batch_raw_{pid}.pdb")
-        pdbqt = os.path.join(app.config['UPLOAD_FOLDER'], f"batch_prot_{pid}.pdbqt")
-        if not protein_prep.fetch_alphafold_structure(pid, raw_pdb)[0]:
-            fasta, _ = protein_prep.fetch_uniprot_fasta(pid)
-            if fasta:
-                protein_prep.predict_structure_esmfold(fasta, raw_pdb)
-        
-        if os.path.exists(raw_pdb):
-            success, _, cleaned = protein_prep.prepare_protein(raw_pdb, pdbqt)
-            if success:
-                verify_structures.verify_protein_preparation(cleaned, pdbqt)
-                protein_paths.append(pdbqt)
-            
-    for pname in [p.strip() for p in protein_names if p.strip()]:
-        pid, _, _ = protein_prep.search_uniprot_by_name(pname, require_alphafold=False)
-        if pid:
-            raw_pdb = os.path.join(app.config['UPLOAD_FOLDER'], f"batch_raw_{pid}.pdb")
-            pdbqt = os.path.join(app.config['UPLOAD_FOLDER'], f"batch_prot_{pid}.pdbqt")
-            if not protein_prep.fetch_alphafold_structure(pid, raw_pdb)[0]:
-                fasta, _ = protein_prep.fetch_uniprot_fasta(pid)
-                if fasta:
-                    protein_prep.predict_structure_esmfold(fasta, raw_pdb)
-            
-            if os.path.exists(raw_pdb):
-                success, _, cleaned = protein_prep.prepare_protein(raw_pdb, pdbqt)
-                if success:
-                    verify_structures.verify_protein_preparation(cleaned, pdbqt)
-                    protein_paths.append(pdbqt)
-                
-    for lname in [l.strip() for l in ligand_names if l.strip()]:
-        pdbqt = os.path.join(app.config['UPLOAD_FOLDER'], f"batch_lig_{secure_filename(lname)}.pdbqt")
-        if ligand_prep.prepare_ligand_from_name(lname, pdbqt)[0]:
-            verify_structures.verify_ligand_preparation(pdbqt)
-            ligand_paths.append(pdbqt)
+    # Remote lookups spend their time waiting on the network, so they run concurrently
+    names = [p.strip() for p in protein_names if p.strip()]
+    resolved = batch_scheduler.imap_ordered(lambda name: protein_prep.search_uniprot_by_name(name)[0],
+                                            names, app.config['FETCH_WORKERS'])
+    pids = [secure_filename(p.strip()) for p in protein_ids if p.strip()] + [pid for pid in resolved if pid]
+    lnames = [l.strip() for l in ligand_names if l.strip()]
+    
+    # Each receptor and ligand is fetched once, so no two workers write the same files
+    fetch_protein = functools.partial(fetch_batch_protein, plddt_cutoff=plddt_cutoff)
+    fetches = [(fetch_protein, pid) for pid in dict.fromkeys(pids)]
+    if lnames:
+        # Ligands are converted together, as one more task next to the protein downloads
+        fetches.append((prepare_batch_ligands, list(dict.fromkeys(lnames))))
+    fetched = batch_scheduler.imap_ordered(lambda fetch: fetch[0](fetch[1], ws), fetches, app.config['FETCH_WORKERS'])
+    for (fetch, _), result in zip(fetches, fetched):
+        if fetch is prepare_batch_ligands:
+            ligand_paths.extend(result)
+        elif result:
+            protein_paths.append(result)
             
     return jsonify({
         'message': f'Prepared {len(protein_paths)} proteins and {len(ligand_paths)} ligands',
@@ -312,6 +543,834 @@ def upload_batch():
         'ligands': [os.path.basename(p) for p in ligand_paths]
     })
 
+def library_folder(ws, library_id):
+    """Folder holding a library's prepared ligands and their docking outputs"""
+    return os.path.join(ws, ligand_library.LIBRARIES_DIR, secure_filename(library_id))
+
+def library_listing_path(ws, library_id):
+    """File listing the ligands a library upload registered in the workspace"""
+    return library_folder(ws, library_id) + '.txt'
+
+def batch_ligands(ws, lig_paths, library_ids):
+    """Ligands of a batch: the named ligand files, then each library's prepared ligands in library order"""
+    libraries = [(secure_filename(library_id), library_folder(ws, library_id), library_listing_path(ws, library_id))
+                 for library_id in library_ids]
+    return ligand_library.BatchLigands(lig_paths, libraries)
+
+def run_library_job(job, library_path, library_id, ws):
+    """
+    Prepare every molecule of an uploaded library and register it for batch docking.
+    
+    Records are streamed from the file and prepared block by block into the
+    library's own folder, and each prepared ligand's file name is appended
+    to the library listing as it is written, so memory does not grow with
+    the library. The caller must hold the library's preparation lock; it is
+    refreshed while the job runs and released when it ends.
+    
+    Returns:
+        dict: Library id, counts and the first few preparation errors
+    """
+    listing = library_listing_path(ws, library_id)
+    lock = library_folder(ws, library_id) + '.lock'
+    tmp_listing = f'{listing}.{uuid.uuid4().hex}.tmp'
+    folder = library_folder(ws, library_id)
+    os.makedirs(folder, exist_ok=True)
+    prepared = failed = 0
+    errors = []
+    try:
+        with workspace.scratch_directory(ws) as scratch, open(tmp_listing, 'w') as out:
+            for record, pdbqt, error in ligand_library.prepare_library(library_path, library_id, folder, scratch):
+                if job is not None:
+                    job.check_cancelled()
+                    job.advance()
+                os.utime(lock)
+                if pdbqt:
+                    out.write(os.path.basename(pdbqt) + '\n')
+                    prepared += 1
+                else:
+                    failed += 1
+                    if len(errors) < 20:
+                        errors.append({'index': record.index, 'name': record.name, 'error': error})
+        os.replace(tmp_listing, listing)
+    finally:
+        if os.path.exists(tmp_listing):
+            os.remove(tmp_listing)
+        if os.path.exists(lock):
+            os.remove(lock)
+    
+    return {
+        'library': library_id,
+        'message': f'Prepared {prepared} ligands from the library ({failed} failed)',
+        'prepared': prepared,
+        'failed': failed,
+        'errors': errors
+    }
+
+@app.route('/upload_library', methods=['POST'])
+def upload_library():
+    """
+    Upload a multi-molecule SDF, MOL2 or SMILES library and prepare all of its ligands.
+    
+    The ligands are registered under the returned library id; pass it to
+    /dock_batch as "library" to screen them all. A library that is already
+    prepared is not prepared again, and the same library cannot be
+    prepared twice at once.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Authentication required'}), 401
+    
+    library = request.files.get('library')
+    if not library or not library.filename or not ligand_library.is_library_file(library.filename):
+        return jsonify({'error': 'Upload an SDF, MOL2 or SMILES library file as "library"'}), 400
+    
+    ws = get_workspace()
+    library_dir = os.path.join(ws, ligand_library.LIBRARIES_DIR)
+    os.makedirs(library_dir, exist_ok=True)
+    filename = secure_filename(library.filename)
+    upload_path = os.path.join(library_dir, f'upload_{uuid.uuid4().hex}_{filename}')
+    library.save(upload_path)
+    
+    # The same file uploaded again maps to the same ligand names
+    library_id = file_digest(upload_path)[:12]
+    listing = library_listing_path(ws, library_id)
+    if os.path.exists(listing):
+        os.remove(upload_path)
+        prepared = sum(1 for _ in ligand_library.iter_listing(listing))
+        return jsonify({
+            'library': library_id,
+            'message': f'Library already prepared ({prepared} ligands)',
+            'prepared': prepared
+        })
+    if not ligand_library.claim(library_folder(ws, library_id) + '.lock'):
+        os.remove(upload_path)
+        return jsonify({'error': 'This library is already being prepared', 'library': library_id}), 409
+    library_path = os.path.join(library_dir, f'{library_id}{os.path.splitext(filename)[1].lower()}')
+    os.replace(upload_path, library_path)
+    
+    if request.form.get('wait'):
+        return jsonify(workspace_task(ws, run_library_job)(None, library_path, library_id, ws))
+    job = jobs.submit('upload_library', workspace_task(ws, run_library_job), library_path, library_id, ws,
+                      owner=session['user_id'])
+    return job_response(job)
+
+def batch_pair_names(prot_path, lig_path):
+    prot_name = os.path.basename(prot_path).replace('batch_prot_', '').replace('.pdbqt', '')
+    lig_name = os.path.basename(lig_path).replace('batch_lig_', '').replace('.pdbqt', '')
+    return prot_name, lig_name
+
+def batch_output_dir(prot_path, lig_path, settings):
+    """
+    Folder for the outputs of a batch pair: the batch's own directory, with a
+    subfolder per ligand library. Settings without an output_dir (tasks queued
+    by an older server) fall back to the receptor's folder.
+    """
+    if settings.get('output_dir'):
+        output_dir = os.path.join(app.config['UPLOAD_FOLDER'], settings['output_dir'])
+    else:
+        output_dir = os.path.dirname(prot_path)
+    lig_dir = os.path.dirname(lig_path)
+    if os.path.basename(os.path.dirname(lig_dir)) == ligand_library.LIBRARIES_DIR:
+        output_dir = os.path.join(output_dir, os.path.basename(lig_dir))
+    os.makedirs(output_dir, exist_ok=True)
+    return output_dir
+
+def batch_directory_setting(ws, batch_id):
+    """
+    Output folder of one batch job, relative to the data folder so workers
+    can resolve it against their own mount. Each batch gets its own folder so
+    concurrent jobs in a workspace never overwrite each other's outputs.
+    """
+    output_dir = workspace.batch_directory(ws, batch_id)
+    return os.path.relpath(output_dir, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+
+def batch_output_file(prot_path, lig_path, settings):
+    """Docking output of a batch pair, written to the batch's own directory"""
+    prot_name, lig_name = batch_pair_names(prot_path, lig_path)
+    tag = settings.get('output_tag', '')
+    tag = f'_{tag}' if tag else ''
+    output_dir = batch_output_dir(prot_path, lig_path, settings)
+    return os.path.join(output_dir, f'batch_{prot_name}_{lig_name}{tag}_out.pdbqt')
+
+def pose_interactions(receptor_pdbqt, models):
+    """
+    Interaction fingerprints of several poses of one ligand.
+    
+    Returns:
+        list: One interactions dict per model, or None if the analysis failed
+    """
+    try:
+        coords, types, donors, names = interactions.ligand_poses(models)
+        return interactions.analyse_poses(interactions.receptor_index(receptor_pdbqt), coords, types, donors, names)
+    except Exception as e:
+        print(f"Interaction analysis failed for {receptor_pdbqt}: {e}")
+        return None
+
+def finish_pair(prot_path, lig_path, output_file, settings):
+    """
+    Parse a pair's docking output and register its complex file.
+    
+    The complex is stored as references to the receptor PDB (converted once
+    per receptor) and the pair's ligand PDB, and assembled when served.
+    With settings['rmsd_threshold'] > 0 only one pose per cluster of
+    near-identical poses is kept; with settings['interactions'] the best
+    pose's receptor contacts are added to the result.
+
+    Returns:
+        dict: Result entry for the pair, or None if post-processing failed
+    """
+    prot_name, lig_name = batch_pair_names(prot_path, lig_path)
+    tag = settings.get('output_tag', '')
+    rmsd_threshold = settings.get('rmsd_threshold', 0)
+    
+    affinities = parse_vina_results(output_file)
+    if not affinities:
+        print(f"No affinities found for {prot_name}/{lig_name}")
+        return None
+
+    # Verification step for batch (compliance)
+    verify_structures.verify_ligand_preparation(lig_path)
+    
+    complex_pdb_path = os.path.join(os.path.dirname(output_file),
+                                    f'batch_{prot_name}_{lig_name}{"_" + tag if tag else ""}_complex.pdb')
+    complex_pdb = os.path.relpath(complex_pdb_path, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+    
+    poses_file = output_file
+    cluster_sizes = None
+    models = None
+    if rmsd_threshold > 0:
+        models, clusters = pose_clustering.dedupe_poses(output_file, rmsd_threshold)
+        keep = sorted(members[0] for members in clusters)
+        cluster_sizes = [len(members) for members in sorted(clusters, key=lambda members: members[0])]
+        if len(keep) < len(models):
+            poses_file = os.path.splitext(output_file)[0] + '_unique.pdbqt'
+            pose_clustering.write_models(models, keep, poses_file)
+            affinities = [affinities[i] for i in keep if i < len(affinities)]
+    
+    ligand_pdb = os.path.splitext(output_file)[0] + '.pdb'
+    converted = convert_pdbqt_to_pdb(poses_file, ligand_pdb)
+    if poses_file != output_file:
+        os.remove(poses_file)
+    if not converted:
+        print(f"Failed to convert poses to PDB for {prot_name}/{lig_name}")
+        return None
+    try:
+        complex_store.save_complex(complex_pdb_path,
+                                   complex_store.receptor_pdb(prot_path, os.path.dirname(output_file)),
+                                   ligand_pdb)
+    except Exception as e:
+        print(f"Failed to register complex for {prot_name}/{lig_name}: {e}")
+        return None
+
+    result = {
+        'protein': prot_name,
+        'ligand': lig_name,
+        'best_affinity': affinities[0],
+        'affinities': affinities,
+        'complex_file': complex_pdb
+    }
+    if cluster_sizes is not None:
+        result['cluster_sizes'] = cluster_sizes
+    if settings.get('interactions'):
+        models = models or pose_clustering.read_models(output_file)
+        fingerprints = pose_interactions(prot_path, models[:1]) if models else None
+        if fingerprints:
+            result['interactions'] = fingerprints[0]
+    return result
+
+def docking_work(receptor, ligand, settings):
+    """Estimated work of one docking run, for the runtime model"""
+    return runtime_model.work(receptor, ligand, settings['size'], settings['exhaustiveness'], settings.get('cpu'))
+
+def batch_item_cost(item, settings):
+    """Estimated work of a batch work item, used to start expensive items first"""
+    prot_path, indexed_ligs = item
+    _, size = compute_docking_box(prot_path, settings.get('box_mode', 'fixed'), settings.get('pocket_index', 0))
+    item_settings = {**settings, 'size': size}
+    return sum(docking_work(prot_path, lig_path, item_settings) for _, lig_path in indexed_ligs)
+
+def schedule_batch_items(items, settings, window=None):
+    """
+    Yield batch work items longest-first by estimated cost.
+    
+    The sort runs when the first item is requested, i.e. in the job that
+    docks the batch rather than in the request that submitted it. With a
+    window only that many items are sorted at a time, so streamed results
+    start at once and memory does not grow with the batch.
+    """
+    yield from cost_model.longest_first(items, lambda item: batch_item_cost(item, settings), window)
+
+def docking_receptor(receptor, settings):
+    """
+    Receptor file smina loads for a search.
+    
+    With settings['trim_margin'] set, this is the receptor cut down to the
+    residues within that margin of the box; results, complexes and
+    interactions still refer to the full receptor.
+    """
+    margin = settings.get('trim_margin')
+    if not margin:
+        return receptor
+    try:
+        return receptor_trim.trimmed_receptor(receptor, settings['center'], settings['size'], margin)
+    except Exception as e:
+        print(f"Receptor trimming failed for {receptor}, docking the full receptor: {e}")
+        return receptor
+
+def smina_dock(receptor, ligand, output_file, settings, job=None):
+    """
+    Dock one receptor/ligand pair, serving repeated searches from the docking cache.
+    
+    Without an explicit timeout in settings the run is given a timeout
+    scaled to its estimated runtime, and the measured runtime is fed back
+    into the estimate.
+    
+    Args:
+        settings: Search parameters (center, size, exhaustiveness, num_modes,
+                  seed, cpu, timeout, trim_margin)
+    
+    Returns:
+        tuple: (success, error_message, cache_hit)
+    """
+    receptor = docking_receptor(receptor, settings)
+    cache_key = None
+    if docking_cache is not None:
+        cache_key = docking_cache.docking_key(
+            receptor, ligand, settings['center'], settings['size'],
+            settings['exhaustiveness'], settings['num_modes'], settings.get('seed'))
+        if docking_cache.fetch(cache_key, output_file):
+            return True, None, True
+    
+    cmd = build_smina_command(
+        receptor, ligand, output_file, center=settings['center'], size=settings['size'],
+        exhaustiveness=settings['exhaustiveness'], num_modes=settings['num_modes'],
+        cpu=settings.get('cpu'), seed=settings.get('seed'), verbosity=settings.get('verbosity', 0))
+    work = docking_work(receptor, ligand, settings)
+    started = time.monotonic()
+    result = run_smina(cmd, timeout=settings.get('timeout') or runtime_model.timeout(work), job=job)
+    if result.returncode != 0:
+        return False, result.stderr, False
+    runtime_model.observe(work, time.monotonic() - started)
+    
+    if cache_key is not None:
+        docking_cache.store(cache_key, output_file, parse_vina_results(output_file))
+    return True, None, False
+
+def dock_pair(prot_path, lig_path, settings, job=None):
+    """
+    Dock one protein/ligand pair for batch mode and build its complex file.
+
+    Returns:
+        dict: Result entry for the pair, or None if docking failed
+    """
+    prot_name, lig_name = batch_pair_names(prot_path, lig_path)
+    output_file = batch_output_file(prot_path, lig_path, settings)
+    
+    try:
+        if job is not None and job.cancelled:
+            return None
+        print(f"Running docking for {prot_name} and {lig_name}...")
+        success, error, _ = smina_dock(prot_path, lig_path, output_file, settings, job=job)
+        
+        if not success:
+            print(f"Smina failed for {prot_name}/{lig_name}: {error}")
+            return None
+
+        return finish_pair(prot_path, lig_path, output_file, settings)
+    except subprocess.TimeoutExpired:
+        print(f"Docking timed out for {prot_name}/{lig_name}")
+    except job_queue.JobCancelled:
+        print(f"Docking cancelled for {prot_name}/{lig_name}")
+    except Exception as e:
+        print(f"Batch docking error for {prot_name}/{lig_name}: {e}")
+    finally:
+        if job is not None:
+            job.advance()
+    return None
+
+def dock_ligand_group(prot_path, lig_paths, settings, job=None):
+    """
+    Dock several ligands against one receptor in a single Smina run.
+    
+    Smina parses the receptor and builds its grids once for the whole group.
+    The combined output is split back into one output file per ligand, which
+    then goes through the same post-processing as a single pair. Ligands
+    already in the docking cache are not re-docked. If the output cannot be
+    matched to the inputs the group is re-docked pair by pair.
+
+    Returns:
+        list: Result entry (or None) for each ligand, in input order
+    """
+    prot_name, _ = batch_pair_names(prot_path, lig_paths[0])
+    output_files = [batch_output_file(prot_path, l, settings) for l in lig_paths]
+    results = [None] * len(lig_paths)
+    receptor = docking_receptor(prot_path, settings)
+    
+    todo = []
+    for i, (lig_path, output_file) in enumerate(zip(lig_paths, output_files)):
+        cache_key = None
+        if docking_cache is not None:
+            cache_key = docking_cache.docking_key(
+                receptor, lig_path, settings['center'], settings['size'],
+                settings['exhaustiveness'], settings['num_modes'], settings.get('seed'))
+            if docking_cache.fetch(cache_key, output_file):
+                results[i] = finish_pair(prot_path, lig_path, output_file, settings)
+                if job is not None:
+                    job.advance()
+                continue
+        todo.append((i, cache_key))
+    
+    if not todo:
+        return results
+    
+    todo_ligs = [lig_paths[i] for i, _ in todo]
+    _, first_lig = batch_pair_names(prot_path, todo_ligs[0])
+    group_output = os.path.join(batch_output_dir(prot_path, todo_ligs[0], settings),
+                                f'batch_{prot_name}_group_{first_lig}_out.pdbqt')
+    cmd = build_smina_command(
+        receptor, todo_ligs, group_output, center=settings['center'], size=settings['size'],
+        exhaustiveness=settings['exhaustiveness'], num_modes=settings['num_modes'],
+        cpu=settings.get('cpu'), seed=settings.get('seed'), verbosity=0)
+    
+    try:
+        if job is not None and job.cancelled:
+            return results
+        print(f"Running grouped docking for {prot_name} and {len(todo_ligs)} ligands...")
+        work = sum(docking_work(receptor, lig, settings) for lig in todo_ligs)
+        if settings.get('timeout'):
+            timeout = settings['timeout'] * len(todo_ligs)
+        else:
+            timeout = runtime_model.timeout(work, runs=len(todo_ligs))
+        started = time.monotonic()
+        result = run_smina(cmd, timeout=timeout, job=job)
+        
+        if result.returncode == 0:
+            runtime_model.observe(work, time.monotonic() - started)
+            todo_outputs = [output_files[i] for i, _ in todo]
+            if split_molecules(group_output, todo_outputs) == len(todo_ligs):
+                for (i, cache_key), output_file in zip(todo, todo_outputs):
+                    if cache_key is not None:
+                        docking_cache.store(cache_key, output_file, parse_vina_results(output_file))
+                    results[i] = finish_pair(prot_path, lig_paths[i], output_file, settings)
+                if job is not None:
+                    job.advance(len(todo_ligs))
+                return results
+            print(f"Grouped output for {prot_name} does not match its {len(todo_ligs)} ligands, docking pairs individually")
+        else:
+            print(f"Grouped Smina run failed for {prot_name}: {result.stderr}")
+    except subprocess.TimeoutExpired:
+        print(f"Grouped docking timed out for {prot_name}, docking pairs individually")
+    except job_queue.JobCancelled:
+        print(f"Grouped docking cancelled for {prot_name}")
+        return results
+    except Exception as e:
+        print(f"Grouped docking error for {prot_name}: {e}")
+    finally:
+        if os.path.exists(group_output):
+            os.remove(group_output)
+    
+    for i, _ in todo:
+        results[i] = dock_pair(prot_path, lig_paths[i], settings, job=job)
+    return results
+
+def iter_batch_items(prot_paths, lig_paths, chunk_size=1):
+    """
+    Yield batch work items as (protein_path, [(pair_index, ligand_path), ...]).
+    
+    Ligands are grouped per receptor in chunks of chunk_size; pair_index is
+    the position of the pair in protein-major order. lig_paths is iterated
+    once per receptor, so it may be a lazy BatchLigands.
+    """
+    chunk_size = max(1, int(chunk_size or 1))
+    index = 0
+    for prot_path in prot_paths:
+        ligs = iter(lig_paths)
+        while True:
+            chunk = list(itertools.islice(ligs, chunk_size))
+            if not chunk:
+                break
+            yield prot_path, list(enumerate(chunk, index))
+            index += len(chunk)
+
+def dock_batch_item(item, settings, job=None):
+    """Dock one batch work item and return [(pair_index, result), ...]"""
+    prot_path, indexed_ligs = item
+    indices = [i for i, _ in indexed_ligs]
+    lig_paths = [l for _, l in indexed_ligs]
+    center, size = compute_docking_box(prot_path, settings.get('box_mode', 'fixed'), settings.get('pocket_index', 0))
+    settings = {**settings, 'center': center, 'size': size}
+    if len(lig_paths) == 1:
+        results = [dock_pair(prot_path, lig_paths[0], settings, job=job)]
+    else:
+        results = dock_ligand_group(prot_path, lig_paths, settings, job=job)
+    return list(zip(indices, results))
+
+def batch_identity(prot_paths, ligands, settings):
+    """
+    Id and manifest header of a checkpointed batch.
+    
+    The batch id is derived from the receptors' and named ligands' contents,
+    the ids of the libraries (themselves digests of the uploaded files) and
+    the search settings, so posting the same screen again picks up where it
+    stopped.
+    
+    Returns:
+        tuple: (batch_id, header)
+    """
+    search = {k: v for k, v in settings.items() if k not in ('cpu', 'timeout', 'output_dir')}
+    library_ids = [library_id for library_id, _, _ in ligands.libraries]
+    parts = [
+        [(os.path.basename(p), file_digest(p)) for p in prot_paths],
+        [(os.path.basename(l), file_digest(l)) for l in ligands.paths]
+    ]
+    if library_ids:
+        parts.append(library_ids)
+    header = {
+        'proteins': [os.path.basename(p) for p in prot_paths],
+        'ligands': [os.path.basename(l) for l in ligands.paths],
+        'libraries': library_ids,
+        'settings': search
+    }
+    return make_key(*parts, search)[:24], header
+
+def open_batch_manifest(ws, batch_id, header, restart=False, retry_failed=True):
+    """
+    Open the checkpoint manifest of a batch, resuming an earlier run if one exists.
+    
+    Pairs that failed in an earlier run are docked again unless
+    retry_failed is False.
+    """
+    path = os.path.join(ws, 'batches', f'{batch_id}.jsonl')
+    if restart and os.path.exists(path):
+        os.remove(path)
+    return batch_manifest.BatchManifest(path, header, retry_failed=retry_failed)
+
+def dock_batch_item_checkpointed(item, settings, manifest, job=None):
+    """
+    Dock a batch work item, recording every pair's state in the manifest.
+    
+    A pair that was running when a previous run stopped is finished from its
+    output file if smina completed it after the pair was started.
+    """
+    prot_path, indexed_ligs = item
+    results = []
+    todo = []
+    for index, lig_path in indexed_ligs:
+        started = manifest.interrupted_at(index)
+        output_file = batch_output_file(prot_path, lig_path, settings)
+        if started is not None and os.path.exists(output_file) and os.path.getmtime(output_file) >= started:
+            result = finish_pair(prot_path, lig_path, output_file, settings)
+            if result:
+                manifest.mark(index, batch_manifest.DONE, result=result)
+                results.append((index, result))
+                if job is not None:
+                    job.advance()
+                continue
+        todo.append((index, lig_path))
+    
+    if not todo:
+        return results
+    for index, _ in todo:
+        manifest.mark(index, batch_manifest.RUNNING)
+    for index, result in dock_batch_item((prot_path, todo), settings, job=job):
+        if result:
+            manifest.mark(index, batch_manifest.DONE, result=result)
+        elif job is None or not job.cancelled:
+            manifest.mark(index, batch_manifest.FAILED)
+        results.append((index, result))
+    return results
+
+def cluster_batch_poses(results, threshold):
+    """
+    Group the pairs of each ligand whose best poses coincide across receptors.
+    
+    Receptors that share a frame (conformers of one target, for example)
+    often yield the same binding mode; such pairs end up in one group.
+    
+    Returns:
+        dict: {ligand: [[protein, ...], ...]} for ligands docked to several
+              receptors, groups and proteins ordered by best affinity
+    """
+    by_ligand = {}
+    for result in results:
+        by_ligand.setdefault(result['ligand'], []).append(result)
+    
+    clusters = {}
+    for ligand, entries in by_ligand.items():
+        if len(entries) < 2:
+            continue
+        coords, kept = [], []
+        for result in entries:
+            parts = complex_store.complex_parts(os.path.join(app.config['UPLOAD_FOLDER'], result['complex_file']))
+            models = pose_clustering.read_models(parts[1]) if parts else []
+            if models:
+                coords.append(pose_clustering.model_coordinates(models[0]))
+                kept.append(result)
+        if kept:
+            groups = pose_clustering.cluster_structures(coords, threshold, [r['best_affinity'] for r in kept])
+            clusters[ligand] = [[kept[i]['protein'] for i in members] for members in groups]
+    return clusters
+
+def run_batch_job(job, items, total, max_jobs, settings, batch_id=None, manifest=None):
+    """
+    Dock every protein/ligand pair of a batch and collect the successful results.
+    
+    With a manifest, pairs it records as done or failed are skipped and their
+    stored results reused, so an interrupted screen only docks what is left.
+    """
+    if job is not None:
+        job.set_total(total)
+    print(f"Batch docking {total} pairs with {max_jobs} concurrent jobs x {settings['cpu']} CPU")
+    
+    if manifest is None:
+        results = []
+        for item_results in batch_scheduler.imap_ordered(
+                lambda item: dock_batch_item(item, settings, job=job),
+                items,
+                max_jobs=max_jobs):
+            results.extend(r for _, r in item_results if r)
+        return {'results': results}
+    
+    by_index = manifest.results()
+    resumed = sum(manifest.counts().get(state, 0) for state in batch_manifest.FINAL_STATES)
+    if resumed:
+        print(f"Resuming batch {batch_id}: {resumed} of {total} pairs already finished")
+        if job is not None:
+            job.advance(resumed)
+    
+    pending = (
+        (prot_path, [(i, l) for i, l in indexed_ligs if not manifest.is_finished(i)])
+        for prot_path, indexed_ligs in items
+    )
+    # Results are keyed by pair index, so items may finish in any order
+    for _, item_results in batch_scheduler.imap_unordered(
+            lambda item: dock_batch_item_checkpointed(item, settings, manifest, job=job),
+            (item for item in pending if item[1]),
+            max_jobs=max_jobs):
+        for index, result in item_results:
+            if result:
+                by_index[index] = result
+    
+    summary = {
+        'batch_id': batch_id,
+        'resumed': resumed,
+        'results': [by_index[i] for i in sorted(by_index)]
+    }
+    if settings.get('rmsd_threshold'):
+        summary['pose_clusters'] = cluster_batch_poses(summary['results'], settings['rmsd_threshold'])
+    return summary
+
+def run_checkpointed_batch_job(job, ws, prot_paths, ligands, items, total, max_jobs, settings,
+                               restart=False, retry_failed=True):
+    """
+    Dock a resumable batch into its own folder.
+    
+    The inputs are hashed into the batch id here, in the job, rather than
+    in the request that submitted it. The batch's lock file is held while
+    it runs; the same screen posted again meanwhile waits for that run to
+    end and then attaches to its manifest, returning its results instead of
+    docking the pairs a second time (a restart is not applied then).
+    """
+    batch_id, header = batch_identity(prot_paths, ligands, settings)
+    lock = workspace.batch_directory(ws, batch_id) + '.lock'
+    attached = False
+    while not workspace.claim_lock(lock):
+        if not attached:
+            print(f"Batch {batch_id} is already running; waiting to attach to it")
+            attached = True
+        if job is not None:
+            job.check_cancelled()
+        time.sleep(BATCH_LOCK_POLL_SECONDS)
+    
+    with workspace.holding_lock(lock):
+        manifest = open_batch_manifest(ws, batch_id, header, restart=restart and not attached,
+                                       retry_failed=retry_failed)
+        settings = {**settings, 'output_dir': batch_directory_setting(ws, batch_id)}
+        return run_batch_job(job, items, total, max_jobs, settings, batch_id, manifest)
+
+def run_distributed_batch_job(job, items, total, settings, max_jobs=1):
+    """
+    Hand a batch to the worker pool through the task broker and wait for it.
+    
+    Each work item becomes one task; paths are stored relative to the data
+    folder so workers can mount the shared storage anywhere. Progress is
+    reported in tasks. Cancelling the job withdraws the tasks no worker has
+    claimed yet.
+    
+    If no task is claimed, renewed or finished for BROKER_STALL_SECONDS (no
+    worker is running, or all of them died), the tasks still pending or
+    whose lease has expired are withdrawn and docked here instead; tasks a
+    live worker holds are left to it. Results are returned in pair order.
+    """
+    data_dir = app.config['UPLOAD_FOLDER']
+    tasks = {}
+    for prot_path, indexed_ligs in items:
+        tasks[indexed_ligs[0][0]] = (prot_path, indexed_ligs)
+    
+    batch_id = job.id if job is not None else workspace.new_workspace_id()
+    broker.submit(batch_id, [(index, {
+        'protein': os.path.relpath(prot_path, data_dir),
+        'ligands': [(i, os.path.relpath(lig_path, data_dir)) for i, lig_path in indexed_ligs],
+        'settings': settings
+    }) for index, (prot_path, indexed_ligs) in tasks.items()])
+    if job is not None:
+        job.set_total(len(tasks))
+    print(f"Queued batch {batch_id}: {total} pairs in {len(tasks)} tasks for distributed workers")
+    
+    reported = 0
+    by_index = {}
+    local_tasks = 0
+    stall_seconds = app.config['BROKER_STALL_SECONDS']
+    while True:
+        if job is not None and job.cancelled:
+            broker.cancel_batch(batch_id)
+            job.check_cancelled()
+        status = broker.batch_status(batch_id)
+        finished = sum(n for state, n in status.items() if state not in (task_broker.PENDING, task_broker.RUNNING))
+        if job is not None and finished > reported:
+            job.advance(finished - reported)
+            reported = finished
+        if finished >= len(tasks):
+            break
+        if stall_seconds > 0 and time.time() - broker.last_activity(batch_id) > stall_seconds:
+            withdrawn = broker.withdraw_batch(batch_id)
+            if withdrawn:
+                print(f"No worker progress on batch {batch_id} for {stall_seconds:.0f}s; "
+                      f"docking {len(withdrawn)} tasks locally")
+                if job is not None:
+                    # Withdrawn tasks count as finished; local docking reports progress per pair
+                    job.set_total(job.total + sum(len(tasks[index][1]) for index in withdrawn))
+                for item_results in batch_scheduler.imap_ordered(
+                        lambda item: dock_batch_item(item, settings, job=job),
+                        (tasks[index] for index in withdrawn),
+                        max_jobs=max_jobs):
+                    by_index.update((i, r) for i, r in item_results if r)
+                local_tasks += len(withdrawn)
+                continue
+        time.sleep(app.config['BROKER_POLL_SECONDS'])
+    
+    for _, item_results in broker.batch_results(batch_id):
+        by_index.update((i, r) for i, r in item_results if r)
+    results = [by_index[i] for i in sorted(by_index)]
+    
+    summary = {'results': results, 'failed_tasks': status.get(task_broker.FAILED, 0)}
+    if local_tasks:
+        summary['local_tasks'] = local_tasks
+    if settings.get('rmsd_threshold'):
+        summary['pose_clusters'] = cluster_batch_poses(results, settings['rmsd_threshold'])
+    return summary
+
+def iter_tiered_batch(items, total, max_jobs, settings, screening, job=None, ordered=True):
+    """
+    Two-stage screen: dock every pair cheaply, then re-dock the best hits.
+    
+    Stage 1 uses the batch settings (exhaustiveness 1). The top_k and/or
+    top_percent pairs by best_affinity are then re-docked with
+    refine_exhaustiveness into separate '_refined' output files.
+    
+    Yields:
+        tuple: (stage, pair_index, result) with stage 'screen' or 'refine'
+    """
+    hits = batch_scheduler.TopHits.for_screen(total, screening.get('top_k'), screening.get('top_percent'))
+    refine_exhaustiveness = int(screening.get('refine_exhaustiveness', 8))
+    
+    def screen_item(item):
+        return item, dock_batch_item(item, settings, job=job)
+    
+    if ordered:
+        screened = batch_scheduler.imap_ordered(screen_item, items, max_jobs=max_jobs)
+    else:
+        screened = (entry for _, entry in batch_scheduler.imap_unordered(screen_item, items, max_jobs=max_jobs))
+    for (prot_path, indexed_ligs), item_results in screened:
+        lig_paths = dict(indexed_ligs)
+        for index, result in item_results:
+            if result:
+                hits.add(result['best_affinity'], (index, prot_path, lig_paths[index], result['best_affinity']))
+                yield 'screen', index, result
+    
+    selected = hits.ranked()
+    if job is not None:
+        job.set_total(total + len(selected))
+    refine_jobs, refine_cpu = batch_scheduler.plan_workers(exhaustiveness=refine_exhaustiveness)
+    refine_settings = {
+        **settings,
+        'exhaustiveness': refine_exhaustiveness,
+        'cpu': refine_cpu,
+        'output_tag': 'refined'
+    }
+    print(f"Refining {len(selected)} hits at exhaustiveness {refine_exhaustiveness} with {refine_jobs} jobs x {refine_cpu} CPU")
+    refine_items = [(prot_path, [(index, lig_path)]) for index, prot_path, lig_path, _ in selected]
+    refined = batch_scheduler.imap_ordered(lambda item: dock_batch_item(item, refine_settings, job=job),
+                                           refine_items, max_jobs=refine_jobs)
+    for (index, _, _, screening_affinity), item_results in zip(selected, refined):
+        for _, result in item_results:
+            if result:
+                result['screening_affinity'] = screening_affinity
+                yield 'refine', index, result
+
+def run_tiered_batch_job(job, items, total, max_jobs, settings, screening):
+    """Run a two-stage screen and report both stages"""
+    if job is not None:
+        job.set_total(total)
+    print(f"Tiered screening of {total} pairs with {max_jobs} concurrent jobs x {settings['cpu']} CPU")
+    screen, refined = [], []
+    for stage, index, result in iter_tiered_batch(items, total, max_jobs, settings, screening, job=job, ordered=False):
+        if stage == 'screen':
+            screen.append((index, result))
+        else:
+            refined.append(result)
+    summary = {'results': [result for _, result in sorted(screen, key=lambda entry: entry[0])], 'refined': refined}
+    if settings.get('rmsd_threshold'):
+        summary['pose_clusters'] = cluster_batch_poses(summary['results'], settings['rmsd_threshold'])
+    return summary
+
+def stream_batch_results(items, total, max_jobs, settings, fmt='ndjson', screening=None):
+    """
+    Dock a batch and yield each pair's result as soon as it is ready.
+    
+    Results are emitted in completion order as NDJSON lines or server-sent
+    events, each tagged with the pair's submission index. In a tiered
+    screen the re-docked hits follow as 'refined' records. A final summary
+    record closes the stream.
+    """
+    def encode(event, payload):
+        body = json.dumps(payload)
+        if fmt == 'sse':
+            return f"event: {event}\ndata: {body}\n\n"
+        return body + "\n"
+    
+    print(f"Streaming batch docking of {total} pairs with {max_jobs} concurrent jobs x {settings['cpu']} CPU")
+    if screening is not None:
+        events = iter_tiered_batch(items, total, max_jobs, settings, screening, ordered=False)
+    else:
+        events = (
+            ('screen', index, result)
+            for _, item_results in batch_scheduler.imap_unordered(
+                lambda item: dock_batch_item(item, settings), items, max_jobs=max_jobs)
+            for index, result in item_results
+        )
+    succeeded = refined = 0
+    for stage, index, result in events:
+        if not result:
+            continue
+        if stage == 'refine':
+            refined += 1
+            yield encode('refined', {'index': index, 'stage': stage, **result})
+        else:
+            succeeded += 1
+            yield encode('result', {'index': index, **result})
+    summary = {'done': True, 'total': total, 'succeeded': succeeded}
+    if screening is not None:
+        summary['refined'] = refined
+    yield encode('done', summary)
+
+def job_response(job):
+    return jsonify({
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('job_status', job_id=job.id),
+        'result_url': url_for('job_result', job_id=job.id)
+    }), 202
+
 @app.route('/dock_batch', methods=['POST'])
 def dock_batch():
     if 'user_id' not in session:
@@ -321,72 +1380,103 @@ def dock_batch():
     proteins = data.get('proteins', [])
     ligands = data.get('ligands', [])
     
-    if not proteins or not ligands:
+    ws = get_workspace()
+    libraries = data.get('library') or []
+    if isinstance(libraries, str):
+        libraries = [libraries]
+    
+    if not proteins or not (ligands or libraries):
         return jsonify({'error': 'No proteins or ligands specified for batch docking'}), 400
+    try:
+        rmsd_threshold = rmsd_threshold_from(data)
+        trim_margin = trim_margin_from(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    results = []
-    smina_cmd = get_smina_command()
+    max_jobs, cpu_per_job = batch_scheduler.plan_workers(
+        max_jobs=data.get('max_jobs', app.config['BATCH_MAX_JOBS']),
+        cpu_per_job=data.get('cpu_per_job', app.config['BATCH_CPU_PER_JOB']),
+        exhaustiveness=1
+    )
+    # Blind docking for batch: the box is derived per receptor unless box_mode is 'fixed'
+    settings = {
+        'box_mode': data.get('box_mode', 'auto'),
+        'pocket_index': data.get('pocket_index', 0),
+        'center': DEFAULT_BOX_CENTER,
+        'size': DEFAULT_BOX_SIZE,
+        'exhaustiveness': 1,
+        'num_modes': 9,
+        'seed': data.get('seed', app.config['DOCKING_SEED']),
+        'cpu': cpu_per_job,
+        'rmsd_threshold': rmsd_threshold,
+        'interactions': bool(data.get('interactions', app.config['INTERACTIONS'])),
+        'trim_margin': trim_margin,
+        # None scales each run's timeout to its estimated runtime
+        'timeout': data.get('timeout')
+    }
     
-    for prot_file in proteins:
-        prot_path = os.path.join(app.config['UPLOAD_FOLDER'], prot_file)
-        if not os.path.exists(prot_path): continue
-            
-        for lig_file in ligands:
-            lig_path = os.path.join(app.config['UPLOAD_FOLDER'], lig_file)
-            if not os.path.exists(lig_path): continue
-                
-            prot_name = prot_file.replace('batch_prot_', '').replace('.pdbqt', '')
-            lig_name = lig_file.replace('batch_lig_', '').replace('.pdbqt', '')
-            
-            output_file = os.path.join(app.config['UPLOAD_FOLDER'], f'batch_{prot_name}_{lig_name}_out.pdbqt')
-            
-            # Blind docking for batch (default 30A box at center 0,0,0)
-            cmd = [
-                smina_cmd, '--receptor', prot_path, '--ligand', lig_path,
-                '--num_modes', '9', '--exhaustiveness', '1', 
-                '--center_x', '0', '--center_y', '0', '--center_z', '0',
-                '--size_x', '30', '--size_y', '30', '--size_z', '30',
-                '--out', output_file, '--verbosity', '0'
-            ]
-            
-            try:
-                print(f"Running docking for {prot_name} and {lig_name}...")
-                result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-                
-                if result.returncode != 0:
-                    print(f"Smina failed for {prot_name}/{lig_name}: {result.stderr}")
-                    continue
-
-                affinities = parse_vina_results(output_file)
-                if affinities:
-                    # Verification step for batch (compliance)
-                    verify_structures.verify_ligand_preparation(lig_path)
-                    
-                    complex_pdb = f'batch_{prot_name}_{lig_name}_complex.pdb'
-                    complex_pdb_path = os.path.join(app.config['UPLOAD_FOLDER'], complex_pdb)
-                    
-                    combined_pdbqt = output_file + ".complex.pdbqt"
-                    if combine_protein_ligand(prot_path, output_file, combined_pdbqt):
-                        if convert_pdbqt_to_pdb(combined_pdbqt, complex_pdb_path):
-                            results.append({
-                                'protein': prot_name,
-                                'ligand': lig_name,
-                                'best_affinity': affinities[0],
-                                'affinities': affinities,
-                                'complex_file': complex_pdb
-                            })
-                        else:
-                            print(f"Failed to convert complex to PDB for {prot_name}/{lig_name}")
-                    else:
-                        print(f"Failed to combine protein/ligand for {prot_name}/{lig_name}")
-                else:
-                    print(f"No affinities found for {prot_name}/{lig_name}")
-            except subprocess.TimeoutExpired:
-                print(f"Docking timed out for {prot_name}/{lig_name}")
-            except Exception as e:
-                print(f"Batch docking error for {prot_name}/{lig_name}: {e}")
-                
-    return jsonify({'results': results})
+    prot_paths = [os.path.join(ws, secure_filename(p)) for p in proteins]
+    lig_paths = [os.path.join(ws, secure_filename(l)) for l in ligands]
+    prot_paths = [p for p in prot_paths if os.path.exists(p)]
+    lig_paths = batch_ligands(ws, [l for l in lig_paths if os.path.exists(l)], libraries)
+    ligand_count = len(lig_paths)
+    if not ligands and not ligand_count:
+        return jsonify({'error': 'No proteins or ligands specified for batch docking'}), 400
+    total = len(prot_paths) * ligand_count
+    # Batches over a library are scheduled a window at a time so the library never sits in memory
+    window = max_jobs * STREAM_SCHEDULE_WINDOW if libraries else None
+    
+    screening = data.get('screening')
+    if screening is True:
+        screening = {}
+    if screening is not None and not isinstance(screening, dict):
+        return jsonify({'error': 'screening must be an object with top_k, top_percent and refine_exhaustiveness'}), 400
+    
+    chunk_size = 1
+    if data.get('group_ligands'):
+        chunk_size = data.get('ligand_chunk_size') or ligand_count
+    
+    stream = data.get('stream')
+    if not stream:
+        accept = request.accept_mimetypes
+        if accept.best == 'text/event-stream':
+            stream = 'sse'
+        elif accept.best == 'application/x-ndjson':
+            stream = 'ndjson'
+    if stream in ('ndjson', 'sse'):
+        settings['output_dir'] = batch_directory_setting(ws, workspace.new_workspace_id())
+        items = schedule_batch_items(iter_batch_items(prot_paths, lig_paths, chunk_size), settings,
+                                     window=max_jobs * STREAM_SCHEDULE_WINDOW)
+        mimetype = 'text/event-stream' if stream == 'sse' else 'application/x-ndjson'
+        return Response(workspace.iter_in_use(ws, stream_batch_results(items, total, max_jobs, settings, stream, screening)),
+                        mimetype=mimetype, headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    
+    items = schedule_batch_items(iter_batch_items(prot_paths, lig_paths, chunk_size), settings, window=window)
+    if screening is not None or (broker is not None and data.get('distributed', True)):
+        settings['output_dir'] = batch_directory_setting(ws, workspace.new_workspace_id())
+    if screening is not None:
+        if data.get('wait'):
+            return jsonify(workspace_task(ws, run_tiered_batch_job)(None, items, total, max_jobs, settings, screening))
+        job = jobs.submit('dock_batch', workspace_task(ws, run_tiered_batch_job), items, total, max_jobs, settings, screening,
+                          owner=session['user_id'])
+        return job_response(job)
+    
+    if broker is not None and data.get('distributed', True):
+        if data.get('wait'):
+            return jsonify(workspace_task(ws, run_distributed_batch_job)(None, items, total, settings, max_jobs))
+        job = jobs.submit('dock_batch', workspace_task(ws, run_distributed_batch_job), items, total, settings, max_jobs,
+                          owner=session['user_id'])
+        return job_response(job)
+    
+    restart = data.get('restart', False)
+    retry_failed = data.get('retry_failed', True)
+    if data.get('wait'):
+        return jsonify(workspace_task(ws, run_checkpointed_batch_job)(None, ws, prot_paths, lig_paths, items, total, max_jobs,
+                                                                      settings, restart, retry_failed))
+    
+    job = jobs.submit('dock_batch', workspace_task(ws, run_checkpointed_batch_job), ws, prot_paths, lig_paths, items, total,
+                      max_jobs, settings, restart, retry_failed, owner=session['user_id'])
+    return job_response(job)
 
 @app.route('/get_fasta', methods=['POST'])
 def get_fasta():
@@ -423,10 +1513,14 @@ def predict_structure():
     fasta = request.form.get('fasta', '').strip()
     uniprot_id = request.form.get('uniprot_id', '').strip()
     protein_name = request.form.get('protein_name', '').strip()
+    try:
+        plddt_cutoff = plddt_cutoff_from(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-    output_pdb = os.path.join(app.config['UPLOAD_FOLDER'], 'protein.pdb')
-    protein_pdbqt = os.path.join(app.config['UPLOAD_FOLDER'], 'protein.pdbqt')
+    ws = get_workspace()
+    output_pdb = os.path.join(ws, 'protein.pdb')
+    protein_pdbqt = os.path.join(ws, 'protein.pdbqt')
     
     if not fasta:
         if not uniprot_id and protein_name:
@@ -444,9 +1538,9 @@ def predict_structure():
         return jsonify({'error': f'Prediction failed: {error}'}), 500
         
     # After prediction, prepare it for docking
-    success, error, cleaned_pdb = protein_prep.prepare_protein(output_pdb, protein_pdbqt)
+    success, error, verification = prepare_protein_in_workspace(output_pdb, protein_pdbqt, ws,
+                                                                plddt_cutoff=plddt_cutoff)
     if success:
-        verification = verify_structures.verify_protein_preparation(cleaned_pdb, protein_pdbqt)
         return jsonify({
             'success': True, 
             'message': 'Structure predicted and prepared successfully',
@@ -457,27 +1551,29 @@ def predict_structure():
 
 @app.route('/prepare_protein', methods=['POST'])
 def prepare_protein():
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-    os.makedirs(app.config['POSES_FOLDER'], exist_ok=True)
-    protein_pdbqt = os.path.join(app.config['UPLOAD_FOLDER'], 'protein.pdbqt')
+    ws = get_workspace()
+    protein_pdbqt = os.path.join(ws, 'protein.pdbqt')
+    try:
+        plddt_cutoff = plddt_cutoff_from(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     if 'file' in request.files and request.files['file'].filename:
         protein_file = request.files['file']
         if not protein_file.filename or not allowed_file(protein_file.filename):
             return jsonify({'error': 'Invalid file format'}), 400
         filename = secure_filename(protein_file.filename)
-        input_pdb = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        input_pdb = os.path.join(ws, filename)
         protein_file.save(input_pdb)
-        success, error, cleaned_pdb = protein_prep.prepare_protein(input_pdb, protein_pdbqt)
+        success, error, verification = prepare_protein_in_workspace(input_pdb, protein_pdbqt, ws, plddt_cutoff=plddt_cutoff)
         if success:
-            verification = verify_structures.verify_protein_preparation(cleaned_pdb, protein_pdbqt)
             return jsonify({'success': True, 'message': 'Protein structure cleaned and prepared successfully', 'verification': verification})
         else:
             return jsonify({'error': f'Protein preparation failed: {error}'}), 500
     
     elif 'uniprot_id' in request.form and request.form['uniprot_id']:
         uniprot_id = request.form['uniprot_id'].strip()
-        raw_pdb = os.path.join(app.config['UPLOAD_FOLDER'], f'raw_{uniprot_id}.pdb')
+        raw_pdb = os.path.join(ws, f'raw_{secure_filename(uniprot_id)}.pdb')
         success, error = protein_prep.fetch_alphafold_structure(uniprot_id, raw_pdb)
         if not success:
             fasta, fasta_error = protein_prep.fetch_uniprot_fasta(uniprot_id)
@@ -487,9 +1583,8 @@ def prepare_protein():
                 return jsonify({'error': f'Structure retrieval failed: {fasta_error}'}), 404
         if not success:
             return jsonify({'error': f'Structure retrieval failed: {error}'}), 404
-        success, error, cleaned_pdb = protein_prep.prepare_protein(raw_pdb, protein_pdbqt)
+        success, error, verification = prepare_protein_in_workspace(raw_pdb, protein_pdbqt, ws, plddt_cutoff=plddt_cutoff)
         if success:
-            verification = verify_structures.verify_protein_preparation(cleaned_pdb, protein_pdbqt)
             return jsonify({'success': True, 'message': 'Structure retrieved and prepared successfully', 'uniprot_id': uniprot_id, 'verification': verification})
         else:
             return jsonify({'error': f'Preparation failed: {error}'}), 500
@@ -499,7 +1594,7 @@ def prepare_protein():
         uniprot_id, full_name, error = protein_prep.search_uniprot_by_name(protein_name, require_alphafold=False)
         if error:
             return jsonify({'error': f'Search failed: {error}'}), 404
-        raw_pdb = os.path.join(app.config['UPLOAD_FOLDER'], f'raw_{uniprot_id}.pdb')
+        raw_pdb = os.path.join(ws, f'raw_{uniprot_id}.pdb')
         success, error = protein_prep.fetch_alphafold_structure(uniprot_id, raw_pdb)
         if not success:
             fasta, fasta_error = protein_prep.fetch_uniprot_fasta(uniprot_id)
@@ -509,9 +1604,8 @@ def prepare_protein():
                 return jsonify({'error': f'Structure retrieval failed: {fasta_error}'}), 404
         if not success:
             return jsonify({'error': f'Structure retrieval failed: {error}'}), 404
-        success, error, cleaned_pdb = protein_prep.prepare_protein(raw_pdb, protein_pdbqt)
+        success, error, verification = prepare_protein_in_workspace(raw_pdb, protein_pdbqt, ws, plddt_cutoff=plddt_cutoff)
         if success:
-            verification = verify_structures.verify_protein_preparation(cleaned_pdb, protein_pdbqt)
             return jsonify({'success': True, 'message': f'Structure for "{full_name}" retrieved and prepared successfully', 'uniprot_id': uniprot_id, 'verification': verification})
         else:
             return jsonify({'error': f'Protein preparation failed: {error}'}), 500
@@ -520,15 +1614,15 @@ def prepare_protein():
 
 @app.route('/prepare_ligand', methods=['POST'])
 def prepare_ligand():
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-    ligand_pdbqt = os.path.join(app.config['UPLOAD_FOLDER'], 'ligand.pdbqt')
+    ws = get_workspace()
+    ligand_pdbqt = os.path.join(ws, 'ligand.pdbqt')
     
     if 'file' in request.files and request.files['file'].filename:
         ligand_file = request.files['file']
         if not ligand_file.filename or not allowed_file(ligand_file.filename):
             return jsonify({'error': 'Invalid file format'}), 400
         filename = secure_filename(ligand_file.filename)
-        input_file = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        input_file = os.path.join(ws, filename)
         ligand_file.save(input_file)
         success, error = ligand_prep.prepare_ligand_from_file(input_file, ligand_pdbqt)
         if success:
@@ -540,9 +1634,11 @@ def prepare_ligand():
     
     elif 'compound_name' in request.form and request.form['compound_name']:
         compound_name = request.form['compound_name'].strip()
-        success, error, smiles, cid, sdf_path = ligand_prep.prepare_ligand_from_name(compound_name, ligand_pdbqt)
+        with workspace.scratch_directory(ws) as scratch:
+            success, error, smiles, cid, sdf_path = ligand_prep.prepare_ligand_from_name(compound_name, ligand_pdbqt, work_dir=scratch)
+            if success:
+                verification = verify_structures.verify_ligand_preparation(ligand_pdbqt, sdf_path)
         if success:
-            verification = verify_structures.verify_ligand_preparation(ligand_pdbqt, sdf_path)
             mol_weight = verify_structures.estimate_molecular_weight(ligand_pdbqt)
             return jsonify({'success': True, 'message': f'Ligand "{compound_name}" generated successfully', 'verification': verification, 'molecular_weight': mol_weight})
         else:
@@ -550,64 +1646,285 @@ def prepare_ligand():
     else:
         return jsonify({'error': 'Please provide either a file or compound name'}), 400
 
+def run_docking_job(job, job_dir, data, ws):
+    """
+    Dock the protein and ligand snapshotted into job_dir and write one complex per pose.
+    
+    Complexes are written next to the inputs in the job's own directory; the
+    raw Smina output and per-pose PDBQT files live in a scratch directory
+    that is removed when the job ends.
+    
+    Returns:
+        dict: {'results': [...]} with one entry per converted pose
+    """
+    protein_pdbqt = os.path.join(job_dir, 'protein.pdbqt')
+    ligand_pdbqt = os.path.join(job_dir, 'ligand.pdbqt')
+    with workspace.scratch_directory(ws) as scratch:
+        results, cached = dock_into_directory(job, protein_pdbqt, ligand_pdbqt, data, job_dir, scratch)
+    with open(os.path.join(ws, 'results.json'), 'w') as f:
+        json.dump(results, f)
+    return {'results': results, 'cached': cached}
+
+def dock_into_directory(job, protein_pdbqt, ligand_pdbqt, data, output_dir, scratch):
+    """
+    Run Smina for one receptor/ligand pair and register a complex PDB per pose.
+    
+    Each pose is converted on its own; complexes reference the receptor PDB,
+    which is written once, and are assembled when a client requests them.
+    
+    Returns:
+        tuple: (results, cache_hit)
+    """
+    output_file = os.path.join(scratch, 'all_poses.pdbqt')
+    grid_mode = data.get('grid_mode', 'manual')
+    if grid_mode == 'manual':
+        center = (data.get('center_x', 0), data.get('center_y', 0), data.get('center_z', 0))
+        size = (data.get('size_x', 25), data.get('size_y', 25), data.get('size_z', 25))
+    elif grid_mode in ('pocket', 'fixed'):
+        center, size = compute_docking_box(protein_pdbqt, grid_mode, data.get('pocket_index', 0))
+    else:
+        center, size = compute_docking_box(protein_pdbqt, 'auto')
+    settings = {
+        'center': center,
+        'size': size,
+        'exhaustiveness': 8,
+        'num_modes': 9,
+        'seed': data.get('seed', app.config['DOCKING_SEED']),
+        'verbosity': 1,
+        'timeout': 300,
+        'trim_margin': data['trim_margin']
+    }
+    try:
+        success, error, cached = smina_dock(protein_pdbqt, ligand_pdbqt, output_file, settings, job=job)
+    except subprocess.TimeoutExpired:
+        raise Exception('Docking timeout')
+    if not success:
+        raise Exception(f'Docking failed: {error}')
+    affinities = parse_vina_results(output_file)
+    if not affinities:
+        raise Exception('No docking results found')
+    # Near-identical poses are collapsed; only each cluster's best pose is converted
+    models, clusters = pose_clustering.dedupe_poses(output_file, data['rmsd_threshold'])
+    clusters = [members for members in clusters if members[0] < len(affinities)]
+    if job is not None:
+        job.set_total(len(clusters))
+    fingerprints = None
+    if clusters and data.get('interactions', app.config['INTERACTIONS']):
+        fingerprints = pose_interactions(protein_pdbqt, [models[members[0]] for members in clusters])
+    receptor_pdb = complex_store.receptor_pdb(protein_pdbqt)
+    results = []
+    for n, members in enumerate(clusters):
+        i = members[0] + 1
+        pose_file = os.path.join(scratch, f'pose_{i}.pdbqt')
+        pose_pdb = os.path.join(output_dir, f'pose_{i}.pdb')
+        complex_pdb = os.path.join(output_dir, f'complex_{i}.pdb')
+        pose_clustering.write_models(models, [members[0]], pose_file)
+        if convert_pdbqt_to_pdb(pose_file, pose_pdb):
+            complex_store.save_complex(complex_pdb, receptor_pdb, pose_pdb)
+            entry = {'pose': i, 'affinity': affinities[members[0]], 'cluster_size': len(members),
+                     'path': data_url_path(complex_pdb)}
+            if fingerprints:
+                entry['interactions'] = fingerprints[n]
+            results.append(entry)
+        if job is not None:
+            job.advance()
+    return results, cached
+
 @app.route('/dock', methods=['POST'])
 def run_docking():
     if 'user_id' not in session:
         return jsonify({'error': 'Authentication required'}), 401
-    protein_pdbqt = os.path.join(app.config['UPLOAD_FOLDER'], 'protein.pdbqt')
-    ligand_pdbqt = os.path.join(app.config['UPLOAD_FOLDER'], 'ligand.pdbqt')
+    ws = get_workspace()
+    protein_pdbqt = os.path.join(ws, 'protein.pdbqt')
+    ligand_pdbqt = os.path.join(ws, 'ligand.pdbqt')
     if not os.path.exists(protein_pdbqt) or not os.path.exists(ligand_pdbqt):
         return jsonify({'error': 'Please upload files first'}), 400
-    for f in os.listdir(app.config['POSES_FOLDER']):
-        os.remove(os.path.join(app.config['POSES_FOLDER'], f))
-    output_file = os.path.join(app.config['UPLOAD_FOLDER'], 'all_poses.pdbqt')
-    smina_cmd = get_smina_command()
-    cmd = [smina_cmd, '--receptor', protein_pdbqt, '--ligand', ligand_pdbqt, '--num_modes', '9', '--exhaustiveness', '8', '--out', output_file, '--verbosity', '1']
     data = request.get_json() if request.is_json else {}
-    grid_mode = data.get('grid_mode', 'manual')
-    if grid_mode == 'manual':
-        cmd.extend(['--center_x', str(data.get('center_x', 0)), '--center_y', str(data.get('center_y', 0)), '--center_z', str(data.get('center_z', 0)), '--size_x', str(data.get('size_x', 25)), '--size_y', str(data.get('size_y', 25)), '--size_z', str(data.get('size_z', 25))])
-    else:
-        cmd.extend(['--center_x', '0', '--center_y', '0', '--center_z', '0', '--size_x', '30', '--size_y', '30', '--size_z', '30'])
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-        if result.returncode != 0:
-            return jsonify({'error': f'Docking failed: {result.stderr}'}), 500
-        affinities = parse_vina_results(output_file)
-        if not affinities:
-            return jsonify({'error': 'No docking results found'}), 500
-        pose_files = split_poses(output_file, app.config['POSES_FOLDER'])
-        results = []
-        for i, (pose_file, affinity) in enumerate(zip(pose_files, affinities), 1):
-            complex_pdbqt = os.path.join(app.config['POSES_FOLDER'], f'complex_{i}.pdbqt')
-            complex_pdb = os.path.join(app.config['POSES_FOLDER'], f'complex_{i}.pdb')
-            if combine_protein_ligand(protein_pdbqt, pose_file, complex_pdbqt):
-                if convert_pdbqt_to_pdb(complex_pdbqt, complex_pdb):
-                    results.append({'pose': i, 'affinity': affinity, 'path': f'data/poses/complex_{i}.pdb'})
-        with open(os.path.join(app.config['UPLOAD_FOLDER'], 'results.json'), 'w') as f:
-            json.dump(results, f)
-        return jsonify({'results': results})
-    except subprocess.TimeoutExpired:
-        return jsonify({'error': 'Docking timeout'}), 500
+        data = {**data, 'rmsd_threshold': rmsd_threshold_from(data), 'trim_margin': trim_margin_from(data)}
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    # Snapshot the inputs so re-preparing the session's structures cannot affect a queued job
+    job_dir = workspace.job_directory(ws, workspace.new_workspace_id())
+    shutil.copyfile(protein_pdbqt, os.path.join(job_dir, 'protein.pdbqt'))
+    shutil.copyfile(ligand_pdbqt, os.path.join(job_dir, 'ligand.pdbqt'))
+    if data.get('wait'):
+        try:
+            return jsonify(workspace_task(ws, run_docking_job)(None, job_dir, data, ws))
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+    
+    job = jobs.submit('dock', workspace_task(ws, run_docking_job), job_dir, data, ws, owner=session['user_id'])
+    return job_response(job)
+
+@app.route('/detect_pockets', methods=['POST'])
+def detect_pockets():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Authentication required'}), 401
+    data = request.get_json() if request.is_json else {}
+    protein_pdbqt = os.path.join(get_workspace(), secure_filename(data.get('protein', 'protein.pdbqt')))
+    if not os.path.exists(protein_pdbqt):
+        return jsonify({'error': 'Please upload a protein first'}), 400
+    try:
+        pockets = docking_box.detect_pockets(protein_pdbqt, top_n=int(data.get('top_n', 3)))
+        return jsonify({
+            'success': True,
+            'receptor_box': docking_box.receptor_box(protein_pdbqt),
+            'pockets': pockets
+        })
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return jsonify({'error': f'Pocket detection failed: {str(e)}'}), 500
+
+def get_user_job(job_id):
+    job = jobs.get(job_id)
+    if job is None or job.owner != session.get('user_id'):
+        return None
+    return job
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = get_user_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = get_user_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.status == job_queue.FAILED:
+        return jsonify({'error': job.error, 'status': job.status}), 500
+    if job.status == job_queue.CANCELLED:
+        return jsonify({'error': 'Job was cancelled', 'status': job.status, **(job.result or {})}), 410
+    if job.status != job_queue.DONE:
+        return jsonify(job.to_dict()), 202
+    return jsonify(job.result)
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = get_user_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if not jobs.cancel(job_id):
+        return jsonify({'error': f'Job already {job.status}'}), 409
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'cancelling'})
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        'docking': docking_cache.stats() if docking_cache is not None else None,
+        'receptors': receptor_cache.stats() if receptor_cache is not None else None,
+        'lookups': lookups.stats() if lookups is not None else None
+    })
 
 @app.route('/results', methods=['GET'])
 def get_results():
-    results_file = os.path.join(app.config['UPLOAD_FOLDER'], 'results.json')
+    results_file = os.path.join(get_workspace(), 'results.json')
     if not os.path.exists(results_file):
         return jsonify({'error': 'No results available'}), 404
     with open(results_file, 'r') as f:
         results = json.load(f)
     return jsonify({'results': results})
 
+# Job directories are never rewritten, so their files can be cached for good;
+# everything else is revalidated against its ETag
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'private, no-cache'
+
+def gzip_sibling(path):
+    """
+    Gzip copy of path stored next to it as path + '.gz'.
+    
+    The copy is written on first use and rewritten when path is newer.
+    """
+    gz_path = path + '.gz'
+    try:
+        if os.path.getmtime(gz_path) >= os.path.getmtime(path):
+            return gz_path
+    except OSError:
+        pass
+    tmp_path = f'{gz_path}.{workspace.new_workspace_id()}.tmp'
+    try:
+        with open(path, 'rb') as src, open(tmp_path, 'wb') as raw, \
+                gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6, mtime=0) as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, gz_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return gz_path
+
+def send_structure(folder, filename):
+    """
+    Serve a structure file with compression and HTTP caching.
+    
+    Lazily stored complexes are assembled on request. Responses carry a
+    strong ETag from the content hash (suffixed for the gzip encoding) and
+    answer If-None-Match with 304. Clients that accept gzip get a
+    precompressed copy.
+    """
+    path = safe_join(folder, filename)
+    if path is None:
+        return send_from_directory(folder, filename)
+    
+    use_gzip = request.accept_encodings.best_match(['gzip', 'identity']) == 'gzip'
+    mimetype = 'chemical/x-pdb' if filename.endswith('.pdb') else None
+    
+    if os.path.isfile(path):
+        etag = file_digest(path)
+        body_path = path
+        if use_gzip and os.path.getsize(path) > 1024:
+            body_path = gzip_sibling(path)
+            etag += '-gzip'
+        else:
+            use_gzip = False
+        response = send_file(body_path, mimetype=mimetype or mimetypes.guess_type(path)[0],
+                             download_name=os.path.basename(path), etag=etag, conditional=True, max_age=None)
+    else:
+        complex_entry = complex_cache.get(path)
+        if complex_entry is None:
+            return send_from_directory(folder, filename)
+        body = complex_entry.gzipped() if use_gzip else complex_entry.data
+        response = Response(body, mimetype=mimetype)
+        response.set_etag(complex_entry.etag + ('-gzip' if use_gzip else ''))
+        response.make_conditional(request)
+    
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    immutable = '/jobs/' in '/' + filename.replace(os.sep, '/')
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+    return response
+
 @app.route('/data/poses/<filename>')
 def serve_pose(filename):
-    return send_from_directory(app.config['POSES_FOLDER'], filename)
+    return send_structure(app.config['POSES_FOLDER'], filename)
+
+def session_may_read(filename):
+    """
+    Whether the current session may download a file of the data folder.
+    
+    Only files inside the session's own workspace are served, and not its
+    scratch files or the listings, locks and uploads of its libraries;
+    caches and anything else in the data folder never are.
+    """
+    if 'workspace' not in session:
+        return False
+    parts = posixpath.normpath(filename.replace('\\', '/')).split('/')
+    if len(parts) < 3 or parts[:2] != [workspace.SESSIONS_DIR, session['workspace']]:
+        return False
+    if parts[2] == workspace.SCRATCH_DIR:
+        return False
+    if parts[2] == ligand_library.LIBRARIES_DIR and len(parts) < 5:
+        return False
+    return True
 
-@app.route('/data/<filename>')
+@app.route('/data/<path:filename>')
 def serve_data(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    if not session_may_read(filename):
+        return jsonify({'error': 'File not found'}), 404
+    return send_structure(app.config['UPLOAD_FOLDER'], filename)
 
 if __name__ == '__main__':
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -0,0 +1,103 @@
+import numpy as np
+
+HYDROGEN_TYPES = {'H', 'HD', 'HS'}
+
+# AutoDock 4 atom types whose element is not simply the type name
+AD4_ELEMENTS = {
+    'A': 'C', 'NA': 'N', 'NS': 'N', 'OA': 'O', 'OS': 'O', 'SA': 'S',
+    'HD': 'H', 'HS': 'H', 'CL': 'Cl', 'BR': 'Br', 'FE': 'Fe', 'ZN': 'Zn',
+    'MG': 'Mg', 'MN': 'Mn', 'CA': 'Ca', 'W': 'O',
+    'G0': 'C', 'G1': 'C', 'G2': 'C', 'G3': 'C',
+    'CG0': 'C', 'CG1': 'C', 'CG2': 'C', 'CG3': 'C'
+}
+
+# PDBQT records that describe the torsion tree and have no PDB equivalent
+TORSION_TREE_RECORDS = ('ROOT', 'ENDROOT', 'BRANCH', 'ENDBRANCH', 'TORSDOF', 'USER')
+
+
+def iter_atom_lines(path):
+    """Yield the ATOM/HETATM records of a PDB or PDBQT file"""
+    with open(path, 'r') as f:
+        for line in f:
+            if line.startswith('ATOM') or line.startswith('HETATM'):
+                yield line
+
+
+def atom_type(line):
+    """AutoDock atom type of a PDBQT record (columns 78-79)"""
+    return line[77:79].strip()
+
+
+def coordinates_from_lines(lines):
+    """
+    Extract coordinates from ATOM/HETATM records.
+
+    Returns:
+        numpy.ndarray: (N, 3) float array
+    """
+    if not lines:
+        return np.zeros((0, 3))
+    return np.array([(line[30:38], line[38:46], line[46:54]) for line in lines],
+                    dtype=float)
+
+
+def read_coordinates(path, heavy_only=False):
+    """
+    Read atom coordinates from a PDB or PDBQT file.
+
+    Args:
+        path: Path to the structure file
+        heavy_only: Skip hydrogens (default: False)
+
+    Returns:
+        numpy.ndarray: (N, 3) float array
+    """
+    lines = list(iter_atom_lines(path))
+    if heavy_only:
+        lines = [line for line in lines if atom_type(line) not in HYDROGEN_TYPES]
+    return coordinates_from_lines(lines)
+
+
+def element_for_type(ad_type):
+    """Element symbol for an AutoDock atom type"""
+    element = AD4_ELEMENTS.get(ad_type.upper())
+    if element:
+        return element
+    letters = ''.join(c for c in ad_type if c.isalpha())[:2]
+    return letters.capitalize() if letters else 'C'
+
+
+def pdb_atom_line(line):
+    """
+    Rewrite a PDBQT ATOM/HETATM record as a PDB record.
+
+    Columns 1-66 (names, residue, coordinates, occupancy, B-factor) are kept,
+    the partial charge and AutoDock type are replaced by the element symbol.
+    """
+    element = element_for_type(atom_type(line))
+    prefix = line[:66].rstrip('\n').ljust(66)
+    return f"{prefix}{'':10}{element:>2}\n"
+
+
+def write_pdb(pdbqt_file, pdb_file):
+    """
+    Convert a PDBQT file to PDB line by line.
+
+    Atom records get element symbols in place of AutoDock types and charges;
+    torsion tree records are dropped; MODEL/ENDMDL, TER, END and REMARK
+    records are copied.
+
+    Returns:
+        int: Number of atom records written
+    """
+    atoms = 0
+    with open(pdbqt_file, 'r') as src, open(pdb_file, 'w') as out:
+        for line in src:
+            if line.startswith(('ATOM', 'HETATM')):
+                out.write(pdb_atom_line(line))
+                atoms += 1
+            elif line.startswith(TORSION_TREE_RECORDS) or not line.strip():
+                continue
+            else:
+                out.write(line if line.endswith('\n') else line + '\n')
+    return atoms
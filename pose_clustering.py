@@ -0,0 +1,144 @@
+import numpy as np
+
+import pdbqt_io
+
+
+def read_models(path):
+    """
+    Split a multi-model PDB/PDBQT file into its models.
+
+    Returns:
+        list: One list of lines per MODEL block (the whole file if it has none)
+    """
+    models = []
+    current = None
+    with open(path, 'r') as f:
+        for line in f:
+            if line.startswith('MODEL'):
+                current = [line]
+                models.append(current)
+            elif current is not None:
+                current.append(line)
+                if line.startswith('ENDMDL'):
+                    current = None
+            elif line.startswith(('ATOM', 'HETATM')):
+                if not models:
+                    models.append([])
+                models[-1].append(line)
+    return models
+
+
+def model_coordinates(lines, heavy_only=True):
+    """(N, 3) coordinates of the atoms in one model"""
+    atoms = [line for line in lines if line.startswith(('ATOM', 'HETATM'))]
+    if heavy_only:
+        atoms = [line for line in atoms if pdbqt_io.atom_type(line) not in pdbqt_io.HYDROGEN_TYPES]
+    return pdbqt_io.coordinates_from_lines(atoms)
+
+
+def pairwise_rmsd(coords):
+    """
+    RMSD between every pair of poses, without superposition.
+
+    Poses of one docking run share the receptor frame, so the plain
+    coordinate RMSD is the meaningful distance. Computed from the Gram
+    matrix of the flattened poses, so memory grows with the number of poses
+    squared rather than poses squared times atoms.
+
+    Args:
+        coords: (n_poses, n_atoms, 3) array with atoms in the same order
+
+    Returns:
+        numpy.ndarray: (n_poses, n_poses) RMSD matrix in Angstrom
+    """
+    coords = np.asarray(coords, dtype=float)
+    n_poses, n_atoms = coords.shape[:2]
+    flat = coords.reshape(n_poses, -1)
+    sq = np.einsum('ij,ij->i', flat, flat)
+    d2 = sq[:, None] + sq[None, :] - 2.0 * flat @ flat.T
+    np.maximum(d2, 0.0, out=d2)
+    np.fill_diagonal(d2, 0.0)
+    return np.sqrt(d2 / max(n_atoms, 1))
+
+
+def leader_clusters(rmsd, threshold, order=None):
+    """
+    Greedy clustering: the best remaining pose absorbs every pose within threshold.
+
+    Args:
+        rmsd: (n, n) distance matrix
+        threshold: Poses closer than this (Angstrom) collapse into one
+        order: Pose indices best first (default: input order, as smina ranks them)
+
+    Returns:
+        list: Clusters as lists of pose indices, representative first
+    """
+    n = rmsd.shape[0]
+    order = np.arange(n) if order is None else np.asarray(order)
+    rank = {p: r for r, p in enumerate(order.tolist())}
+    assigned = np.zeros(n, dtype=bool)
+    clusters = []
+    for i in order:
+        if assigned[i]:
+            continue
+        members = np.flatnonzero((rmsd[i] < threshold) & ~assigned)
+        assigned[members] = True
+        # Members in ranking order, so the representative comes first
+        clusters.append(sorted(members.tolist(), key=rank.__getitem__))
+    return clusters
+
+
+def cluster_structures(coord_list, threshold, scores=None):
+    """
+    Cluster poses that may not all describe the same molecule.
+
+    Poses are grouped by atom count, since RMSD is only defined between
+    poses with matching atoms, and each group is clustered with
+    leader_clusters.
+
+    Args:
+        coord_list: List of (n_atoms, 3) arrays
+        threshold: RMSD cut-off in Angstrom
+        scores: Optional score per pose, lower is better
+
+    Returns:
+        list: Clusters as lists of indices into coord_list, best cluster first
+    """
+    if scores is None:
+        scores = list(range(len(coord_list)))
+    by_size = {}
+    for i, coords in enumerate(coord_list):
+        by_size.setdefault(len(coords), []).append(i)
+
+    clusters = []
+    for indices in by_size.values():
+        stacked = np.stack([coord_list[i] for i in indices])
+        order = sorted(range(len(indices)), key=lambda k: scores[indices[k]])
+        for members in leader_clusters(pairwise_rmsd(stacked), threshold, order):
+            clusters.append([indices[k] for k in members])
+    clusters.sort(key=lambda members: scores[members[0]])
+    return clusters
+
+
+def dedupe_poses(path, threshold):
+    """
+    Collapse near-identical poses in a docking output file.
+
+    Returns:
+        tuple: (models, clusters) where models are the file's MODEL blocks and
+               clusters lists pose indices per cluster, representative first,
+               in smina's ranking order
+    """
+    models = read_models(path)
+    if threshold <= 0 or len(models) < 2:
+        return models, [[i] for i in range(len(models))]
+    coords = [model_coordinates(lines) for lines in models]
+    return models, cluster_structures(coords, threshold)
+
+
+def write_models(models, indices, path):
+    """Write the selected models to path, renumbered from 1"""
+    with open(path, 'w') as out:
+        for number, i in enumerate(indices, 1):
+            for line in models[i]:
+                out.write(f'MODEL {number}\n' if line.startswith('MODEL') else line)
@@ -1,9 +1,15 @@
 import os
+import re
+import hashlib
 import requests
 from Bio.PDB.PDBParser import PDBParser
 from Bio.PDB.MMCIFParser import MMCIFParser
 from Bio.PDB.PDBIO import PDBIO, Select
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import conversion_engine
+import http_client
+import lookup_cache
+import receptor_trim
 
 
 def detect_file_format(file_path):
@@ -59,10 +65,15 @@ def fetch_uniprot_fasta(uniprot_id):
     Returns:
         tuple: (fasta_sequence, error_message)
     """
+    return lookup_cache.lookup('uniprot_fasta', [uniprot_id.strip().upper()],
+                               lambda: _fetch_uniprot_fasta(uniprot_id))
+
+
+def _fetch_uniprot_fasta(uniprot_id):
     url = f"https://rest.uniprot.org/uniprotkb/{uniprot_id}.fasta"
 
     try:
-        response = requests.get(url, timeout=10)
+        response = http_client.get(url, timeout=10)
 
         if response.status_code == 200:
             return response.text, None
@@ -74,11 +85,62 @@ def fetch_uniprot_fasta(uniprot_id):
         return None, f"Failed to fetch molecular sequence: {str(e)}"
 
 
+# Resolved names, checked before the disk cache: (name, require_alphafold) -> [id, full name]
+SEARCH_MEMO_SIZE = 4096
+_search_memo = {}
+# AlphaFold availability per accession, filled from definite (200/404) answers only
+_alphafold_models = {}
+
+
 def search_uniprot_by_name(protein_name, require_alphafold=False):
     """
     Search protein database for a protein by name and get the first result's ID.
     Prioritizes reviewed entries and human proteins.
     """
+    memo_key = (protein_name.strip().lower(), bool(require_alphafold))
+    found = _search_memo.get(memo_key)
+    if found is None:
+        found, error = lookup_cache.lookup(
+            'uniprot_search', list(memo_key),
+            lambda: _search_uniprot_by_name(protein_name, require_alphafold))
+        if error:
+            return None, None, error
+        if len(_search_memo) >= SEARCH_MEMO_SIZE:
+            _search_memo.pop(next(iter(_search_memo)), None)
+        _search_memo[memo_key] = found
+    return found[0], found[1], None
+
+
+def _query_uniprot(query):
+    """Results of one UniProt search, or None if the request failed"""
+    url = f"https://rest.uniprot.org/uniprotkb/search?query={query}&format=json&size=5"
+    try:
+        response = http_client.get(url, timeout=10)
+        if response.status_code == 200:
+            return response.json().get('results', [])
+    except Exception:
+        pass
+    return None
+
+
+def _alphafold_has_model(uniprot_id):
+    if uniprot_id in _alphafold_models:
+        return _alphafold_models[uniprot_id]
+    af_check_url = f"https://alphafold.ebi.ac.uk/files/AF-{uniprot_id}-F1-model_v4.pdb"
+    try:
+        af_response = http_client.head(af_check_url, timeout=5)
+    except Exception:
+        return False
+    if af_response.status_code in (200, 404):
+        _alphafold_models[uniprot_id] = af_response.status_code == 200
+    return af_response.status_code == 200
+
+
+def _entry_name(entry, default):
+    return entry.get('proteinDescription', {}).get('recommendedName', {}).get('fullName', {}).get('value', default)
+
+
+def _search_uniprot_by_name(protein_name, require_alphafold):
     queries = [
         f"(protein_name:{protein_name}) AND (reviewed:true) AND (organism_id:9606)",
         f"(protein_name:{protein_name}) AND (reviewed:true)",
@@ -86,45 +148,30 @@ def search_uniprot_by_name(protein_name, require_alphafold=False):
         f"protein_name:{protein_name}"
     ]
 
-    for query in queries:
-        url = f"https://rest.uniprot.org/uniprotkb/search?query={query}&format=json&size=5"
-
-        try:
-            response = requests.get(url, timeout=10)
-
-            if response.status_code == 200:
-                data = response.json()
-                results = data.get('results', [])
-
-                if results:
-                    if require_alphafold:
-                        for entry in results:
-                            uniprot_id = entry.get('primaryAccession')
-                            protein_full_name = entry.get(
-                                'proteinDescription',
-                                {}).get('recommendedName',
-                                        {}).get('fullName',
-                                                {}).get('value', protein_name)
-
-                            af_check_url = f"https://alphafold.ebi.ac.uk/files/AF-{uniprot_id}-F1-model_v4.pdb"
-                            af_response = requests.head(af_check_url,
-                                                        timeout=5)
-
-                            if af_response.status_code == 200:
-                                return uniprot_id, protein_full_name, None
-
-                    entry = results[0]
-                    uniprot_id = entry.get('primaryAccession')
-                    protein_full_name = entry.get(
-                        'proteinDescription',
-                        {}).get('recommendedName',
-                                {}).get('fullName',
-                                        {}).get('value', protein_name)
-                    return uniprot_id, protein_full_name, None
-        except Exception:
-            continue
+    # All queries (and later the AlphaFold checks) are sent at once; answers
+    # are then read in priority order, so the first usable one decides
+    executor = ThreadPoolExecutor(max_workers=len(queries) + 5)
+    try:
+        searches = [executor.submit(_query_uniprot, query) for query in queries]
+        for search in searches:
+            results = search.result()
+            if not results:
+                continue
+
+            if require_alphafold:
+                checks = [executor.submit(_alphafold_has_model, entry.get('primaryAccession'))
+                          for entry in results]
+                for entry, check in zip(results, checks):
+                    if check.result():
+                        return [entry.get('primaryAccession'), _entry_name(entry, protein_name)], None
 
-    return None, None, f"No results found for protein name '{protein_name}'"
+            entry = results[0]
+            return [entry.get('primaryAccession'), _entry_name(entry, protein_name)], None
+    finally:
+        # Lower-priority requests still in flight are no longer needed
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return None, f"No results found for protein name '{protein_name}'"
 
 
 def predict_structure_esmfold(fasta_sequence, output_path):
@@ -141,54 +188,181 @@ def predict_structure_esmfold(fasta_sequence, output_path):
     if len(sequence) < 10:
         return False, "Sequence too short. Minimum 10 amino acids required."
 
+    # ESMFold API expects raw sequence string without newlines or headers
+    clean_sequence = "".join(sequence.split())
+    sequence_hash = hashlib.sha256(clean_sequence.upper().encode('ascii', 'ignore')).hexdigest()
+    pdb_content, error = lookup_cache.lookup('esmfold', [sequence_hash],
+                                             lambda: _fold_sequence(clean_sequence))
+    if error:
+        return False, error
+
+    with open(output_path, 'w') as f:
+        f.write(pdb_content)
+    return True, None
+
+
+def _fold_sequence(clean_sequence):
     api_url = "https://api.esmatlas.com/foldSequence/v1/pdb/"
 
     try:
-        # ESMFold API expects raw sequence string without newlines or headers
-        clean_sequence = "".join(sequence.split())
-        response = requests.post(api_url, data=clean_sequence, timeout=120)
+        response = http_client.post(api_url, data=clean_sequence, timeout=120)
 
         if response.status_code == 200:
             pdb_content = response.text
 
             if len(pdb_content) < 100:
-                return False, "Database returned invalid structure data"
-
-            with open(output_path, 'w') as f:
-                f.write(pdb_content)
+                return None, "Database returned invalid structure data"
 
-            return True, None
+            return pdb_content, None
         elif response.status_code == 400:
-            return False, "Invalid sequence format"
+            return None, "Invalid sequence format"
         elif response.status_code == 503:
-            return False, "Structural prediction service temporarily unavailable. Please try again."
+            return None, "Structural prediction service temporarily unavailable. Please try again."
         else:
-            return False, f"Structural database error: HTTP {response.status_code}"
+            return None, f"Structural database error: HTTP {response.status_code}"
     except requests.Timeout:
-        return False, "Structure prediction timed out. Try a shorter sequence."
+        return None, "Structure prediction timed out. Try a shorter sequence."
     except Exception as e:
-        return False, f"Failed to predict structure: {str(e)}"
+        return None, f"Failed to predict structure: {str(e)}"
 
 
 def fetch_alphafold_structure(uniprot_id, output_path):
     """
     Download predicted structure from structural database.
     """
+    content, error = lookup_cache.lookup('alphafold', [uniprot_id.strip().upper()],
+                                         lambda: _download_alphafold(uniprot_id))
+    if error:
+        return False, error
+
+    with open(output_path, 'wb') as f:
+        f.write(content)
+    return True, None
+
+
+def _download_alphafold(uniprot_id):
     pdb_url = f"https://alphafold.ebi.ac.uk/files/AF-{uniprot_id}-F1-model_v4.pdb"
 
     try:
-        response = requests.get(pdb_url, timeout=30)
+        response = http_client.get(pdb_url, timeout=30)
 
         if response.status_code == 200:
-            with open(output_path, 'wb') as f:
-                f.write(response.content)
-            return True, None
+            return response.content, None
         elif response.status_code == 404:
-            return False, f"No pre-computed structure available for {uniprot_id}"
+            return None, f"No pre-computed structure available for {uniprot_id}"
         else:
-            return False, f"Structural database error: HTTP {response.status_code}"
+            return None, f"Structural database error: HTTP {response.status_code}"
     except Exception as e:
-        return False, f"Failed to download structure: {str(e)}"
+        return None, f"Failed to download structure: {str(e)}"
+
+
+WATER_RESIDUES = {'HOH', 'WAT', 'H2O', 'TIP', 'TIP3', 'SOL', 'DOD'}
+STANDARD_RESIDUES = {
+    'ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'GLN', 'GLU', 'GLY', 'HIS', 'ILE',
+    'LEU', 'LYS', 'MET', 'PHE', 'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL',
+    'SEC', 'PYL', 'ASX', 'GLX', 'UNK'
+}
+
+# A quoted mmCIF value ends at a quote followed by whitespace, so "O5'" stays one token
+_CIF_TOKEN = re.compile(r"""'(.*?)'(?=\s|$)|"(.*?)"(?=\s|$)|(\S+)""")
+
+
+def _cif_tokens(line):
+    if "'" not in line and '"' not in line:
+        return line.split()
+    return [next(group for group in match.groups() if group is not None)
+            for match in _CIF_TOKEN.finditer(line)]
+
+
+def _pdb_atom_record(record, serial, name, altloc, res_name, chain_id, res_seq, icode,
+                     x, y, z, occupancy, b_factor, element, charge):
+    """One fixed-column PDB ATOM/HETATM line"""
+    # Atom names start in column 14 unless they fill all four columns or have a two-letter element
+    name_field = f" {name:<3}" if len(name) < 4 and len(element) < 2 else f"{name:<4}"
+    return (f"{record:<6}{serial % 100000:>5} {name_field}{altloc:1}{res_name:>3} {chain_id[:1]:1}"
+            f"{res_seq:>4}{icode:1}   {x:8.3f}{y:8.3f}{z:8.3f}{occupancy:6.2f}{b_factor:6.2f}"
+            f"          {element:>2}{charge:2}\n")
+
+
+def _cif_value(row, columns, *names, default=''):
+    for name in names:
+        i = columns.get(name)
+        if i is not None and row[i] not in ('?', '.'):
+            return row[i]
+    return default
+
+
+def _mmcif_atom_sites(lines):
+    """
+    Stream the _atom_site loop of an mmCIF file as PDB fields.
+
+    Only the first model is read. Author chain and residue numbering are
+    used, as in PDB files.
+
+    Yields:
+        tuple: (record, name, altloc, res_name, chain_id, res_seq, icode,
+                x, y, z, occupancy, b_factor, element, charge)
+    """
+    columns = None
+    in_header = False
+    first_model = None
+    pending = []
+    for line in lines:
+        stripped = line.strip()
+        if stripped == 'loop_':
+            if columns is not None and not in_header:
+                return
+            in_header = True
+            columns = None
+            continue
+        if in_header and stripped.startswith('_'):
+            if stripped.startswith('_atom_site.'):
+                columns = columns or {}
+                columns[stripped.split()[0][len('_atom_site.'):]] = len(columns)
+                continue
+            if columns is None:
+                continue
+        if columns is None:
+            in_header = False
+            continue
+        in_header = False
+        if not stripped or stripped.startswith(('#', '_', 'data_')):
+            return
+
+        # A row may be wrapped over several lines
+        pending.extend(_cif_tokens(stripped))
+        if len(pending) < len(columns):
+            continue
+        row, pending = pending, []
+
+        model = _cif_value(row, columns, 'pdbx_PDB_model_num', default='1')
+        if first_model is None:
+            first_model = model
+        elif model != first_model:
+            return
+
+        res_seq = _cif_value(row, columns, 'auth_seq_id', 'label_seq_id', default='0')
+        charge = _cif_value(row, columns, 'pdbx_formal_charge', default='0').lstrip('+')
+        if charge in ('', '0'):
+            charge = ''
+        elif charge.startswith('-'):
+            charge = charge[1:] + '-'
+        else:
+            charge = charge + '+'
+        yield (_cif_value(row, columns, 'group_PDB', default='ATOM'),
+               _cif_value(row, columns, 'auth_atom_id', 'label_atom_id'),
+               _cif_value(row, columns, 'label_alt_id'),
+               _cif_value(row, columns, 'auth_comp_id', 'label_comp_id'),
+               _cif_value(row, columns, 'auth_asym_id', 'label_asym_id'),
+               res_seq[-4:],
+               _cif_value(row, columns, 'pdbx_PDB_ins_code'),
+               float(_cif_value(row, columns, 'Cartn_x')),
+               float(_cif_value(row, columns, 'Cartn_y')),
+               float(_cif_value(row, columns, 'Cartn_z')),
+               float(_cif_value(row, columns, 'occupancy', default='1')),
+               float(_cif_value(row, columns, 'B_iso_or_equiv', default='0')),
+               _cif_value(row, columns, 'type_symbol').upper(),
+               charge)
 
 
 def clean_protein_structure_text_based(input_pdb,
@@ -197,70 +371,62 @@ def clean_protein_structure_text_based(input_pdb,
                                        remove_water=True,
                                        remove_hetero=True):
     """
-    Text-based PDB cleaner as fallback when BioPython fails.
-    Handles malformed PDB files that BioPython cannot parse.
+    Streaming line-based cleaner for PDB and mmCIF files.
+    
+    Reads the input once and writes every kept atom as it goes, so memory
+    use does not grow with structure size. mmCIF _atom_site records are
+    rewritten as PDB ATOM/HETATM lines (first model only). Also handles
+    malformed PDB files that BioPython cannot parse.
     
     Args:
-        input_pdb: Path to input PDB file
+        input_pdb: Path to input PDB or mmCIF file
         output_pdb: Path to output cleaned PDB file
         keep_chain: Chain to keep (default: 'A', set to None to keep all chains)
         remove_water: Remove water molecules (default: True)
-        remove_hetero: Remove all heteroatoms including ligands (default: True)
+        remove_hetero: Remove HETATM records such as ligands and ions, and
+                       ATOM records of non-standard residues (default: True)
     
     Returns:
         tuple: (success, error_message)
     """
-    standard_residues = {
-        'ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'GLN', 'GLU', 'GLY', 'HIS', 'ILE',
-        'LEU', 'LYS', 'MET', 'PHE', 'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL',
-        'SEC', 'PYL', 'ASX', 'GLX', 'UNK'
-    }
-    water_residues = {'HOH', 'WAT', 'H2O', 'TIP', 'TIP3', 'SOL'}
+    def keep(record, res_name, chain_id):
+        if keep_chain and chain_id and chain_id != keep_chain:
+            return False
+        if remove_water and res_name in WATER_RESIDUES:
+            return False
+        return not (remove_hetero and (record == 'HETATM' or res_name not in STANDARD_RESIDUES))
 
     try:
-        cleaned_lines = []
         atom_count = 0
-
-        with open(input_pdb, 'r') as f:
-            for line in f:
-                if line.startswith('ATOM') or line.startswith('HETATM'):
-                    if len(line) < 26:
-                        continue
-
-                    chain_id = line[21:22].strip() if len(line) > 21 else ''
-                    res_name = line[17:20].strip() if len(line) > 19 else ''
-
-                    if keep_chain and chain_id and chain_id != keep_chain:
-                        continue
-
-                    if remove_water and res_name in water_residues:
-                        continue
-
-                    if remove_hetero:
-                        if line.startswith('HETATM'):
+        last_line = ''
+
+        with open(input_pdb, 'r') as f, open(output_pdb, 'w') as out:
+            if detect_file_format(input_pdb) == 'mmcif':
+                for fields in _mmcif_atom_sites(f):
+                    if keep(fields[0], fields[3], fields[4]):
+                        atom_count += 1
+                        last_line = _pdb_atom_record(fields[0], atom_count, *fields[1:])
+                        out.write(last_line)
+            else:
+                for line in f:
+                    if line.startswith(('ATOM', 'HETATM')):
+                        if len(line) < 26:
                             continue
-                        if res_name not in standard_residues:
+                        if not keep(line[:6].strip(), line[17:20].strip(), line[21:22].strip()):
                             continue
+                        atom_count += 1
+                    elif not line.startswith(('TER', 'END', 'MODEL', 'HEADER', 'TITLE', 'COMPND')):
+                        continue
+                    last_line = line if line.endswith('\n') else line + '\n'
+                    out.write(last_line)
 
-                    cleaned_lines.append(line)
-                    atom_count += 1
-
-                elif line.startswith('TER') or line.startswith('END'):
-                    cleaned_lines.append(line)
-                elif line.startswith('MODEL') or line.startswith('ENDMDL'):
-                    cleaned_lines.append(line)
-                elif line.startswith('HEADER') or line.startswith(
-                        'TITLE') or line.startswith('COMPND'):
-                    cleaned_lines.append(line)
+            if not last_line.startswith('END'):
+                out.write('END\n')
 
         if atom_count == 0:
+            os.remove(output_pdb)
             return False, "No valid protein atoms found after cleaning"
 
-        with open(output_pdb, 'w') as f:
-            f.writelines(cleaned_lines)
-            if not any(line.startswith('END') for line in cleaned_lines):
-                f.write('END\n')
-
         return True, None
 
     except Exception as e:
@@ -275,7 +441,7 @@ def clean_protein_structure(input_pdb,
     """
     Clean protein structure by removing water molecules, heteroatoms, and unwanted chains.
     Supports both PDB and mmCIF formats.
-    Uses BioPython first, falls back to text-based parser for problematic files.
+    Uses the streaming text-based cleaner, and BioPython only for files it cannot read.
     
     Args:
         input_pdb: Path to input PDB file (can be PDB or mmCIF format)
@@ -284,6 +450,32 @@ def clean_protein_structure(input_pdb,
         remove_water: Remove water molecules (default: True)
         remove_hetero: Remove all heteroatoms including ligands (default: True)
     
+    Returns:
+        tuple: (success, error_message)
+    """
+    success, error = clean_protein_structure_text_based(
+        input_pdb, output_pdb, keep_chain, remove_water, remove_hetero)
+    if success:
+        return True, None
+
+    success, biopython_error = clean_protein_structure_biopython(
+        input_pdb, output_pdb, keep_chain, remove_water, remove_hetero)
+    if success:
+        return True, None
+    return False, f"Text-based cleaning failed ({error}), BioPython fallback also failed: {biopython_error}"
+
+
+def clean_protein_structure_biopython(input_pdb,
+                                      output_pdb,
+                                      keep_chain='A',
+                                      remove_water=True,
+                                      remove_hetero=True):
+    """
+    Clean a structure through BioPython's object model.
+    
+    Slower and far more memory-hungry than the streaming cleaner on large
+    structures; use it when object-level access is needed.
+    
     Returns:
         tuple: (success, error_message)
     """
@@ -341,11 +533,7 @@ def clean_protein_structure(input_pdb,
         return True, None
 
     except Exception as e:
-        success, error = clean_protein_structure_text_based(
-            input_pdb, output_pdb, keep_chain, remove_water, remove_hetero)
-        if success:
-            return True, None
-        return False, f"BioPython failed ({str(e)}), text-based fallback also failed: {error}"
+        return False, f"BioPython cleaning failed: {str(e)}"
 
 
 def add_hydrogens_openbabel(input_pdb, output_pdb, ph=7.0):
@@ -360,46 +548,39 @@ def add_hydrogens_openbabel(input_pdb, output_pdb, ph=7.0):
     Returns:
         tuple: (success, error_message)
     """
-    try:
-        cmd = ['obabel', input_pdb, '-O', output_pdb, '-p', str(ph)]
-        result = subprocess.run(cmd,
-                                capture_output=True,
-                                text=True,
-                                timeout=60)
-
-        if result.returncode != 0:
-            error_msg = result.stderr if result.stderr else result.stdout
-            return False, f"OpenBabel hydrogen addition failed: {error_msg}"
-
-        if not os.path.exists(output_pdb) or os.path.getsize(output_pdb) == 0:
-            return False, "Hydrogen addition produced empty file"
-
-        return True, None
-
-    except subprocess.TimeoutExpired:
-        return False, "Hydrogen addition timed out"
-    except Exception as e:
-        return False, f"Error adding hydrogens: {str(e)}"
-
-
-def prepare_protein(input_pdb, output_pdbqt, keep_chain='A', add_h=True):
+    error = conversion_engine.default_engine().add_hydrogens(input_pdb, output_pdb, ph)
+    if error:
+        return False, error
+    return True, None
+
+
+def prepare_protein(input_pdb,
+                    output_pdbqt,
+                    keep_chain='A',
+                    add_h=True,
+                    work_dir=None,
+                    plddt_cutoff=None):
     """
     Complete protein preparation pipeline:
     1. Clean structure (remove water, heteroatoms, unwanted chains)
-    2. Add hydrogens (optional)
-    3. Convert to PDBQT format
+    2. Drop low-confidence residues of predicted models (optional)
+    3. Add hydrogens (optional)
+    4. Convert to PDBQT format
     
     Args:
         input_pdb: Path to input PDB file
         output_pdbqt: Path to output PDBQT file
         keep_chain: Chain to keep (default: 'A')
         add_h: Add hydrogens before conversion (default: True)
+        work_dir: Directory for intermediate PDB files (default: next to output_pdbqt)
+        plddt_cutoff: Remove residues with a lower pLDDT (B-factor column of
+                      AlphaFold/ESMFold models); None keeps every residue
     
     Returns:
         tuple: (success, error_message, intermediate_pdb_path)
     """
     try:
-        base_dir = os.path.dirname(output_pdbqt)
+        base_dir = work_dir or os.path.dirname(output_pdbqt)
         cleaned_pdb = os.path.join(base_dir, 'cleaned_protein.pdb')
 
         success, error = clean_protein_structure(input_pdb,
@@ -408,6 +589,14 @@ def prepare_protein(input_pdb, output_pdbqt, keep_chain='A', add_h=True):
         if not success:
             return False, error, None
 
+        if plddt_cutoff:
+            confident_pdb = os.path.join(base_dir, 'confident_protein.pdb')
+            kept, dropped = receptor_trim.drop_low_confidence(cleaned_pdb, confident_pdb, plddt_cutoff)
+            if kept == 0:
+                return False, f"No residues with pLDDT of at least {plddt_cutoff}", None
+            print(f"Removed {dropped} residues with pLDDT below {plddt_cutoff}")
+            cleaned_pdb = confident_pdb
+
         if add_h:
             hydrogenated_pdb = os.path.join(base_dir, 'protein_with_h.pdb')
             success, error = add_hydrogens_openbabel(cleaned_pdb,
@@ -422,19 +611,10 @@ def prepare_protein(input_pdb, output_pdbqt, keep_chain='A', add_h=True):
         else:
             final_pdb = cleaned_pdb
 
-        cmd = ['obabel', final_pdb, '-O', output_pdbqt, '-xr']
-        result = subprocess.run(cmd,
-                                capture_output=True,
-                                text=True,
-                                timeout=60)
-
-        if result.returncode != 0:
-            error_msg = result.stderr if result.stderr else result.stdout
-            return False, f"PDBQT conversion failed: {error_msg}", final_pdb
-
-        if not os.path.exists(output_pdbqt) or os.path.getsize(
-                output_pdbqt) == 0:
-            return False, "PDBQT conversion produced empty file", final_pdb
+        error = conversion_engine.default_engine().to_pdbqt(
+            [(final_pdb, output_pdbqt)], rigid=True)[0]
+        if error:
+            return False, error, final_pdb
 
         return True, None, final_pdb
 
@@ -0,0 +1,58 @@
+import os
+import shutil
+
+from disk_cache import DiskCache, file_digest, make_key
+
+PDBQT_FILE = 'receptor.pdbqt'
+CLEANED_FILE = 'cleaned.pdb'
+
+# Bump when protein_prep changes what a preparation produces, so older entries stop matching
+PREPARATION_VERSION = 3
+
+
+class ReceptorCache(DiskCache):
+    """
+    Content-addressed cache of prepared receptors.
+
+    Entries are keyed by the raw structure bytes and the preparation options,
+    and hold the receptor PDBQT, the cleaned PDB it was made from and the
+    verification report, so a hit skips cleaning, hydrogenation and PDBQT
+    conversion entirely.
+    """
+
+    def receptor_key(self, input_pdb, keep_chain='A', add_h=True, plddt_cutoff=None):
+        return make_key(
+            'receptor-prep',
+            PREPARATION_VERSION,
+            file_digest(input_pdb),
+            keep_chain,
+            bool(add_h),
+            float(plddt_cutoff) if plddt_cutoff else None
+        )
+
+    def fetch(self, key, output_pdbqt, cleaned_pdb=None):
+        """
+        Copy a cached preparation to output_pdbqt (and cleaned_pdb if given).
+
+        Returns:
+            dict: Cached verification report on a hit, None on a miss
+        """
+        entry_dir, meta = self.get(key)
+        if entry_dir is None:
+            return None
+        try:
+            shutil.copyfile(os.path.join(entry_dir, PDBQT_FILE), output_pdbqt)
+            if cleaned_pdb:
+                shutil.copyfile(os.path.join(entry_dir, CLEANED_FILE), cleaned_pdb)
+        except OSError:
+            return None
+        return meta.get('verification') or {}
+
+    def store(self, key, output_pdbqt, cleaned_pdb, verification):
+        """Save a successful preparation under key"""
+        if not os.path.exists(output_pdbqt):
+            return None
+        files = {PDBQT_FILE: output_pdbqt}
+        if cleaned_pdb and os.path.exists(cleaned_pdb):
+            files[CLEANED_FILE] = cleaned_pdb
+        return self.put(key, files, {'verification': verification})
@@ -0,0 +1,140 @@
+import os
+import uuid
+
+import numpy as np
+
+from disk_cache import make_key
+
+# Smina's scoring terms vanish beyond 8 A, so atoms farther than this from
+# the box cannot affect any pose inside it
+SCORING_CUTOFF = 8.0
+
+
+def _residue_key(line):
+    """Chain, residue number and insertion code of an ATOM/HETATM line"""
+    return line[21:27]
+
+
+def residue_confidence(pdb_file):
+    """
+    Mean pLDDT per residue, read from the B-factor column of a predicted model.
+
+    AlphaFold writes pLDDT on a 0-100 scale; ESMFold may write it as a
+    fraction, which is rescaled so one cutoff works for both.
+
+    Returns:
+        dict: {residue key: mean pLDDT}
+    """
+    sums, counts = {}, {}
+    with open(pdb_file, 'r') as f:
+        for line in f:
+            if not line.startswith(('ATOM', 'HETATM')) or len(line) < 66:
+                continue
+            try:
+                b_factor = float(line[60:66])
+            except ValueError:
+                continue
+            key = _residue_key(line)
+            sums[key] = sums.get(key, 0.0) + b_factor
+            counts[key] = counts.get(key, 0) + 1
+
+    confidence = {key: sums[key] / counts[key] for key in sums}
+    if confidence and max(confidence.values()) <= 1.0:
+        confidence = {key: value * 100.0 for key, value in confidence.items()}
+    return confidence
+
+
+def drop_low_confidence(input_pdb, output_pdb, cutoff):
+    """
+    Remove residues whose pLDDT is below cutoff from a predicted model.
+
+    Returns:
+        tuple: (kept_residues, dropped_residues)
+    """
+    confidence = residue_confidence(input_pdb)
+    keep = {key for key, value in confidence.items() if value >= cutoff}
+    with open(input_pdb, 'r') as f, open(output_pdb, 'w') as out:
+        for line in f:
+            if line.startswith(('ATOM', 'HETATM')) and _residue_key(line) not in keep:
+                continue
+            out.write(line)
+    return len(keep), len(confidence) - len(keep)
+
+
+def residues_near_box(pdbqt_file, center, size, margin):
+    """
+    Residues with at least one atom inside the box grown by margin on every side.
+
+    Returns:
+        set: Residue keys of the residues to keep
+    """
+    keys, coords = [], []
+    with open(pdbqt_file, 'r') as f:
+        for line in f:
+            if line.startswith(('ATOM', 'HETATM')):
+                try:
+                    coords.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+                except ValueError:
+                    continue
+                keys.append(_residue_key(line))
+    if not coords:
+        return set()
+
+    half = np.asarray(size, dtype=float) / 2.0 + margin
+    inside = np.all(np.abs(np.asarray(coords) - np.asarray(center, dtype=float)) <= half, axis=1)
+    return {keys[i] for i in np.flatnonzero(inside)}
+
+
+def trim_to_box(pdbqt_file, output_file, center, size, margin=SCORING_CUTOFF):
+    """
+    Write a receptor reduced to the residues near a docking box.
+
+    Whole residues are kept, so no residue loses part of its side chain.
+
+    Returns:
+        tuple: (kept_atoms, total_atoms)
+    """
+    keep = residues_near_box(pdbqt_file, center, size, margin)
+    kept = total = 0
+    with open(pdbqt_file, 'r') as f, open(output_file, 'w') as out:
+        for line in f:
+            if line.startswith(('ATOM', 'HETATM')):
+                total += 1
+                if _residue_key(line) not in keep:
+                    continue
+                kept += 1
+            out.write(line)
+    return kept, total
+
+
+def trimmed_receptor(pdbqt_file, center, size, margin=SCORING_CUTOFF):
+    """
+    Receptor trimmed to a docking box, written once per box and reused.
+
+    The trimmed file sits next to the receptor and is regenerated only when
+    the receptor is newer. If trimming would leave no atoms the full
+    receptor is returned.
+
+    Returns:
+        str: Path of the receptor smina should load
+    """
+    box = make_key([round(float(v), 3) for v in center], [round(float(v), 3) for v in size], float(margin))[:12]
+    trimmed = f"{os.path.splitext(pdbqt_file)[0]}.trim-{box}.pdbqt"
+    try:
+        if os.path.getmtime(trimmed) >= os.path.getmtime(pdbqt_file):
+            return trimmed
+    except OSError:
+        pass
+
+    # Concurrent jobs may trim the same receptor; publish atomically
+    tmp_path = f"{trimmed}.{uuid.uuid4().hex}.tmp"
+    try:
+        kept, total = trim_to_box(pdbqt_file, tmp_path, center, size, margin)
+        if kept == 0:
+            return pdbqt_file
+        os.replace(tmp_path, trimmed)
+        print(f"Trimmed {os.path.basename(pdbqt_file)} to {kept} of {total} atoms near the docking box")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return trimmed
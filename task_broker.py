@@ -0,0 +1,234 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch_id TEXT NOT NULL,
+    pair_index INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_claim ON tasks (state, id);
+CREATE INDEX IF NOT EXISTS tasks_batch ON tasks (batch_id, pair_index);
+"""
+
+
+class TaskBroker:
+    """
+    Docking task queue stored in a SQLite database on shared storage.
+
+    Workers claim tasks with a time-limited lease and renew it while they
+    run. A task whose lease expires (its worker died or was killed) becomes
+    claimable again until it has been attempted max_attempts times.
+    """
+
+    def __init__(self, db_path, lease_seconds=600, max_attempts=3):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA busy_timeout=30000')
+        return closing(conn)
+
+    def submit(self, batch_id, tasks):
+        """
+        Add tasks to the queue.
+
+        Args:
+            batch_id: Identifier shared by all tasks of one batch
+            tasks: Iterable of (pair_index, payload) with JSON-serialisable payloads
+
+        Returns:
+            int: Number of tasks added
+        """
+        now = time.time()
+        rows = [(batch_id, index, json.dumps(payload), PENDING, now, now)
+                for index, payload in tasks]
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(
+                'INSERT INTO tasks (batch_id, pair_index, payload, state, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            conn.execute('COMMIT')
+        return len(rows)
+
+    def claim(self, worker_id):
+        """
+        Lease the oldest available task to worker_id.
+
+        Returns:
+            dict: Task with 'id', 'batch_id', 'pair_index', 'payload' and
+                  'attempts', or None if nothing is available
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Tasks abandoned by dead workers that are out of retries fail here
+                conn.execute(
+                    'UPDATE tasks SET state = ?, error = ?, updated_at = ? '
+                    'WHERE state = ? AND lease_expires < ? AND attempts >= ?',
+                    (FAILED, 'Worker lease expired too many times', now,
+                     RUNNING, now, self.max_attempts))
+                row = conn.execute(
+                    'SELECT * FROM tasks WHERE state = ? OR (state = ? AND lease_expires < ?) '
+                    'ORDER BY id LIMIT 1', (PENDING, RUNNING, now)).fetchone()
+                if row is None:
+                    conn.execute('COMMIT')
+                    return None
+                conn.execute(
+                    'UPDATE tasks SET state = ?, worker = ?, lease_expires = ?, '
+                    'attempts = attempts + 1, updated_at = ? WHERE id = ?',
+                    (RUNNING, worker_id, now + self.lease_seconds, now, row['id']))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+        return {
+            'id': row['id'],
+            'batch_id': row['batch_id'],
+            'pair_index': row['pair_index'],
+            'payload': json.loads(row['payload']),
+            'attempts': row['attempts'] + 1
+        }
+
+    def heartbeat(self, task_id, worker_id):
+        """
+        Extend the lease of a running task.
+
+        Returns:
+            bool: False if the worker no longer owns the task
+        """
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute(
+                'UPDATE tasks SET lease_expires = ?, updated_at = ? '
+                'WHERE id = ? AND worker = ? AND state = ?',
+                (now + self.lease_seconds, now, task_id, worker_id, RUNNING))
+            return cur.rowcount == 1
+
+    def complete(self, task_id, worker_id, result):
+        """
+        Store the result of a task the worker still owns.
+
+        Returns:
+            bool: False if the lease was lost and another worker took over
+        """
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute(
+                'UPDATE tasks SET state = ?, result = ?, error = NULL, lease_expires = NULL, '
+                'updated_at = ? WHERE id = ? AND worker = ? AND state = ?',
+                (DONE, json.dumps(result), now, task_id, worker_id, RUNNING))
+            return cur.rowcount == 1
+
+    def fail(self, task_id, worker_id, error, retry=True):
+        """
+        Record a failed attempt.
+
+        With retry=True the task goes back to the queue until it has been
+        attempted max_attempts times.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT attempts FROM tasks WHERE id = ? AND worker = ? AND state = ?',
+                               (task_id, worker_id, RUNNING)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return False
+            state = PENDING if retry and row['attempts'] < self.max_attempts else FAILED
+            conn.execute(
+                'UPDATE tasks SET state = ?, error = ?, worker = NULL, lease_expires = NULL, '
+                'updated_at = ? WHERE id = ?', (state, str(error), now, task_id))
+            conn.execute('COMMIT')
+        return True
+
+    def cancel_batch(self, batch_id):
+        """Cancel every task of a batch that has not started yet"""
+        with self._connect() as conn:
+            cur = conn.execute('UPDATE tasks SET state = ?, updated_at = ? WHERE batch_id = ? AND state = ?',
+                               (CANCELLED, time.time(), batch_id, PENDING))
+            return cur.rowcount
+
+    def withdraw_batch(self, batch_id):
+        """
+        Cancel the tasks of a batch that no live worker holds.
+
+        Pending tasks and running tasks whose lease has expired are
+        withdrawn; a worker that later reports on one of them is ignored.
+
+        Returns:
+            list: Pair indices of the withdrawn tasks
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            where = 'batch_id = ? AND (state = ? OR (state = ? AND lease_expires < ?))'
+            params = (batch_id, PENDING, RUNNING, now)
+            rows = conn.execute(f'SELECT pair_index FROM tasks WHERE {where}', params).fetchall()
+            conn.execute(f'UPDATE tasks SET state = ?, lease_expires = NULL, updated_at = ? WHERE {where}',
+                         (CANCELLED, now) + params)
+            conn.execute('COMMIT')
+        return [row['pair_index'] for row in rows]
+
+    def last_activity(self, batch_id):
+        """Time any task of a batch was last submitted, claimed, renewed or finished"""
+        with self._connect() as conn:
+            row = conn.execute('SELECT MAX(updated_at) AS t FROM tasks WHERE batch_id = ?',
+                               (batch_id,)).fetchone()
+        return row['t'] or 0.0
+
+    def batch_status(self, batch_id):
+        """
+        Count the tasks of a batch by state.
+
+        Returns:
+            dict: {state: count} for every state present in the batch
+        """
+        with self._connect() as conn:
+            rows = conn.execute('SELECT state, COUNT(*) AS n FROM tasks WHERE batch_id = ? GROUP BY state',
+                                (batch_id,)).fetchall()
+        return {row['state']: row['n'] for row in rows}
+
+    def batch_results(self, batch_id):
+        """
+        Results of the finished tasks of a batch, in pair order.
+
+        Yields:
+            tuple: (pair_index, result)
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT pair_index, result FROM tasks WHERE batch_id = ? AND state = ? ORDER BY pair_index',
+                (batch_id, DONE)).fetchall()
+        for row in rows:
+            yield row['pair_index'], json.loads(row['result']) if row['result'] else None
+
@@ -130,6 +130,8 @@ def verify_pdbqt_structure(pdbqt_file: str, is_protein: bool = True) -> Dict:
         has_atom_types = False
         has_coordinates = False
         root_found = False
+        branch_count = 0
+        torsdof = None
         warnings = []
         
         with open(pdbqt_file, 'r') as f:
@@ -161,6 +163,13 @@ def verify_pdbqt_structure(pdbqt_file: str, is_protein: bool = True) -> Dict:
                 
                 if line.startswith('ROOT'):
                     root_found = True
+                elif line.startswith('BRANCH'):
+                    branch_count += 1
+                elif line.startswith('TORSDOF'):
+                    try:
+                        torsdof = int(line.split()[1])
+                    except (IndexError, ValueError):
+                        pass
         
         if atom_count == 0:
             return {
@@ -200,7 +209,8 @@ def verify_pdbqt_structure(pdbqt_file: str, is_protein: bool = True) -> Dict:
                 'has_coordinates': has_coordinates,
                 'has_partial_charges': has_charges,
                 'has_atom_types': has_atom_types,
-                'has_root': root_found
+                'has_root': root_found,
+                'torsion_count': torsdof if torsdof is not None else branch_count
             },
             'warnings': warnings
         }
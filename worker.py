@@ -0,0 +1,114 @@
+"""
+Docking worker: pulls batch docking tasks from the shared task broker.
+
+Run one or more of these on any machine that mounts the same data folder
+as the web server; start one per core to use a whole machine:
+
+    DOCKING_BROKER=/mnt/shared/broker.sqlite python worker.py --data-dir /mnt/shared/data
+
+Each task is a receptor with one or more ligands, docked with the same
+pipeline as /dock_batch (smina, result parsing, complex generation). Output
+files are written next to the inputs in the shared data folder and the
+results are reported back through the broker. The docking pipeline is
+loaded with DATA_DIR set to --data-dir, so its caches and cost model live
+in the shared folder rather than under the worker's working directory.
+"""
+import argparse
+import os
+import socket
+import threading
+import time
+import uuid
+
+from task_broker import TaskBroker
+
+# The docking pipeline, imported by load_pipeline() once the data folder is known
+main = None
+
+
+def load_pipeline(data_dir):
+    """Import the docking pipeline with every data path under data_dir"""
+    global main
+    os.environ['DATA_DIR'] = data_dir
+    import main
+
+
+def heartbeat_loop(broker, task_id, worker_id, stop, interval):
+    """Renew the task lease until stop is set or the lease is lost"""
+    while not stop.wait(interval):
+        if not broker.heartbeat(task_id, worker_id):
+            print(f"Lost lease on task {task_id}")
+            return
+
+
+def run_task(broker, task, worker_id, cpu=None):
+    """Dock one claimed task and report its result to the broker"""
+    payload = task['payload']
+    settings = payload['settings']
+    if cpu:
+        settings = {**settings, 'cpu': cpu}
+    data_dir = main.app.config['UPLOAD_FOLDER']
+    prot_path = os.path.join(data_dir, payload['protein'])
+    indexed_ligs = [(index, os.path.join(data_dir, lig)) for index, lig in payload['ligands']]
+
+    stop = threading.Event()
+    beat = threading.Thread(target=heartbeat_loop,
+                            args=(broker, task['id'], worker_id, stop, max(1, broker.lease_seconds / 3)),
+                            daemon=True)
+    beat.start()
+    try:
+        results = main.dock_batch_item((prot_path, indexed_ligs), settings)
+    except Exception as e:
+        print(f"Task {task['id']} failed (attempt {task['attempts']}): {e}")
+        broker.fail(task['id'], worker_id, e, retry=True)
+        return
+    finally:
+        stop.set()
+        beat.join()
+
+    if not any(result for _, result in results):
+        broker.fail(task['id'], worker_id, 'Docking failed for every ligand', retry=False)
+        return
+    if not broker.complete(task['id'], worker_id, results):
+        print(f"Task {task['id']} finished after its lease expired; result discarded")
+
+
+def main_loop(broker, worker_id, poll_interval=2.0, once=False, cpu=None):
+    print(f"Worker {worker_id} polling {broker.db_path}")
+    while True:
+        task = broker.claim(worker_id)
+        if task is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+        print(f"Worker {worker_id} docking task {task['id']} of batch {task['batch_id']}")
+        run_task(broker, task, worker_id, cpu=cpu)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run docking tasks from the shared task broker')
+    parser.add_argument('--broker', default=os.environ.get('DOCKING_BROKER'),
+                        help='SQLite broker database on shared storage (default: $DOCKING_BROKER)')
+    parser.add_argument('--data-dir', default=os.environ.get('DATA_DIR', 'data'),
+                        help='Shared data folder the task paths are relative to (default: $DATA_DIR or data)')
+    parser.add_argument('--worker-id', default=f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}",
+                        help='Name recorded on claimed tasks (default: host-pid-random)')
+    parser.add_argument('--cpu', type=int, default=None,
+                        help='Threads per smina run (default: the value planned by the server)')
+    parser.add_argument('--lease', type=float, default=600,
+                        help='Seconds a claimed task stays leased without a heartbeat (default: 600)')
+    parser.add_argument('--poll', type=float, default=2.0,
+                        help='Seconds to wait when the queue is empty (default: 2)')
+    parser.add_argument('--once', action='store_true',
+                        help='Exit when the queue is empty instead of polling')
+    args = parser.parse_args()
+
+    if not args.broker:
+        parser.error('--broker or DOCKING_BROKER is required')
+
+    load_pipeline(args.data_dir)
+    main.check_broker_path(args.broker)
+    print(f"Docking worker on {socket.gethostname()} using data folder {os.path.abspath(args.data_dir)}")
+    main_loop(TaskBroker(args.broker, lease_seconds=args.lease), args.worker_id,
+              poll_interval=args.poll, once=args.once, cpu=args.cpu)
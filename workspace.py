@@ -0,0 +1,185 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+SESSIONS_DIR = 'sessions'
+SCRATCH_DIR = 'scratch'
+
+# How often a workspace in use is touched, so cleanup in other processes sees it as fresh
+IN_USE_TOUCH_SECONDS = 600
+
+# A lock file not refreshed for this long belongs to a process that died
+LOCK_STALE_SECONDS = 600
+# How often a held lock file is refreshed
+LOCK_TOUCH_SECONDS = 60
+
+_in_use = {}
+_in_use_lock = threading.Lock()
+
+
+def new_workspace_id():
+    return uuid.uuid4().hex
+
+
+def session_workspace(root, workspace_id):
+    """
+    Directory holding one session's prepared structures and docking outputs.
+
+    Args:
+        root: Data folder (app.config['UPLOAD_FOLDER'])
+        workspace_id: Identifier stored in the user's session
+
+    Returns:
+        str: Path of the workspace, created if needed
+    """
+    path = os.path.join(root, SESSIONS_DIR, workspace_id)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def job_directory(workspace, job_id):
+    """Directory for the outputs of one docking job inside a workspace"""
+    path = os.path.join(workspace, 'jobs', job_id)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def batch_directory(workspace, batch_id):
+    """Directory for the outputs of one batch docking job inside a workspace"""
+    path = os.path.join(workspace, 'batches', batch_id)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@contextmanager
+def scratch_directory(workspace):
+    """
+    Private directory for the intermediate files of one preparation or job.
+
+    The directory is removed when the block exits, whether or not it succeeded.
+
+    Yields:
+        str: Path of the scratch directory
+    """
+    path = os.path.join(workspace, SCRATCH_DIR, new_workspace_id())
+    os.makedirs(path)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+@contextmanager
+def _kept_fresh(path, interval):
+    """Touch path every interval seconds while the block runs"""
+    stop = threading.Event()
+
+    def keep_fresh():
+        while True:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            if stop.wait(interval):
+                return
+
+    toucher = threading.Thread(target=keep_fresh, daemon=True)
+    toucher.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        toucher.join()
+
+
+@contextmanager
+def in_use(path):
+    """
+    Mark a workspace as used by a running job for the duration of the block.
+
+    Jobs mostly write to files that already exist, which does not change
+    the workspace's mtime, so the workspace is touched periodically while
+    the block runs and cleanup in this process skips it outright.
+    """
+    key = os.path.abspath(path)
+    with _in_use_lock:
+        _in_use[key] = _in_use.get(key, 0) + 1
+    try:
+        with _kept_fresh(key, IN_USE_TOUCH_SECONDS):
+            yield path
+    finally:
+        with _in_use_lock:
+            _in_use[key] -= 1
+            if not _in_use[key]:
+                del _in_use[key]
+
+
+def claim_lock(lock_path, stale_seconds=LOCK_STALE_SECONDS):
+    """
+    Create a lock file, taking over one that was not refreshed for stale_seconds.
+
+    Returns:
+        bool: False while another process holds the lock
+    """
+    for _ in range(2):
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) < stale_seconds:
+                    return False
+                os.remove(lock_path)
+            except OSError:
+                pass
+    return False
+
+
+@contextmanager
+def holding_lock(lock_path):
+    """Keep a claimed lock file fresh for the duration of the block, then release it"""
+    try:
+        with _kept_fresh(lock_path, LOCK_TOUCH_SECONDS):
+            yield lock_path
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+
+def iter_in_use(path, items):
+    """Yield from items with the workspace marked in use until the iteration ends"""
+    with in_use(path):
+        yield from items
+
+
+def cleanup_stale_workspaces(root, max_age_seconds):
+    """
+    Remove session workspaces that have not been modified for max_age_seconds.
+
+    Workspaces marked in_use() are kept whatever their age.
+
+    Returns:
+        int: Number of workspaces removed
+    """
+    sessions_root = os.path.join(root, SESSIONS_DIR)
+    if not os.path.isdir(sessions_root):
+        return 0
+
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    for name in os.listdir(sessions_root):
+        path = os.path.join(sessions_root, name)
+        try:
+            with _in_use_lock:
+                busy = os.path.abspath(path) in _in_use
+            if not busy and os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        except OSError:
+            continue
+    return removed